@@ -0,0 +1,109 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+
+Parsing of Caffe training logs (in place of caffe/tools/extra/parse_log.py). Stats have the same columns as the
+.train/.test files written by parse_log.py: NumIters, Seconds, LearningRate, then net outputs in order.
+"""
+import os
+import re
+import datetime
+import numpy as np
+
+REGEX_ITERATION = re.compile(r'Iteration (\d+)')
+REGEX_TRAIN_OUTPUT = re.compile(r'Train net output #(\d+): (\S+) = ([.\deE+-]+)')
+REGEX_TEST_OUTPUT = re.compile(r'Test net output #(\d+): (\S+) = ([.\deE+-]+)')
+REGEX_LEARNING_RATE = re.compile(r'lr = ([-+]?[0-9]*\.?[0-9]+([eE]?[-+]?[0-9]+)?)')
+REGEX_TIME = re.compile(r'^[IWEF](\d{4}) (\d{2}):(\d{2}):(\d{2}\.\d+)')
+
+
+class CaffeLog:
+    """
+    A Caffe log parsed incrementally: update() only reads what was appended since the previous call.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.iteration = -1
+        self.learning_rate = np.nan
+        self.start_time, self.last_time, self.year = None, None, 2000
+        self.train_rows, self.test_rows = [], []
+
+    def update(self):
+        if os.path.getsize(self.path) < self.offset:  # log was overwritten
+            self.__init__(self.path)
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):  # being written
+                    break
+                self.offset += len(line)
+                self._parse_line(line.decode('utf-8', errors='replace'))
+        return self
+
+    def _seconds(self, line):
+        m = REGEX_TIME.match(line)
+        if m is None:
+            return None
+        t = datetime.datetime.strptime('{} {} {}:{}:{}'.format(self.year, *m.groups()), '%Y %m%d %H:%M:%S.%f')
+        if self.last_time is not None and t < self.last_time - datetime.timedelta(days=1):  # new year
+            self.year += 1
+            t = t.replace(year=self.year)
+        self.last_time = t
+        if self.start_time is None:
+            self.start_time = t
+        return (t - self.start_time).total_seconds()
+
+    def _parse_line(self, line):
+        seconds = self._seconds(line)
+        m = REGEX_ITERATION.search(line)
+        if m:
+            self.iteration = int(m.group(1))
+        if self.iteration < 0:
+            return
+
+        m = REGEX_LEARNING_RATE.search(line)
+        if m:
+            self.learning_rate = float(m.group(1))
+            for rows in (self.train_rows, self.test_rows):  # rows before the first learning rate line
+                for row in rows:
+                    if np.isnan(row['LearningRate']):
+                        row['LearningRate'] = self.learning_rate
+
+        for regex, rows in ((REGEX_TRAIN_OUTPUT, self.train_rows), (REGEX_TEST_OUTPUT, self.test_rows)):
+            m = regex.search(line)
+            if m:
+                if int(m.group(1)) == 0 or not rows:
+                    rows.append(dict(NumIters=self.iteration, Seconds=seconds, LearningRate=self.learning_rate))
+                rows[-1][m.group(2)] = float(m.group(3))
+
+    @staticmethod
+    def _stats(rows):
+        if not rows:
+            return ['NumIters', 'Seconds', 'LearningRate'], np.zeros((0, 3))
+        labels = list(rows[0].keys())
+        for row in rows:
+            labels.extend(k for k in row if k not in labels)
+        return labels, np.array([[np.nan if row.get(k) is None else row[k] for k in labels] for row in rows])
+
+    def train_stats(self):
+        """
+        :return: column names, N x K array
+        """
+        return self._stats(self.train_rows)
+
+    def test_stats(self):
+        return self._stats(self.test_rows)
+
+
+_logs = dict()
+
+
+def load(path):
+    """
+    :return: the CaffeLog of path, updated with what was appended to it since it was last loaded
+    """
+    key = os.path.abspath(path)
+    if key not in _logs:
+        _logs[key] = CaffeLog(path)
+    return _logs[key].update()
@@ -0,0 +1,278 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+
+Static cost of a network: blob shapes, activation memory, parameter counts and multiply-accumulates per layer,
+inferred from the prototxt without building the network.
+"""
+import ast
+import json
+import argparse
+from functools import reduce
+import numpy as np
+
+import splatnet.configs
+from splatnet.permutohedral import filter_cost, num_filter_taps
+from splatnet.utils import parse_channel_scale, map_channel_scale
+
+PHASES = ('TRAIN', 'TEST')
+
+
+def load_net_param(net):
+    """
+    :param net: path to a .prototxt file, or a NetParameter (e.g. from NetSpec.to_proto())
+    """
+    if not isinstance(net, str):
+        return net
+    from caffe.proto import caffe_pb2
+    import google.protobuf.text_format as txtf
+    net_param = caffe_pb2.NetParameter()
+    with open(net) as f:
+        txtf.Merge(f.read(), net_param)
+    return net_param
+
+
+def in_phase(layer, phase):
+    for rule in layer.include:
+        if rule.HasField('phase') and PHASES[rule.phase] != phase:
+            return False
+    for rule in layer.exclude:
+        if rule.HasField('phase') and PHASES[rule.phase] == phase:
+            return False
+    return True
+
+
+def data_layer_shapes(layer):
+    """
+    Top shapes of the dataset Python layers, from their param_str
+    """
+    params = ast.literal_eval(layer.python_param.param_str)
+    bs, ss = params.get('batch_size', 1), params['sample_size']
+    shapes = [(bs, len(params['feat_dims'].split('_')), 1, ss), (bs, 1, 1, ss),
+              (bs, sum(splatnet.configs.SN_NUM_PART_CATEGORIES), 1, 1)]
+    return shapes[:len(layer.top)]
+
+
+def with_input_layers(net_param, phase='TRAIN'):
+    """
+    Replace the dataset layers of a network (in place) with Input layers of the same shapes and drop layers of the
+    other phase, so that it can be run on synthetic data
+    """
+    for i in reversed(range(len(net_param.layer))):
+        layer = net_param.layer[i]
+        if not in_phase(layer, phase):
+            del net_param.layer[i]
+        elif layer.type == 'Python' and layer.python_param.module.startswith('dataset_'):
+            shapes = data_layer_shapes(layer)
+            layer.type = 'Input'
+            layer.ClearField('python_param')
+            layer.ClearField('include')
+            for shape in shapes:
+                layer.input_param.shape.add().dim.extend(shape)
+    return net_param
+
+
+def python_layer_shapes(layer, bottoms):
+    name = layer.python_param.layer
+    if layer.python_param.module.startswith('dataset_'):
+        return data_layer_shapes(layer)
+    elif name == 'PickAndScale':
+        n, _, h, w = bottoms[0]
+        return [(n, len(layer.python_param.param_str.split('_')), h, w)]
+    elif name == 'Permute':
+        return [tuple(bottoms[0][int(d)] for d in layer.python_param.param_str.split('_'))]
+    elif name == 'LossHelper':
+        n, c, _, s = bottoms[0]
+        return [(n * s, c, 1, 1)]
+    elif name == 'LogLoss':
+        return [(1, 1, 1, 1)]
+    elif name == 'MaskedSoftmaxLoss':
+        return [(1, 1, 1, 1), bottoms[0]][:len(layer.top)]
+    else:  # GlobalPooling, ProbRenorm
+        return [bottoms[0]]
+
+
+def layer_cost(layer, bottoms, vertices_per_point=1.0):
+    """
+    :param bottoms: list of bottom shapes
+    :param vertices_per_point: estimated number of occupied lattice vertices per point (see tools/profile_lattice.py)
+    :return: list of top shapes, number of parameters, multiply-accumulates, extra (non-blob) bytes
+    """
+    if layer.type == 'Input':
+        return [tuple(s.dim) for s in layer.input_param.shape], 0, 0, 0
+    elif layer.type == 'Python':
+        return python_layer_shapes(layer, bottoms), 0, 0, 0
+    elif layer.type == 'Convolution':
+        p = layer.convolution_param
+        n, c, h, w = bottoms[0]
+        kernel = list(p.kernel_size) or [p.kernel_h, p.kernel_w]
+        kh, kw = kernel * 2 if len(kernel) == 1 else kernel
+        sh = sw = p.stride[0] if p.stride else 1
+        ph = pw = p.pad[0] if p.pad else 0
+        top = (n, p.num_output, (h + 2 * ph - kh) // sh + 1, (w + 2 * pw - kw) // sw + 1)
+        group = max(p.group, 1)
+        num_params = p.num_output * (c // group) * kh * kw + (p.num_output if p.bias_term else 0)
+        return [top], num_params, int(np.prod(top)) * (c // group) * kh * kw, 0
+    elif layer.type == 'Permutohedral':
+        p = layer.permutohedral_param
+        n, c, _, s = bottoms[0]
+        d = bottoms[1][1]
+        s_out = bottoms[2][3] if len(bottoms) > 2 else s
+        group = max(p.group, 1)
+        taps = num_filter_taps(d, p.neighborhood_size)
+        num_params = p.num_output * (c // group) * taps + (p.num_output if p.bias_term else 0)
+        flops, nbytes = filter_cost(max(s, s_out), int(np.ceil(vertices_per_point * max(s, s_out))), d,
+                                    c, p.num_output // group, p.neighborhood_size)
+        tops = [(n, p.num_output, 1, s_out), (1, 1, 1, 1)]
+        return tops[:len(layer.top)], num_params, n * flops // 2, n * nbytes
+    elif layer.type == 'BatchNorm':
+        return [bottoms[0]], 2 * bottoms[0][1] + 1, 2 * int(np.prod(bottoms[0])), 0
+    elif layer.type == 'Concat':
+        axis = layer.concat_param.axis
+        top = list(bottoms[0])
+        top[axis] = sum(b[axis] for b in bottoms)
+        return [tuple(top)], 0, 0, 0
+    elif layer.type == 'Eltwise':
+        return [bottoms[0]], 0, (len(bottoms) - 1) * int(np.prod(bottoms[0])), 0
+    elif layer.type in ('SoftmaxWithLoss', 'Accuracy'):
+        return [(1, 1, 1, 1)] * len(layer.top), 0, 0, 0
+    else:  # ReLU, Softmax and other element-wise layers
+        return [bottoms[0]] * len(layer.top), 0, 0, 0
+
+
+def analyze(net, phase='TRAIN', lattice_stats=None, vertices_per_point=1.0, itemsize=4):
+    """
+    :param net: path to a .prototxt file or a NetParameter
+    :param lattice_stats: a dict of lattice spec (PickAndScale param_str) -> vertices per point
+    :param vertices_per_point: estimate used for lattices not in lattice_stats
+    :return: list of dicts, one per layer: name, type, top shapes, bytes of new top blobs, params, MACs,
+             extra bytes (lattice buffers)
+    """
+    net_param = load_net_param(net)
+    shapes, producers, rows = dict(), dict(), []
+    for layer in net_param.layer:
+        if not in_phase(layer, phase):
+            continue
+        bottoms = [shapes[b] for b in layer.bottom]
+        vpp = vertices_per_point
+        if layer.type == 'Permutohedral' and lattice_stats:
+            src = producers.get(layer.bottom[1])
+            if src is not None and src.type == 'Python' and src.python_param.param_str in lattice_stats:
+                vpp = lattice_stats[src.python_param.param_str]
+        tops, num_params, macs, extra = layer_cost(layer, bottoms, vpp)
+        new_bytes = sum(int(np.prod(s)) * itemsize for t, s in zip(layer.top, tops) if t not in shapes)
+        for t, s in zip(layer.top, tops):
+            shapes[t] = s
+            producers[t] = layer
+        rows.append(dict(name=layer.name, type=layer.type if layer.type != 'Python' else layer.python_param.layer,
+                         tops=tops, act_bytes=new_bytes, params=num_params, macs=macs, extra_bytes=extra))
+    return rows
+
+
+def totals(rows, train=False, itemsize=4, param_copies=4):
+    """
+    :param train: if True, count gradients of activations and parameters, solver history, and backward MACs
+                  (twice the forward ones)
+    :param param_copies: parameter copies when training (data, gradient and solver history; 4 for Adam)
+    :return: a dict of totals
+    """
+    params = sum(r['params'] for r in rows)
+    out = dict(params=params,
+               macs=sum(r['macs'] for r in rows) * (3 if train else 1),
+               act_bytes=sum(r['act_bytes'] for r in rows) * (2 if train else 1),
+               param_bytes=params * itemsize * (param_copies if train else 1),
+               extra_bytes=sum(r['extra_bytes'] for r in rows))
+    out['total_bytes'] = out['act_bytes'] + out['param_bytes'] + out['extra_bytes']
+    return out
+
+
+def print_layers(rows, file=None):
+    print('{:16} {:18} {:24} {:>10} {:>10} {:>12}'.format('layer', 'type', 'top', 'act(MB)', 'params', 'MMACs'),
+          file=file)
+    for r in rows:
+        print('{:16} {:18} {:24} {:10.2f} {:10d} {:12.2f}'.format(
+            r['name'], r['type'], 'x'.join(str(v) for v in r['tops'][0]) if r['tops'] else '',
+            (r['act_bytes'] + r['extra_bytes']) / 2 ** 20, r['params'], r['macs'] / 1e6), file=file)
+
+
+def print_totals(name, t, file=None):
+    print('{}: {:,} params, {:.2f} GMACs/iter, activations {:.1f}MB, parameters {:.1f}MB, lattices {:.1f}MB, '
+          'total {:.1f}MB'.format(name, t['params'], t['macs'] / 1e9, t['act_bytes'] / 2 ** 20,
+                                  t['param_bytes'] / 2 ** 20, t['extra_bytes'] / 2 ** 20, t['total_bytes'] / 2 ** 20),
+          file=file)
+
+
+def lattice_stats_from_json(path, feat_dims_str, lattice_dims_strs):
+    """
+    Vertices per point from a tools/profile_lattice.py summary, keyed the way the network generators name lattice
+    specs (channel indices into the input, which lists feature dims then lattice dims, without duplicates)
+    """
+    with open(path) as f:
+        profile = json.load(f)
+    names = [parse_channel_scale(s, channel_str=True)[0] for s in [feat_dims_str] + list(lattice_dims_strs)]
+    input_dims = reduce(lambda x, y: x if y in x else x + [y], reduce(lambda x, y: x + y, names), [])
+    return {map_channel_scale(spec, input_dims): v['vertices_per_point'] for spec, v in profile['lattices'].items()}
+
+
+def network_variants(model, arch, skips, feat, lattice, sample_size, batch_size, dataset_params=None,
+                     category='airplane', renorm_class=False):
+    """
+    :return: train and deploy NetParameters of a generated network
+    """
+    args = dict(arch_str=arch, skip_str=skips, sample_size=sample_size, batch_size=batch_size,
+                feat_dims_str=feat, lattice_dims_str=lattice, dataset_params=dataset_params, create_prototxt=False)
+    if model == 'partseg':
+        from splatnet.partseg3d import models
+        fn, args['category'] = models.partseg_seq, category
+    elif model == 'partseg_combined':
+        from splatnet.partseg3d import models
+        fn, args['renorm_class'] = models.partseg_seq_combined_categories, renorm_class
+    elif model == 'semseg':
+        from splatnet.semseg3d import models
+        fn = models.semseg_seq
+    else:
+        raise ValueError('Unknown model: {}'.format(model))
+    return fn(**args), fn(deploy=True, **args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate memory, parameters and MACs of a network',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--prototxt', nargs='+', help='analyze these .prototxt files instead of generating networks')
+    parser.add_argument('--model', default='partseg', choices=('partseg', 'partseg_combined', 'semseg'),
+                        help='network generator')
+    parser.add_argument('--arch', default='64_128_256_256', help='network architecture')
+    parser.add_argument('--skips', nargs='+', help='skip connections')
+    parser.add_argument('--feat', default='x_y_z', help='features to use as input')
+    parser.add_argument('--lattice', nargs='+', help='bnn lattice features and scales')
+    parser.add_argument('--category', default='airplane', help='shapenet category (partseg)')
+    parser.add_argument('--renorm_class', action='store_true', help='renormalize prediction in true class')
+    parser.add_argument('--sample_size', type=int, default=3000, help='number of points in a sample')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of samples in a batch')
+    parser.add_argument('--dataset_params', nargs='+', help='dataset-specific parameters (key value pairs)')
+    parser.add_argument('--vertices_per_point', type=float, default=1.0,
+                        help='occupied lattice vertices per point, for lattices without profile')
+    parser.add_argument('--lattice_profile', default=None, type=str,
+                        help='a .json summary from tools/profile_lattice.py (profiled with the same --feat/--lattice)')
+    parser.add_argument('--param_copies', type=int, default=4, help='parameter copies when training (4 for Adam)')
+    parser.add_argument('--layers', action='store_true', help='if True, print per-layer costs')
+    args = parser.parse_args()
+
+    stats = lattice_stats_from_json(args.lattice_profile, args.feat, args.lattice) \
+        if args.lattice_profile and args.lattice else None
+
+    if args.prototxt:
+        variants = [(path, path, 'TEST' if 'deploy' in path else 'TRAIN') for path in args.prototxt]
+    else:
+        dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2])) if args.dataset_params \
+            else None
+        train_net, deploy_net = network_variants(args.model, args.arch, args.skips, args.feat, args.lattice,
+                                                 args.sample_size, args.batch_size, dataset_params,
+                                                 args.category, args.renorm_class)
+        variants = [('train', train_net, 'TRAIN'), ('deploy', deploy_net, 'TEST')]
+
+    for name, net, phase in variants:
+        rows = analyze(net, phase, stats, args.vertices_per_point)
+        if args.layers:
+            print_layers(rows)
+        print_totals(name, totals(rows, train=phase == 'TRAIN', param_copies=args.param_copies))
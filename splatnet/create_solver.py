@@ -2,8 +2,18 @@
 Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import os
+import sys
+import json
+import time
+import datetime
 import tempfile
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
 from caffe.proto import caffe_pb2
+import google.protobuf.text_format as txtf
+from splatnet.utils import current_rss, set_data_shard
 
 
 def get_prototxt(solver_proto, save_path=None):
@@ -33,6 +43,7 @@ def standard_solver(train_net,
                     display=1,
                     random_seed=0,
                     debug_info=False,
+                    solver_mode='GPU',
                     create_prototxt=True,
                     save_path=None):
 
@@ -55,10 +66,13 @@ def standard_solver(train_net,
     solver.snapshot_prefix = prefix
     solver.random_seed = random_seed
 
-    solver.solver_mode = caffe_pb2.SolverParameter.GPU
-    if solver_type is 'SGD':
+    if solver_mode == 'CPU':
+        solver.solver_mode = caffe_pb2.SolverParameter.CPU
+    else:
+        solver.solver_mode = caffe_pb2.SolverParameter.GPU
+    if solver_type == 'SGD':
         solver.solver_type = caffe_pb2.SolverParameter.SGD
-    elif solver_type is 'ADAM':
+    elif solver_type == 'ADAM':
         solver.solver_type = caffe_pb2.SolverParameter.ADAM
     solver.momentum = 0.9
     solver.momentum2 = 0.999
@@ -72,3 +86,236 @@ def standard_solver(train_net,
 
     return solver
 
+
+def load_solver_param(path):
+    solver = caffe_pb2.SolverParameter()
+    with open(path) as f:
+        txtf.Merge(f.read(), solver)
+    return solver
+
+
+def learning_rate(solver_param, it):
+    """
+    :return: learning rate at iteration it for the 'fixed' and 'step' policies, otherwise None
+    """
+    if solver_param.lr_policy == 'fixed':
+        return solver_param.base_lr
+    elif solver_param.lr_policy == 'step':
+        return solver_param.base_lr * solver_param.gamma ** (it // solver_param.stepsize)
+    return None
+
+
+def run_solver(solver, solver_path, metrics_path=None, points_per_batch=0, after_step=None):
+    """
+    Train until max_iter. Without metrics_path, this is solver.solve(). Otherwise the solver is stepped one iteration
+    at a time, and a JSON record is appended to metrics_path for each iteration with: scalar outputs of the training
+    network (loss, accuracy), learning rate, wall time split into time spent in data layers (those that keep a
+    forward_time) and the rest, points per second and resident memory. Iterations that start with a test pass
+    (Solver::TestAll(), every test_interval iterations) are marked tested=True: their times include the test nets.
+    :param solver_path: the solver .prototxt used to create solver
+    :param points_per_batch: batch size x sample size
+    :param after_step: if given, called after every iteration (which then also steps one iteration at a time)
+    """
+    if not metrics_path and after_step is None:
+        solver.solve()
+        return
+
+    param = load_solver_param(solver_path)
+    data_layers = [l for l in solver.net.layers if hasattr(l, 'forward_time')]
+    outputs = [name for name in solver.net.outputs if solver.net.blobs[name].data.size == 1]
+    with open(metrics_path if metrics_path else os.devnull, 'a') as f:
+        while solver.iter < param.max_iter:
+            it = solver.iter
+            data_time = -sum(l.forward_time for l in data_layers)
+            tic = time.time()
+            solver.step(1)
+            if after_step is not None:
+                after_step()
+            wall_time = time.time() - tic
+            if not metrics_path:
+                continue
+            data_time += sum(l.forward_time for l in data_layers)
+            tested = bool(param.test_interval) and it % param.test_interval == 0 and \
+                (it > 0 or param.test_initialization)
+            record = dict(iter=it, lr=learning_rate(param, it), wall_time=wall_time, data_time=data_time,
+                          compute_time=wall_time - data_time,
+                          points_per_sec=points_per_batch * param.iter_size / wall_time,
+                          rss_mb=current_rss() / 2 ** 20, tested=tested)
+            record.update({name: float(solver.net.blobs[name].data.flat[0]) for name in outputs})
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+
+    # the end of Solver::Solve(), which step() does not do
+    if param.snapshot_after_train and (param.snapshot == 0 or solver.iter % param.snapshot != 0):
+        solver.snapshot()
+    if param.test_interval and solver.iter % param.test_interval == 0:
+        test_all(solver, param)
+
+
+def _log(msg):
+    # glog format, so that the line is parsed along with caffe's own (see caffe_log.py)
+    sys.stderr.write('{} {} create_solver.py] {}\n'.format(datetime.datetime.now().strftime('I%m%d %H:%M:%S.%f'),
+                                                           os.getpid(), msg))
+    sys.stderr.flush()
+
+
+def test_all(solver, param):
+    """
+    Run all test nets with the current weights and log their mean outputs as Solver::TestAll() does
+    """
+    for i, test_net in enumerate(solver.test_nets):
+        test_net.share_with(solver.net)
+        sums = dict()
+        for _ in range(param.test_iter[i]):
+            test_net.forward()
+            for name in test_net.outputs:
+                sums[name] = sums.get(name, 0) + test_net.blobs[name].data.astype(np.float64).ravel()
+        _log('Iteration {}, Testing net (#{})'.format(solver.iter, i))
+        k = 0
+        for name in test_net.outputs:
+            for v in sums[name]:
+                _log('    Test net output #{}: {} = {:g}'.format(k, name, v / param.test_iter[i]))
+                k += 1
+
+
+def train(solver_path, weights=None, state=None, metrics_path=None, points_per_batch=0, num_workers=1):
+    """
+    Create a solver and train until max_iter, in num_workers data-parallel processes if more than one
+    :param weights: a .caffemodel to start from
+    :param state: a .solverstate to resume from
+    """
+    if num_workers > 1:
+        run_parallel(solver_path, num_workers, weights, state, metrics_path, points_per_batch)
+        return
+
+    import caffe
+    solver = caffe.get_solver(solver_path)
+    if weights:
+        solver.net.copy_from(weights)
+    if state:
+        solver.restore(state)
+
+    run_solver(solver, solver_path, metrics_path, points_per_batch)
+
+
+def average_params(net, shared, rank, barrier):
+    """
+    Replace parameters of net with their average over all processes
+    :param shared: K x (number of parameters) float32 array in shared memory, row rank belongs to this process
+    """
+    blobs = [b for name in net.params for b in net.params[name]]
+    offset = 0
+    for b in blobs:
+        shared[rank, offset:offset + b.data.size] = b.data.flat
+        offset += b.data.size
+    barrier.wait()
+    mean = shared.mean(axis=0)
+    offset = 0
+    for b in blobs:
+        b.data[...] = mean[offset:offset + b.data.size].reshape(b.data.shape)
+        offset += b.data.size
+    barrier.wait()  # no process writes its row again before all of them have read
+
+
+def sync_replicas(solver, shared, rank, barrier, snapshot=0):
+    """
+    After an iteration: average parameters over all processes, then (rank 0) snapshot every snapshot iterations.
+    Snapshots are taken here rather than by Solver::Step, which would save the replica before it is averaged.
+    """
+    average_params(solver.net, shared, rank, barrier)
+    if rank == 0 and snapshot and solver.iter % snapshot == 0:
+        solver.snapshot()
+
+
+def _parallel_worker(rank, num_workers, solver_path, weights, state, metrics_path, points_per_batch,
+                     shared_path, barrier):
+    import caffe
+    caffe.set_mode_cpu()
+    set_data_shard(rank, num_workers)
+    np.random.seed(rank)  # data augmentation differs across workers
+
+    param = load_solver_param(solver_path)
+    snapshot = param.snapshot
+    # snapshots are taken by sync_replicas, on averaged parameters
+    param.snapshot = 0
+    param.snapshot_after_train = False
+    if rank > 0:  # only rank 0 displays, tests and snapshots
+        param.display = 0
+        param.test_interval = 0
+        param.test_initialization = False
+        del param.test_net[:], param.test_iter[:]
+    worker_solver_path = get_prototxt(param)
+    solver = caffe.get_solver(worker_solver_path)
+    os.remove(worker_solver_path)
+    if weights:
+        solver.net.copy_from(weights)
+    if state:
+        solver.restore(state)
+
+    num_params = sum(b.data.size for name in solver.net.params for b in solver.net.params[name])
+    if rank == 0:
+        shared = np.memmap(shared_path, dtype=np.float32, mode='w+', shape=(num_workers, num_params))
+    barrier.wait()
+    if rank > 0:
+        shared = np.memmap(shared_path, dtype=np.float32, mode='r+', shape=(num_workers, num_params))
+
+    def after_step():
+        sync_replicas(solver, shared, rank, barrier, snapshot)
+
+    average_params(solver.net, shared, rank, barrier)  # start from the same parameters
+    if rank == 0:  # the original solver_path, for run_solver to snapshot after training as it says
+        run_solver(solver, solver_path, metrics_path, points_per_batch * num_workers, after_step)
+    else:
+        while solver.iter < param.max_iter:
+            solver.step(1)
+            after_step()
+
+
+def run_parallel(solver_path, num_workers, weights=None, state=None, metrics_path=None, points_per_batch=0,
+                 num_threads=None):
+    """
+    Data-parallel training on cpu. Each of num_workers processes trains a replica of the solver on its shard of the
+    training data (see utils.set_data_shard), and parameters are averaged through shared memory after every
+    iteration, so the effective batch size is num_workers times that of the network. This is the same as averaging
+    gradients for SGD (with momentum and weight decay), and an approximation of it for adaptive solvers (e.g. ADAM).
+    Only rank 0 tests, snapshots (averaged parameters) and writes metrics.
+    :param weights: a .caffemodel to start from
+    :param state: a .solverstate to resume from
+    :param num_threads: BLAS/OpenMP threads per worker, by default cores are split evenly among workers
+    """
+    if not num_threads:
+        num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, shared_path = tempfile.mkstemp(prefix='splatnet_params_', dir=shm_dir)
+    os.close(fd)
+
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(num_workers)
+    workers = [ctx.Process(target=_parallel_worker, name='worker{}'.format(rank),
+                           args=(rank, num_workers, solver_path, weights, state, metrics_path, points_per_batch,
+                                 shared_path, barrier)) for rank in range(num_workers)]
+    thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+    environ = {k: os.environ.get(k) for k in thread_vars}
+    try:
+        os.environ.update({k: str(num_threads) for k in thread_vars})  # read by workers at start up
+        try:
+            for w in workers:
+                w.start()
+        finally:
+            for k, v in environ.items():
+                if v is None:
+                    os.environ.pop(k)
+                else:
+                    os.environ[k] = v
+        running = {w.sentinel: w for w in workers}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                w = running.pop(sentinel)
+                w.join()
+                if w.exitcode != 0:  # the others would wait for it forever
+                    for other in running.values():
+                        other.terminate()
+                    raise RuntimeError('{} failed (exit code {})'.format(w.name, w.exitcode))
+    finally:
+        os.remove(shared_path)
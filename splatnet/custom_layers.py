@@ -5,24 +5,31 @@ Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses
 import numpy as np
 import caffe
 
+# Buffers are (re)allocated in reshape() and reused by forward/backward, which only use in-place operations.
+
 
 class GlobalPooling(caffe.Layer):
     def setup(self, bottom, top):
         pass
 
     def reshape(self, bottom, top):
-        top[0].reshape(*bottom[0].data.shape)
+        n, c, h, w = bottom[0].data.shape
+        top[0].reshape(n, c, h, w)
+        self.max_loc = np.empty((n, c, 1), dtype=np.intp)
+        self.max_val = np.empty((n, c, 1, 1), dtype=bottom[0].data.dtype)
 
     def forward(self, bottom, top):
         n, c, h, w = bottom[0].data.shape
-        self.max_loc = bottom[0].data.reshape(n, c, h*w).argmax(axis=2)
-        top[0].data[...] = bottom[0].data.max(axis=(2, 3), keepdims=True)
+        data = bottom[0].data.reshape(n, c, h * w)
+        np.argmax(data, axis=2, out=self.max_loc[:, :, 0])
+        self.max_val.reshape(n, c, 1)[...] = np.take_along_axis(data, self.max_loc, axis=2)
+        top[0].data[...] = self.max_val
 
     def backward(self, top, propagate_down, bottom):
         n, c, h, w = top[0].diff.shape
-        nn, cc = np.ix_(np.arange(n), np.arange(c))
+        np.sum(top[0].diff, axis=(2, 3), keepdims=True, out=self.max_val)
         bottom[0].diff[...] = 0
-        bottom[0].diff.reshape(n, c, -1)[nn, cc, self.max_loc] = top[0].diff.sum(axis=(2, 3))
+        np.put_along_axis(bottom[0].diff.reshape(n, c, h * w), self.max_loc, self.max_val.reshape(n, c, 1), axis=2)
 
 
 class ProbRenorm(caffe.Layer):
@@ -30,15 +37,21 @@ class ProbRenorm(caffe.Layer):
         pass
 
     def reshape(self, bottom, top):
-        top[0].reshape(*bottom[0].data.shape)
+        n, c, h, w = bottom[0].data.shape
+        top[0].reshape(n, c, h, w)
+        self.clipped = np.empty((n, c, h, w), dtype=bottom[0].data.dtype)
+        self.sc = np.empty((n, 1, h, w), dtype=bottom[0].data.dtype)
 
     def forward(self, bottom, top):
-        clipped = bottom[0].data * bottom[1].data
-        self.sc = 1.0 / (np.sum(clipped, axis=1, keepdims=True) + 1e-10)
-        top[0].data[...] = clipped * self.sc
+        np.multiply(bottom[0].data, bottom[1].data, out=self.clipped)
+        np.sum(self.clipped, axis=1, keepdims=True, out=self.sc)
+        self.sc += 1e-10
+        np.reciprocal(self.sc, out=self.sc)
+        np.multiply(self.clipped, self.sc, out=top[0].data)
 
     def backward(self, top, propagate_down, bottom):
-        bottom[0].diff[...] = top[0].diff * bottom[1].data * self.sc
+        np.multiply(top[0].diff, bottom[1].data, out=bottom[0].diff)
+        bottom[0].diff[...] *= self.sc
 
 
 class Permute(caffe.Layer):
@@ -52,44 +65,93 @@ class Permute(caffe.Layer):
         top[0].reshape(*new_shape)
 
     def forward(self, bottom, top):
-        top[0].data[...] = bottom[0].data.transpose(*self.dims)
+        np.copyto(top[0].data, bottom[0].data.transpose(*self.dims))
 
     def backward(self, top, propagate_down, bottom):
-        bottom[0].diff[...] = top[0].diff.transpose(*self.dims_ind)
+        np.copyto(bottom[0].diff, top[0].diff.transpose(*self.dims_ind))
 
 
 class LossHelper(caffe.Layer):
     def setup(self, bottom, top):
-        self.old_shape = bottom[0].data.shape
+        pass
 
     def reshape(self, bottom, top):
-        new_shape = (self.old_shape[0] * self.old_shape[3], self.old_shape[1], 1, 1)
-        top[0].reshape(*new_shape)
+        n, c, h, s = bottom[0].data.shape
+        assert h == 1
+        top[0].reshape(n * s, c, 1, 1)
 
     def forward(self, bottom, top):
-        top[0].data[...] = bottom[0].data.transpose(0, 3, 1, 2).reshape(*top[0].data.shape)
+        n, c, _, s = bottom[0].data.shape
+        np.copyto(top[0].data.reshape(n, s, c), bottom[0].data.reshape(n, c, s).transpose(0, 2, 1))
 
     def backward(self, top, propagate_down, bottom):
-        bottom[0].diff[...] = top[0].diff.reshape(self.old_shape[0], self.old_shape[3], self.old_shape[1], 1
-                                                  ).transpose(0, 2, 3, 1)
+        n, c, _, s = bottom[0].diff.shape
+        np.copyto(bottom[0].diff.reshape(n, c, s), top[0].diff.reshape(n, s, c).transpose(0, 2, 1))
 
 
 class LogLoss(caffe.Layer):
     def setup(self, bottom, top):
-        self.n, self.c, _, self.s = bottom[0].data.shape
-        self.inds = np.ix_(np.arange(self.n), np.arange(self.c), np.arange(1), np.arange(self.s))
+        pass
+
+    def reshape(self, bottom, top):
+        n, _, h, s = bottom[0].data.shape
+        top[0].reshape(1, 1, 1, 1)
+        self.label = np.empty((n, 1, h, s), dtype=np.intp)
+        self.valid = np.empty((n, 1, h, s), dtype=bottom[0].data.dtype)
+        self.buf = np.empty((n, 1, h, s), dtype=bottom[0].data.dtype)
+
+    def forward(self, bottom, top):
+        np.copyto(self.label, bottom[1].data.reshape(self.label.shape), casting='unsafe')
+        self.valid[...] = np.take_along_axis(bottom[0].data, self.label, axis=1)
+        self.valid += 1e-10
+        top[0].data[...] = -np.mean(np.log(self.valid, out=self.buf))
+
+    def backward(self, top, propagate_down, bottom):
+        bottom[0].diff[...] = 0.0
+        np.reciprocal(self.valid, out=self.buf)
+        self.buf *= -top[0].diff.flat[0] / self.valid.size
+        np.put_along_axis(bottom[0].diff, self.label, self.buf, axis=1)
+
+
+class MaskedSoftmaxLoss(caffe.Layer):
+    """
+    Softmax over the classes allowed by a mask, fused with the log loss (in place of Softmax -> ProbRenorm -> LogLoss)
+    bottoms: scores (N x C x 1 x S), label (N x 1 x 1 x S), class mask (N x C x 1 x 1)
+    tops: loss, masked probabilities (N x C x 1 x S; use loss_weight 0)
+    """
+    def setup(self, bottom, top):
+        pass
 
     def reshape(self, bottom, top):
+        n, c, h, s = bottom[0].data.shape
         top[0].reshape(1, 1, 1, 1)
+        top[1].reshape(n, c, h, s)
+        self.label = np.empty((n, 1, h, s), dtype=np.intp)
+        self.norm = np.empty((n, 1, h, s), dtype=bottom[0].data.dtype)
+        self.picked = np.empty((n, 1, h, s), dtype=bottom[0].data.dtype)
+        self.log_mask = np.empty(bottom[2].data.shape, dtype=bottom[0].data.dtype)
 
     def forward(self, bottom, top):
-        self.valid = bottom[0].data[self.inds[0], bottom[1].data.astype(int), self.inds[2], self.inds[3]]
-        top[0].data[:] = -np.mean(np.log(self.valid + 1e-10))
+        prob = top[1].data
+        with np.errstate(divide='ignore'):
+            np.log(bottom[2].data, out=self.log_mask)  # 0 for allowed classes, -inf otherwise
+        np.add(bottom[0].data, self.log_mask, out=prob)
+        np.max(prob, axis=1, keepdims=True, out=self.norm)
+        prob -= self.norm
+        np.copyto(self.label, bottom[1].data.reshape(self.label.shape), casting='unsafe')
+        self.picked[...] = np.take_along_axis(prob, self.label, axis=1)
+        np.exp(prob, out=prob)
+        np.sum(prob, axis=1, keepdims=True, out=self.norm)
+        prob /= self.norm
+        np.log(self.norm, out=self.norm)
+        self.picked -= self.norm  # log-probabilities of labels
+        top[0].data[...] = -np.mean(self.picked)
 
     def backward(self, top, propagate_down, bottom):
-        bottom[0].diff[:] = 0.0
-        bottom[0].diff[self.inds[0], bottom[1].data.astype(int), self.inds[2], self.inds[3]] = \
-            -1.0 / ((self.valid + 1e-10) * (self.n * self.s))
+        diff = bottom[0].diff
+        np.copyto(diff, top[1].data)
+        np.put_along_axis(diff, self.label, np.take_along_axis(diff, self.label, axis=1) - 1, axis=1)
+        diff *= top[0].diff.flat[0] / self.label.size
 
 
 class PickAndScale(caffe.Layer):
@@ -109,8 +171,7 @@ class PickAndScale(caffe.Layer):
 
     def forward(self, bottom, top):
         for i, (j, s) in enumerate(self.dims):
-            top[0].data[:, i, :, :] = bottom[0].data[:, j, :, :] * s
+            np.multiply(bottom[0].data[:, j, :, :], s, out=top[0].data[:, i, :, :])
 
     def backward(self, top, propagate_down, bottom):
         pass  # TODO NOT_YET_IMPLEMENTED
-
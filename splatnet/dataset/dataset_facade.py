@@ -3,12 +3,16 @@ Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
 import os
+import time
 import numpy as np
 from numpy.linalg import eig
 import caffe
-from splatnet.utils import rotate_3d
+from splatnet.utils import rotate_3d, ColumnStore, ply_header, data_shard
 from splatnet.configs import FACADE_DATA_DIR
 
+# data files have 11 columns: (x, y, z, nx, ny, nz, r, g, b, height, label)
+FACADE_COLUMNS = 'x_y_z_nx_ny_nz_r_g_b_h_l'
+
 
 def ordered_points(subset, dims='x_y_z_nx_ny_nz_r_g_b_h,l', order_dim='z', val_ratio=0.0, root=FACADE_DATA_DIR):
     pcl_train_path = os.path.join(root, 'pcl_train.ply')
@@ -54,27 +58,14 @@ def ordered_points(subset, dims='x_y_z_nx_ny_nz_r_g_b_h,l', order_dim='z', val_r
     return tuple([pcl_data[:, idx] * sc for (idx, sc) in zip(feat_idxs, feat_scales)])
 
 
-def points(subset, dims='x_y_z_nx_ny_nz_r_g_b_h,l', shuffle=False, val_ratio=0.0, root=FACADE_DATA_DIR):
+def points_store(subset, shuffle=False, val_ratio=0.0, root=FACADE_DATA_DIR):
+    """
+    Load a subset once
+    :return: a ColumnStore holding a single sample (the whole point cloud) with columns FACADE_COLUMNS
+    """
     pcl_train_path = os.path.join(root, 'pcl_train.ply')
     pcl_test_path = os.path.join(root, 'pcl_test.ply')
 
-    # data files have 11 columns: (x, y, z, nx, ny, nz, r, g, b, height, label)
-    feat_dict = dict(zip('x_y_z_nx_ny_nz_r_g_b_h_l'.split('_'), range(11)))
-    feat_idxs, feat_scales = [], []
-    for g in dims.split(','):
-        feat_idxs.append([])
-        feat_scales.append([])
-        for f in g.split('_'):
-            if f.find('*') >= 0:
-                feat_idxs[-1].append(feat_dict[f[:f.find('*')]])
-                feat_scales[-1].append(float(f[f.find('*') + 1:]))
-            elif f.find('/') >= 0:
-                feat_idxs[-1].append(feat_dict[f[:f.find('/')]])
-                feat_scales[-1].append(1.0 / float(f[f.find('/') + 1:]))
-            else:
-                feat_idxs[-1].append(feat_dict[f])
-                feat_scales[-1].append(1.0)
-
     order_dim = 2
     if subset == 'train':
         pcl_data = np.loadtxt(pcl_train_path, skiprows=15)
@@ -95,7 +86,44 @@ def points(subset, dims='x_y_z_nx_ny_nz_r_g_b_h,l', shuffle=False, val_ratio=0.0
         order_idx = np.random.permutation(len(pcl_data))
         pcl_data = pcl_data[order_idx]
 
-    return tuple([pcl_data[:, idx] * sc for (idx, sc) in zip(feat_idxs, feat_scales)])
+    return ColumnStore([pcl_data], FACADE_COLUMNS)
+
+
+# names of .ply vertex properties that differ from the feature names used here
+PLY_PROPERTY_NAMES = {'red': 'r', 'green': 'g', 'blue': 'b',
+                      'diffuse_red': 'r', 'diffuse_green': 'g', 'diffuse_blue': 'b',
+                      'height': 'h', 'label': 'l'}
+
+
+def scene_columns(props):
+    return [PLY_PROPERTY_NAMES.get(p, p) for p in props]
+
+
+def load_scene(path):
+    """
+    Load a single scene from an ascii .ply file (e.g. pcl_test.ply), with columns named after its vertex properties
+    :return: a ColumnStore holding the scene as a single sample
+    """
+    _, props, header_size = ply_header(path)
+    return ColumnStore([np.loadtxt(path, skiprows=header_size, ndmin=2)], scene_columns(props))
+
+
+def iter_scene_chunks(path, chunk_size=100000):
+    """
+    Read an ascii .ply scene in chunks of at most chunk_size points, in file order (not necessarily spatially coherent)
+    :return: a generator of N_i x C arrays, with columns scene_columns of the file's vertex properties
+    """
+    num_vertices, _, header_size = ply_header(path)
+    with open(path) as f:
+        for _ in range(header_size):
+            f.readline()
+        for _ in range(0, num_vertices, chunk_size):
+            yield np.loadtxt(f, max_rows=chunk_size, ndmin=2)
+
+
+def points(subset, dims='x_y_z_nx_ny_nz_r_g_b_h,l', shuffle=False, val_ratio=0.0, root=FACADE_DATA_DIR):
+    store = points_store(subset, shuffle=shuffle, val_ratio=val_ratio, root=root)
+    return tuple([store.view(g)[0] for g in dims.split(',')])
 
 
 class InputFacade(caffe.Layer):
@@ -140,6 +168,10 @@ class InputFacade(caffe.Layer):
                                                dims='_'.join(self.raw_dims) + ',l',
                                                val_ratio=params['val_ratio'],
                                                root=params['root'])
+        rank, num_shards = data_shard() if self.phase == caffe.TRAIN else (0, 1)
+        if num_shards > 1:  # a contiguous part of the ordered points
+            begin, end = len(self.data) * rank // num_shards, len(self.data) * (rank + 1) // num_shards
+            self.data, self.label = self.data[begin:end], self.label[begin:end]
         self.data_copy = self.data.copy()
         self.label -= 1  # label starts from 0
         self.top_names = ['data', 'label']
@@ -172,6 +204,7 @@ class InputFacade(caffe.Layer):
             self.jitter_h = None
         self.jitter_rotation = params['jitter_rotation']
 
+        self.forward_time = 0.0
         self._restart()
 
     def reshape(self, bottom, top):
@@ -180,6 +213,7 @@ class InputFacade(caffe.Layer):
             top[top_index].reshape(*shape)
 
     def forward(self, bottom, top):
+        tic = time.time()
         points_per_batch = self.sample_size * self.batch_size
         data, label = self.data[self.idx:self.idx+points_per_batch].reshape(self.batch_size, self.sample_size, -1), \
                       self.label[self.idx:self.idx+points_per_batch]
@@ -218,6 +252,7 @@ class InputFacade(caffe.Layer):
         self.idx += points_per_batch
         if self.idx + points_per_batch > len(self.data):
             self._restart()
+        self.forward_time += time.time() - tic  # read by trainers to separate data loading from compute
 
     def backward(self, top, propagate_down, bottom):
         pass
@@ -3,12 +3,19 @@ Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
 import os
+import time
 import pickle
 import numpy as np
 import caffe
-from splatnet.utils import rotate_3d
+from splatnet.utils import rotate_3d, ColumnStore, data_shard
 from splatnet.configs import SN_CATEGORIES, SN_CATEGORY_NAMES, SN_NUM_PART_CATEGORIES, SHAPENET3D_DATA_DIR
 
+# data files have 6 feature columns, followed by rgb and part label
+SN_COLUMNS = 'x_y_z_nx_ny_nz'
+
+# shapes kept in memory by preload(), inherited by forked processes (see partseg3d/train.py)
+_preloaded = dict()
+
 
 def category_mask(category):
     """
@@ -26,11 +33,14 @@ def category_mask(category):
     return mask
 
 
-def points_single_category(subset, category='airplane',
-                           dims='x_y_z',    # combinations of 'x', 'y', 'z', 'nx', 'ny', 'nz' and 'one'
-                           read_cache=True, write_cache=True, cache_dir='',
-                           shuffle=False,
-                           root=SHAPENET3D_DATA_DIR):
+def load_single_category(subset, category='airplane',
+                         read_cache=True, write_cache=True, cache_dir='',
+                         shuffle=False,
+                         root=SHAPENET3D_DATA_DIR):
+    """
+    Load all shapes of a category once
+    :return: a ColumnStore with columns SN_COLUMNS, object labels, part labels and shape ids
+    """
 
     if not category.startswith('0'):
         category = SN_CATEGORIES[SN_CATEGORY_NAMES.index(category)]
@@ -44,7 +54,10 @@ def points_single_category(subset, category='airplane',
         os.makedirs(cache_dir, exist_ok=True)
         cache_path = os.path.join(cache_dir, '{}_{}.cache'.format(subset, category))
 
-    if read_cache and os.path.exists(cache_path):
+    preload_key = (os.path.abspath(root), subset, category)
+    if read_cache and preload_key in _preloaded:
+        feat_list, label_list, hash_list = (list(v) for v in _preloaded[preload_key])
+    elif read_cache and os.path.exists(cache_path):
         with open(cache_path, mode='rb') as f:
             feat_list, label_list, hash_list = pickle.load(f)
     else:
@@ -62,20 +75,42 @@ def points_single_category(subset, category='airplane',
             with open(cache_path, mode='wb') as f:
                 pickle.dump((feat_list, label_list, hash_list), f)
 
-    # adding 'one' as an additional feature
-    feat_dict = dict(zip('x_y_z_nx_ny_nz_one'.split('_'), range(7)))
-    feat_idxs = [feat_dict[f] for f in dims.split('_')]
-    if 'one' in dims.split('_'):
-        feat_list = [np.concatenate((d, np.ones((len(d), 1))), axis=1) for d in feat_list]
-
-    feat_list = [d[:, feat_idxs] for d in feat_list]
-
     # shuffle
     if shuffle:
         idx = np.random.permutation(len(hash_list))
-        feat_list, label_list, hash_list = feat_list[idx], label_list[idx], hash_list[idx]
+        feat_list, label_list, hash_list = [feat_list[i] for i in idx], [label_list[i] for i in idx], \
+                                           [hash_list[i] for i in idx]
+
+    return ColumnStore(feat_list, SN_COLUMNS), [object_label] * len(feat_list), label_list, hash_list
 
-    return feat_list, [object_label] * len(feat_list), label_list, hash_list
+
+def preload(subsets, categories, root=SHAPENET3D_DATA_DIR):
+    """
+    Keep shapes of some categories in memory, so that later loads (including from data layers in forked
+    processes) do not read them again
+    """
+    for subset in subsets:
+        for category in categories:
+            if not category.startswith('0'):
+                category = SN_CATEGORIES[SN_CATEGORY_NAMES.index(category)]
+            store, _, label_list, hash_list = load_single_category(subset, category=category, root=root)
+            _preloaded[(os.path.abspath(root), subset, category)] = (store.arrays, label_list, hash_list)
+
+
+def points_single_category(subset, category='airplane',
+                           dims='x_y_z',    # combinations of 'x', 'y', 'z', 'nx', 'ny', 'nz' and 'one'
+                           read_cache=True, write_cache=True, cache_dir='',
+                           shuffle=False,
+                           root=SHAPENET3D_DATA_DIR):
+
+    store, object_labels, label_list, hash_list = load_single_category(subset, category=category,
+                                                                       read_cache=read_cache,
+                                                                       write_cache=write_cache,
+                                                                       cache_dir=cache_dir,
+                                                                       shuffle=shuffle,
+                                                                       root=root)
+
+    return store.view(dims), object_labels, label_list, hash_list
 
 
 def points_all_categories(subset,
@@ -99,14 +134,13 @@ def points_all_categories(subset,
 
     if not feats:
         for i, c in enumerate(SN_CATEGORIES):
-            c_feats, c_object_labels, c_part_labels, c_shape_ids = points_single_category(subset,
-                                                                                         category=c,
-                                                                                         dims='x_y_z_nx_ny_nz',
-                                                                                         read_cache=True,
-                                                                                         write_cache=False,
-                                                                                         cache_dir=cache_dir,
-                                                                                         shuffle=False,
-                                                                                         root=root)
+            c_feats, c_object_labels, c_part_labels, c_shape_ids = load_single_category(subset,
+                                                                                       category=c,
+                                                                                       read_cache=True,
+                                                                                       write_cache=False,
+                                                                                       cache_dir=cache_dir,
+                                                                                       shuffle=False,
+                                                                                       root=root)
             c_part_labels = [v + sum(SN_NUM_PART_CATEGORIES[:i]) for v in c_part_labels]
             feats.extend(c_feats)
             object_labels.extend(c_object_labels)
@@ -117,19 +151,13 @@ def points_all_categories(subset,
             with open(cache_path, mode='wb') as f:
                 pickle.dump((feats, object_labels, part_labels, shape_ids), f)
 
-    # adding 'one' as an additional feature
-    feat_dict = dict(zip('x_y_z_nx_ny_nz_one'.split('_'), range(7)))
-    feat_idxs = [feat_dict[f] for f in dims.split('_')]
-    if 'one' in dims.split('_'):
-        feats = [np.concatenate((d, np.ones((len(d), 1))), axis=1) for d in feats]
-    feats = [d[:, feat_idxs] for d in feats]
-
     # shuffle
     if shuffle:
         idx = np.random.permutation(len(shape_ids))
-        feats, object_labels, part_labels, shape_ids = feats[idx], object_labels[idx], part_labels[idx], shape_ids[idx]
+        feats, object_labels, part_labels, shape_ids = [feats[i] for i in idx], [object_labels[i] for i in idx], \
+                                                       [part_labels[i] for i in idx], [shape_ids[i] for i in idx]
 
-    return feats, object_labels, part_labels, shape_ids
+    return ColumnStore(feats, SN_COLUMNS).view(dims), object_labels, part_labels, shape_ids
 
 
 class InputShapenet(caffe.Layer):
@@ -213,6 +241,9 @@ class InputShapenet(caffe.Layer):
 
         data, _, label, _ = points_single_category(params['subset'], params['category'],
                                                    dims='_'.join(self.raw_dims), root=params['root'])
+        rank, num_shards = data_shard() if self.phase == caffe.TRAIN else (0, 1)
+        if num_shards > 1:
+            data, label = data[rank::num_shards], label[rank::num_shards]
         self.data_copy = data
         self.label_copy = label
         self.top_names = ['data', 'label']
@@ -222,6 +253,7 @@ class InputShapenet(caffe.Layer):
             raise Exception('Incorrect number of outputs (expected %d, got %d)' %
                             (len(self.top_names), len(top)))
 
+        self.forward_time = 0.0
         self._restart()
 
     def reshape(self, bottom, top):
@@ -230,12 +262,14 @@ class InputShapenet(caffe.Layer):
             top[top_index].reshape(*shape)
 
     def forward(self, bottom, top):
+        tic = time.time()
         top[0].data[...] = self.data[self.index:self.index+self.batch_size]
         top[1].data[...] = self.label[self.index:self.index+self.batch_size]
 
         self.index += self.batch_size
         if self.index + self.batch_size > len(self.data):
             self._restart()
+        self.forward_time += time.time() - tic  # read by trainers to separate data loading from compute
 
     def backward(self, top, propagate_down, bottom):
         pass
@@ -299,7 +333,6 @@ class InputShapenetAllCategories(caffe.Layer):
 
         # reshape and reset index
         self.data = data[:, self.feat_dims].reshape(num_samples, self.sample_size, -1, 1).transpose(0, 2, 3, 1)
-        import pdb;pdb.set_trace()
         self.label = label.reshape(num_samples, self.sample_size, -1, 1).transpose(0, 2, 3, 1)
         self.label_mask = label_mask
         self.index = 0
@@ -328,6 +361,9 @@ class InputShapenetAllCategories(caffe.Layer):
 
         data, category, label, _ = points_all_categories(params['subset'],
                                                          dims='_'.join(self.raw_dims), root=params['root'])
+        rank, num_shards = data_shard() if self.phase == caffe.TRAIN else (0, 1)
+        if num_shards > 1:
+            data, category, label = data[rank::num_shards], category[rank::num_shards], label[rank::num_shards]
         self.data_copy = data
         self.label_copy = label
         self.label_mask_copy = [category_mask(c) for c in category]
@@ -341,6 +377,7 @@ class InputShapenetAllCategories(caffe.Layer):
             raise Exception('Incorrect number of outputs (expected %d, got %d)' %
                             (len(self.top_names), len(top)))
 
+        self.forward_time = 0.0
         self._restart()
 
     def reshape(self, bottom, top):
@@ -350,6 +387,7 @@ class InputShapenetAllCategories(caffe.Layer):
             top[2].reshape(self.batch_size, self.top_channels[2], 1, 1)
 
     def forward(self, bottom, top):
+        tic = time.time()
         top[0].data[...] = self.data[self.index:self.index+self.batch_size]
         top[1].data[...] = self.label[self.index:self.index+self.batch_size]
         if self.output_mask:
@@ -358,6 +396,7 @@ class InputShapenetAllCategories(caffe.Layer):
         self.index += self.batch_size
         if self.index + self.batch_size > len(self.data):
             self._restart()
+        self.forward_time += time.time() - tic  # read by trainers to separate data loading from compute
 
     def backward(self, top, propagate_down, bottom):
         pass
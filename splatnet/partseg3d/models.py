@@ -464,9 +464,8 @@ def partseg_seq_combined_categories(arch_str='64_128_256_256', batchnorm=True,
         if deploy:
             n.prob = L.Softmax(top_prev)
         else:
-            n.prob_raw = L.Softmax(top_prev)
-            n.prob = L.Python(n.prob_raw, n.label_mask, python_param=dict(module='custom_layers', layer='ProbRenorm'))
-            n.loss = L.Python(n.prob, n.label, python_param=dict(module='custom_layers', layer='LogLoss'), loss_weight=1)
+            n.loss, n.prob = L.Python(top_prev, n.label, n.label_mask, ntop=2, loss_weight=[1, 0],
+                                      python_param=dict(module='custom_layers', layer='MaskedSoftmaxLoss'))
             n.accuracy = L.Accuracy(n.prob, n.label)
     else:
         if deploy:
@@ -10,71 +10,108 @@ import numpy as np
 import caffe
 
 import splatnet.configs
-from splatnet import plot_log
-from splatnet.utils import modify_blob_shape, seg_scores
+from splatnet import caffe_log
+from splatnet.utils import modify_blob_shape, seg_scores, save_label_ply, pad_indices, scatter_mean, unique_rows, \
+    ProbReducer
+from splatnet.pred_archive import PredictionWriter
 
 
-def extract_feat_shapes(network_path, weights_path, feed, out_names, batch_size=64, sample_size=3000):
+def extract_feat_shapes(network_path, weights_path, feed, out_names, batch_size=64, sample_size=3000,
+                        dedup=False, reducer=None):
+    """
+    Run a network over a list of shapes
+    :param feed: a dict of input name -> list of per-shape N_i x C arrays
+    :param out_names: names of output blobs
+    :param batch_size:
+    :param sample_size: -1 -- one shape per forward at its own size, otherwise shapes are padded to this size
+                        (and it is increased if some shape has more points)
+    :param dedup: if True, each distinct point of a shape is fed to the network only once, and unless sample_size is
+                  -1, shapes are padded to the largest number of distinct points in a shape instead of sample_size
+                  (padding back up to sample_size would cost as much as not deduplicating)
+    :param reducer: optionally, a function (e.g. a ProbReducer) applied to each N_i x C' output right after the
+                    forward, returning a dict of per-point arrays; only its results are kept
+    :return: a dict of output name -> list of per-shape N_i x C' arrays (or reducer results)
+    """
     if sample_size == -1:
         assert batch_size == 1
 
-    ori_sample_sizes = [len(sample) for sample in list(feed.values())[0]]
+    in_keys = list(feed.keys())
+    ori_sample_sizes = [len(sample) for sample in feed[in_keys[0]]]
     nsamples = len(ori_sample_sizes)
 
+    # map every shape to its distinct points
+    if dedup:
+        inverses = []
+        feed_unique = {in_key: [] for in_key in in_keys}
+        for i in range(nsamples):
+            samples = [feed[in_key][i] for in_key in in_keys]
+            _, first_idx, inverse = unique_rows(np.concatenate(samples, axis=1))
+            inverses.append(inverse)
+            for in_key, sample in zip(in_keys, samples):
+                feed_unique[in_key].append(sample[first_idx])
+        feed = feed_unique
+    else:
+        inverses = [None] * nsamples
+        feed = {in_key: [feed[in_key][i] for i in range(nsamples)] for in_key in in_keys}
+    sample_sizes = [len(sample) for sample in feed[in_keys[0]]]
+
+    if sample_size != -1 and (dedup or max(sample_sizes) > sample_size):
+        sample_size = max(sample_sizes)
+
     batch_size = nsamples if nsamples < batch_size else batch_size
 
     net = caffe.Net(network_path, weights_path, caffe.TEST)
-    net_bs, _, _, net_ss = net.blobs[list(feed.keys())[0]].data.shape
+    net_bs, _, _, net_ss = net.blobs[in_keys[0]].data.shape
 
     if sample_size != -1 and (net_bs != batch_size or net_ss != sample_size):
-        network_path = modify_blob_shape(network_path, feed.keys(), {0: batch_size, 3: sample_size})
+        network_path = modify_blob_shape(network_path, in_keys, {0: batch_size, 3: sample_size})
         net = caffe.Net(network_path, weights_path, caffe.TEST)
 
     # pad samples to fixed length
     if sample_size != -1:
-        for i in range(nsamples):
-            k = ori_sample_sizes[i]
-            idx = np.concatenate((np.tile(np.arange(k), (sample_size // k, )),
-                                  np.random.permutation(k)[:(sample_size % k)]), axis=0)
-            feed = feed.copy()
-            for in_key in feed:
-                feed[in_key][i] = feed[in_key][i][idx]
-
-    outs = {v: [] for v in out_names}
+        pad_idxs = [pad_indices(k, sample_size) for k in sample_sizes]
+        feed = {in_key: [feed[in_key][i][idx] for i, idx in enumerate(pad_idxs)] for in_key in in_keys}
+    else:
+        pad_idxs = [None] * nsamples
+
+    outs = {v: [None] * nsamples for v in out_names}
     for b in range(int(np.ceil(nsamples / batch_size))):
         b_end = min(batch_size * (b + 1), nsamples)
         b_slice = slice(b_end - batch_size, b_end)
         bs = min(batch_size, nsamples - batch_size * b)
 
         if sample_size == -1:
-            ss = list(feed.values())[0][b_end - 1].shape[0]
+            ss = feed[in_keys[0]][b_end - 1].shape[0]
             if net_ss != ss or net_bs != 1:
-                network_path = modify_blob_shape(network_path, feed.keys(), {0: 1, 3: ss})
+                network_path = modify_blob_shape(network_path, in_keys, {0: 1, 3: ss})
                 net = caffe.Net(network_path, weights_path, caffe.TEST)
                 net_ss, net_bs = ss, 1
         else:
             ss = sample_size
 
-        for in_key in feed:
+        for in_key in in_keys:
             net.blobs[in_key].data[...] \
                 = np.concatenate(feed[in_key][b_slice], axis=0).reshape(batch_size, ss, -1, 1).transpose(0, 2, 3, 1)
         net.forward()
         for out_key in out_names:
-            out = net.blobs[out_key].data.transpose(0, 3, 1, 2)[-bs:].reshape(bs * ss, -1)
-            outs[out_key].append(out.copy())
-
-    if sample_size != -1:
-        outs = {v: np.array_split(np.concatenate(outs[v], axis=0), nsamples) for v in out_names}
-        # remove padding
-        for v in out_names:
-            outs[v] = [sample[:k] for (sample, k) in zip(outs[v], ori_sample_sizes)]
+            out = net.blobs[out_key].data.transpose(0, 3, 1, 2).reshape(batch_size, ss, -1)
+            for j, i in enumerate(range(b_end - bs, b_end), start=batch_size - bs):
+                # average outputs of padded copies, then expand back to original points
+                sample_out = out[j] if pad_idxs[i] is None else scatter_mean(out[j], pad_idxs[i], sample_sizes[i])
+                if reducer is not None:
+                    sample_out = reducer(sample_out)
+                    if inverses[i] is not None:
+                        sample_out = {k: v[inverses[i]] for k, v in sample_out.items()}
+                    outs[out_key][i] = sample_out
+                else:
+                    outs[out_key][i] = sample_out.copy() if inverses[i] is None else sample_out[inverses[i]]
 
     return outs
 
 
 def partseg_test(dataset, network, weights, input_dims='x_y_z', sample_size=3000, batch_size=64,
                  category='airplane', dataset_params=None,
-                 save_dir='', skip_ply=False, use_cpu=False):
+                 save_dir='', skip_ply=False, use_cpu=False, pred_writer=None, dedup=False):
     """
     Testing trained segmentation network
     :param dataset: choices: 'shapenet'
@@ -87,6 +124,8 @@ def partseg_test(dataset, network, weights, input_dims='x_y_z', sample_size=3000
     :param save_dir: default ''
     :param skip_ply: default False
     :param use_cpu: default False
+    :param pred_writer: if present, a PredictionWriter that collects predictions instead of .ply files
+    :param dedup: if True, evaluate each distinct point only once
     :return:
     """
 
@@ -103,8 +142,8 @@ def partseg_test(dataset, network, weights, input_dims='x_y_z', sample_size=3000
         dataset_params = dict(subset='test')  # default values
         dataset_params.update(dataset_params_new)
 
-        data, _, part_label, names = shapenet.points_single_category(dims=input_dims, category=category, **dataset_params)
-        xyz_norm_list, _, _, _ = shapenet.points_single_category(dims='x_y_z_nx_ny_nz', category=category, **dataset_params)
+        store, _, part_label, names = shapenet.load_single_category(category=category, **dataset_params)
+        data, xyz_norm_list = store.view(input_dims), store.view('x_y_z_nx_ny_nz')
         cmap = splatnet.configs.SN_CMAP
         if category.startswith('0'):
             category_id = splatnet.configs.SN_CATEGORIES.index(category)
@@ -115,40 +154,29 @@ def partseg_test(dataset, network, weights, input_dims='x_y_z', sample_size=3000
     else:
         raise ValueError('Unsupported dataset: {}'.format(dataset))
 
+    # labels (and float16 probs, if archived) are extracted per batch, restricted to parts of this category
+    reducer = ProbReducer(class_range=(category_offset, num_part_categories),
+                          keep_prob=pred_writer is not None and pred_writer.save_prob)
+
     tic = time.time()
-    probs = extract_feat_shapes(network, weights,
-                                feed=dict(data=data),
-                                out_names=('prob',),
-                                sample_size=sample_size, batch_size=batch_size)['prob']
+    outs = extract_feat_shapes(network, weights,
+                               feed=dict(data=data),
+                               out_names=('prob',),
+                               sample_size=sample_size, batch_size=batch_size, dedup=dedup, reducer=reducer)['prob']
     elapsed = time.time() - tic
 
-    if probs[0].shape[1] > num_part_categories:
-        preds = [np.argmax(prob[:, category_offset:category_offset+num_part_categories], axis=1) for prob in probs]
-    else:
-        preds = [np.argmax(prob, axis=1) for prob in probs]
+    preds = [out['label'] for out in outs]
 
     acc, avgacc, avgiou = seg_scores(preds, part_label, nclasses=num_part_categories)
 
-    if not skip_ply:
+    if pred_writer is not None:
+        for out, name in zip(outs, names):
+            pred_writer.add(name, out['label'], prob=out.get('prob'), category=category)
+    elif not skip_ply:
         os.makedirs(save_dir, exist_ok=True)
         for xyz_norm, pred, name in zip(xyz_norm_list, preds, names):
-            out = np.array([np.concatenate((x, cmap[int(c)]), axis=0) for (x, c) in zip(xyz_norm, pred)])
-            header = '''ply
-format ascii 1.0
-element vertex {}
-property float x
-property float y
-property float z
-property float nx
-property float ny
-property float nz
-property uchar diffuse_red
-property uchar diffuse_green
-property uchar diffuse_blue
-end_header'''.format(len(pred))
-            fmt = '%.6f %.6f %.6f %.6f %.6f %.6f %d %d %d'
-            save_path = os.path.join(save_dir, '{}.ply'.format(name))
-            np.savetxt(save_path, out, fmt=fmt, header=header, comments='')
+            save_label_ply(os.path.join(save_dir, '{}.ply'.format(name)), xyz_norm[:, :3], pred, cmap,
+                           norms=xyz_norm[:, 3:])
 
     return acc, avgacc, avgiou, elapsed
 
@@ -163,8 +191,14 @@ if __name__ == '__main__':
     parser.add_argument('--input', default='x_y_z', help='features to use as input')
     parser.add_argument('--cpu', action='store_true', help='use cpu')
     parser.add_argument('--skip_ply', action='store_true', help='if True, do not output .ply prediction results')
+    parser.add_argument('--save_archive', default=None, type=str,
+                        help='if present, write all predictions to this single .npz archive instead of .ply files')
+    parser.add_argument('--save_prob', action='store_true', help='if True, also store float16 probs in the archive')
     parser.add_argument('--sample_size', default=3000, type=int, help='testing sample size')
     parser.add_argument('--batch_size', default=64, type=int, help='testing sample size')
+    parser.add_argument('--dedup', action='store_true',
+                        help='if True, feed each distinct point only once, padding shapes up to the largest number of '
+                             'distinct points in a shape instead of to sample_size')
     parser.add_argument('--snapshot', default=None, type=str, help='snapshot rule - last|best_acc|best_loss|ITER')
     parser.add_argument('--exp_dir', default=None, type=str, help='if present, assigns values to options below')
     parser.add_argument('--network', default=None, type=str, help='a .prototxt file')
@@ -192,6 +226,7 @@ if __name__ == '__main__':
 
     tic = time.time()
     ious = []
+    pred_writer = PredictionWriter(args.save_archive, save_prob=args.save_prob) if args.save_archive else None
 
     for category_cnt, category in enumerate(args.categories):
         if category_cnt == 0 or not args.single_model:
@@ -218,11 +253,11 @@ if __name__ == '__main__':
                     if args.snapshot == 'last':
                         snap_iter = max(iters_avail)
                     elif args.snapshot == 'best_acc':
-                        _, stats_val = plot_log.parse_and_plot(log, skip_train=0, skip_test=0)
+                        _, stats_val = caffe_log.load(log).test_stats()
                         iter_acc = dict(zip(stats_val[:, 0], stats_val[:, -2]))
                         snap_iter = iters_avail[np.argmax([iter_acc[v] for v in iters_avail])]
                     elif args.snapshot == 'best_loss':
-                        _, stats_val = plot_log.parse_and_plot(log, skip_train=0, skip_test=0)
+                        _, stats_val = caffe_log.load(log).test_stats()
                         iter_loss = dict(zip(stats_val[:, 0], stats_val[:, -1]))
                         snap_iter = iters_avail[np.argmin([iter_loss[v] for v in iters_avail])]
                     elif args.snapshot.isdigit():
@@ -233,14 +268,21 @@ if __name__ == '__main__':
 
         acc, avgacc, avgiou, _ = partseg_test(args.dataset, network, weights, args.input,
                                               args.sample_size, args.batch_size, category, dataset_params,
-                                              os.path.join(save_dir, category), args.skip_ply, args.cpu)
+                                              os.path.join(save_dir, category), args.skip_ply, args.cpu,
+                                              pred_writer, args.dedup)
         ious.append((np.mean(avgiou), len(avgiou)))
 
+        if pred_writer is not None:
+            pred_location = args.save_archive
+        else:
+            pred_location = '-' if args.skip_ply else os.path.join(save_dir, category)
         with open(log_eval, 'a') as f:
             f.write('{} {} {} {} {} {} {}\n'.format(category, len(avgiou),
                                                     np.mean(acc), np.mean(avgacc), np.mean(avgiou),
-                                                    os.path.basename(weights),
-                                                    '-' if args.skip_ply else os.path.join(save_dir, category)))
+                                                    os.path.basename(weights), pred_location))
+
+    if pred_writer is not None:
+        pred_writer.close()
 
     elapsed = time.time() - tic
 
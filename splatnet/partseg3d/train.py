@@ -3,20 +3,24 @@ Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
 import os
+import sys
+import time
 import argparse
+import multiprocessing
+import multiprocessing.connection
 import caffe
 from splatnet.partseg3d import models
 from splatnet import create_solver
 import splatnet.configs
 
 
-def partseg_train(network, exp_dir, category, args):
+def partseg_train(network, exp_dir, category, args, device=0):
 
     if args.cpu:
         caffe.set_mode_cpu()
     else:
         caffe.set_mode_gpu()
-        caffe.set_device(0)
+        caffe.set_device(device)
 
     if network == 'seq':
         batch_norm = True
@@ -51,37 +55,89 @@ def partseg_train(network, exp_dir, category, args):
 
     random_seed = 0
     debug_info = False
-    solver = create_solver.standard_solver(network,
-                                           network,
-                                           os.path.join(exp_dir, category),
-                                           base_lr=args.base_lr,
-                                           gamma=args.lr_decay,
-                                           stepsize=args.stepsize,
-                                           test_iter=args.test_iter,
-                                           test_interval=args.test_interval,
-                                           max_iter=args.num_iter,
-                                           snapshot=args.snapshot_interval,
-                                           solver_type=args.solver_type,
-                                           weight_decay=args.weight_decay,
-                                           iter_size=args.iter_size,
-                                           debug_info=debug_info,
-                                           random_seed=random_seed,
-                                           save_path=os.path.join(exp_dir, category+'_solver.prototxt'))
-    solver = caffe.get_solver(solver)
+    solver_path = create_solver.standard_solver(network,
+                                                network,
+                                                os.path.join(exp_dir, category),
+                                                base_lr=args.base_lr,
+                                                gamma=args.lr_decay,
+                                                stepsize=args.stepsize,
+                                                test_iter=args.test_iter,
+                                                test_interval=args.test_interval,
+                                                max_iter=args.num_iter,
+                                                snapshot=args.snapshot_interval,
+                                                solver_type=args.solver_type,
+                                                weight_decay=args.weight_decay,
+                                                iter_size=args.iter_size,
+                                                debug_info=debug_info,
+                                                random_seed=random_seed,
+                                                solver_mode='CPU' if args.cpu else 'GPU',
+                                                save_path=os.path.join(exp_dir, category+'_solver.prototxt'))
 
+    weights, state = None, None
     if args.init_model:
         if args.init_model.endswith('.caffemodel'):
-            solver.net.copy_from(args.init_model)
+            weights = args.init_model
         else:
-            solver.net.copy_from(os.path.join(exp_dir, '{}_iter_{}.caffemodel'.format(category, args.init_model)))
+            weights = os.path.join(exp_dir, '{}_iter_{}.caffemodel'.format(category, args.init_model))
 
     if args.init_state:
         if args.init_state.endswith('.solverstate'):
-            solver.restore(args.init_state)
+            state = args.init_state
         else:
-            solver.restore(os.path.join(exp_dir, '{}_iter_{}.solverstate'.format(category, args.init_state)))
+            state = os.path.join(exp_dir, '{}_iter_{}.solverstate'.format(category, args.init_state))
+
+    create_solver.train(solver_path, weights, state,
+                        os.path.join(exp_dir, category + '_metrics.jsonl') if args.metrics else None,
+                        args.batch_size * args.sample_size, args.workers)
+
+
+def _train_job(network, exp_dir, category, args, device):
+    # redirect at the file descriptor level, so that caffe's own logging goes to the same file
+    sys.stdout.flush(), sys.stderr.flush()
+    fd = os.open(os.path.join(exp_dir, category + '.log'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(fd, 1), os.dup2(fd, 2)
+    os.close(fd)
+    partseg_train(network, exp_dir, category, args, device=device)
+
 
-    solver.solve()
+def partseg_train_jobs(network, exp_dir, categories, args, num_jobs, devices=(0,)):
+    """
+    Train per-category models concurrently, each in a forked process logging to <exp_dir>/<category>.log.
+    Shapes are loaded once here and shared with the jobs; a new job is started whenever one finishes.
+    :param num_jobs: number of concurrent jobs
+    :param devices: gpu devices, assigned to job slots round-robin
+    :return: list of categories whose training failed
+    """
+    import dataset_shapenet  # the module used by the data layers (splatnet/dataset is in sys.path)
+    dataset_params = dict(subset_train='train', subset_test='val', root=dataset_shapenet.SHAPENET3D_DATA_DIR)
+    dataset_params.update(args.dataset_params)
+    tic = time.time()
+    dataset_shapenet.preload((dataset_params['subset_train'], dataset_params['subset_test']), categories,
+                             root=dataset_params['root'])
+    print('Loaded {} categories in {:.2f} secs'.format(len(categories), time.time() - tic), flush=True)
+
+    ctx = multiprocessing.get_context('fork')
+    pending = list(categories)
+    free_devices = [devices[i % len(devices)] for i in range(min(num_jobs, len(pending)))]
+    running, failed = dict(), []
+    while pending or running:
+        while pending and free_devices:
+            category, device = pending.pop(0), free_devices.pop(0)
+            job = ctx.Process(target=_train_job, args=(network, exp_dir, category, args, device), name=category)
+            job.start()
+            running[job.sentinel] = (job, category, device, time.time())
+            print('{}: started (device {})'.format(category, device), flush=True)
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            job, category, device, start = running.pop(sentinel)
+            job.join()
+            free_devices.append(device)
+            if job.exitcode != 0:
+                failed.append(category)
+            print('{}: {} in {:.2f} secs'.format(category, 'done' if job.exitcode == 0 else
+                                                 'failed (exit code {})'.format(job.exitcode),
+                                                 time.time() - start), flush=True)
+
+    return failed
 
 
 def partseg_train_single_model(network, exp_dir, args):
@@ -125,37 +181,39 @@ def partseg_train_single_model(network, exp_dir, args):
 
     random_seed = 0
     debug_info = False
-    solver = create_solver.standard_solver(network,
-                                           network,
-                                           os.path.join(exp_dir, 'snapshot'),
-                                           base_lr=args.base_lr,
-                                           gamma=args.lr_decay,
-                                           stepsize=args.stepsize,
-                                           test_iter=args.test_iter,
-                                           test_interval=args.test_interval,
-                                           max_iter=args.num_iter,
-                                           snapshot=args.snapshot_interval,
-                                           solver_type=args.solver_type,
-                                           weight_decay=args.weight_decay,
-                                           iter_size=args.iter_size,
-                                           debug_info=debug_info,
-                                           random_seed=random_seed,
-                                           save_path=os.path.join(exp_dir, 'solver.prototxt'))
-    solver = caffe.get_solver(solver)
+    solver_path = create_solver.standard_solver(network,
+                                                network,
+                                                os.path.join(exp_dir, 'snapshot'),
+                                                base_lr=args.base_lr,
+                                                gamma=args.lr_decay,
+                                                stepsize=args.stepsize,
+                                                test_iter=args.test_iter,
+                                                test_interval=args.test_interval,
+                                                max_iter=args.num_iter,
+                                                snapshot=args.snapshot_interval,
+                                                solver_type=args.solver_type,
+                                                weight_decay=args.weight_decay,
+                                                iter_size=args.iter_size,
+                                                debug_info=debug_info,
+                                                random_seed=random_seed,
+                                                solver_mode='CPU' if args.cpu else 'GPU',
+                                                save_path=os.path.join(exp_dir, 'solver.prototxt'))
 
+    weights, state = None, None
     if args.init_model:
         if args.init_model.endswith('.caffemodel'):
-            solver.net.copy_from(args.init_model)
+            weights = args.init_model
         else:
-            solver.net.copy_from(os.path.join(exp_dir, 'snapshot_iter_{}.caffemodel'.format(args.init_model)))
+            weights = os.path.join(exp_dir, 'snapshot_iter_{}.caffemodel'.format(args.init_model))
 
     if args.init_state:
         if args.init_state.endswith('.solverstate'):
-            solver.restore(args.init_state)
+            state = args.init_state
         else:
-            solver.restore(os.path.join(exp_dir, 'snapshot_iter_{}.solverstate'.format(args.init_state)))
+            state = os.path.join(exp_dir, 'snapshot_iter_{}.solverstate'.format(args.init_state))
 
-    solver.solve()
+    create_solver.train(solver_path, weights, state, os.path.join(exp_dir, 'metrics.jsonl') if args.metrics else None,
+                        args.batch_size * args.sample_size, args.workers)
 
 
 if __name__ == '__main__':
@@ -193,9 +251,19 @@ if __name__ == '__main__':
     parser.add_argument('--cpu', action='store_true', help='use cpu')
     parser.add_argument('--init_model', default=None, type=str, help='a .caffemodel file, or a snapshot iter')
     parser.add_argument('--init_state', default=None, type=str, help='a .solverstate file, or a snapshot iter')
+    parser.add_argument('--metrics', action='store_true', help='if True, log per-iteration metrics to a .jsonl file')
+    parser.add_argument('--jobs', default=1, type=int,
+                        help='number of categories to train concurrently, each logging to <exp_dir>/<category>.log '
+                             '(with --cpu, limit BLAS threads per job, e.g. OMP_NUM_THREADS, accordingly)')
+    parser.add_argument('--devices', default=[0], nargs='+', type=int, help='gpu devices, shared by jobs')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='number of data-parallel worker processes (with --cpu), each training on batch_size samples')
 
     args = parser.parse_args()
 
+    if args.workers > 1 and not args.cpu:
+        parser.error('--workers requires --cpu')
+
     if not args.dataset_params:
         args.dataset_params = {}
     else:
@@ -218,6 +286,11 @@ if __name__ == '__main__':
             categories = args.categories
         del args.categories
 
-        for category in categories:
-            partseg_train(args.network, args.exp_dir, category, args)
+        if args.jobs > 1:
+            failed = partseg_train_jobs(args.network, args.exp_dir, categories, args, args.jobs, args.devices)
+            if failed:
+                sys.exit('Training failed for: {}'.format(' '.join(failed)))
+        else:
+            for category in categories:
+                partseg_train(args.network, args.exp_dir, category, args, device=args.devices[0])
 
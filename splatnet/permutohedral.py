@@ -0,0 +1,275 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+
+A NumPy implementation of the permutohedral lattice (Adams et al., Fast High-Dimensional Filtering Using the
+Permutohedral Lattice, 2010), with learned filters over lattice neighborhoods as in bilateralNN.
+Points are embedded in the lattice, splatted to the vertices of their enclosing simplices, filtered on the lattice
+and sliced back. The hash table is a sorted array of integer-coded vertex keys, looked up with searchsorted.
+"""
+import itertools
+import numpy as np
+from splatnet.utils import parse_channel_scale
+
+
+def elevate(positions):
+    """
+    Embed d-dimensional positions in the hyperplane of the (d+1)-dimensional lattice (y = E p), scaled so that
+    a Gaussian blur on the lattice approximates a Gaussian with unit standard deviation in position space
+    :param positions: N x d ndarray
+    :return: N x (d+1) ndarray
+    """
+    n, d = positions.shape
+    scale_factor = (d + 1) * np.sqrt(2.0 / 3) / np.sqrt(np.arange(1, d + 1) * np.arange(2, d + 2))
+    cf = positions * scale_factor
+    elevated = np.zeros((n, d + 1))
+    elevated[:, :d] = np.cumsum(cf[:, ::-1], axis=1)[:, ::-1]  # suffix sums
+    elevated[:, 1:] -= np.arange(1, d + 1) * cf
+    return elevated
+
+
+def enclosing_simplices(elevated):
+    """
+    Find the enclosing simplex of every elevated point
+    :param elevated: N x (d+1) ndarray
+    :return: N x (d+1) x d integer keys of simplex vertices (last coordinate is implied, as keys sum to 0),
+             N x (d+1) barycentric weights
+    """
+    n, d1 = elevated.shape
+    rows = np.arange(n)[:, np.newaxis]
+
+    # closest remainder-0 point
+    v = elevated / d1
+    up, down = np.ceil(v) * d1, np.floor(v) * d1
+    greedy = np.where(up - elevated < elevated - down, up, down)
+    s = np.rint(greedy.sum(axis=1) / d1).astype(np.int64)[:, np.newaxis]
+
+    # rank differential to find the permutation between this simplex and the canonical one
+    rank = np.empty((n, d1), dtype=np.int64)
+    rank[rows, np.argsort(greedy - elevated, axis=1, kind='stable')] = np.arange(d1)
+
+    # if the point doesn't lie on the plane (sum != 0), bring it back
+    shift = ((s < 0) & (rank < -s)).astype(np.int64) - ((s > 0) & (rank >= d1 - s)).astype(np.int64)
+    greedy += d1 * shift
+    rank += s + d1 * shift
+
+    # barycentric coordinates
+    diff = (elevated - greedy) / d1
+    bary = np.zeros((n, d1 + 1))
+    bary[rows, d1 - 1 - rank] += diff
+    bary[rows, d1 - rank] -= diff
+    bary[:, 0] += 1.0 + bary[:, d1]
+
+    # vertices: remainder-r vertex is greedy + canonical[r][rank]
+    r = np.arange(d1).reshape(1, d1, 1)
+    keys = greedy.astype(np.int64)[:, np.newaxis, :] + np.where(rank[:, np.newaxis, :] <= d1 - 1 - r, r, r - d1)
+    return keys[:, :, :-1], bary[:, :d1]
+
+
+def filter_offsets(d, neighborhood_size=1):
+    """
+    Lattice offsets covered by a filter: sum_k a_k ((d+1) e_k - 1) for a_k in [0, n] with min(a) = 0
+    :return: T x d integer offsets, T = (n+1)^(d+1) - n^(d+1), the center first
+    """
+    a = np.array([v for v in itertools.product(range(neighborhood_size + 1), repeat=d + 1) if min(v) == 0])
+    offsets = a * (d + 1) - a.sum(axis=1, keepdims=True)
+    return offsets[:, :d].astype(np.int64)
+
+
+def num_filter_taps(d, neighborhood_size=1):
+    return (neighborhood_size + 1) ** (d + 1) - neighborhood_size ** (d + 1)
+
+
+def filter_cost(num_points, num_vertices, d, channels_in, channels_out, neighborhood_size=1, itemsize=4):
+    """
+    Rough cost of one learned filter on a lattice (splat, blur, slice)
+    :return: FLOPs (a multiply-add counts as 2), bytes of lattice values, neighbor table and simplex weights
+    """
+    taps = num_filter_taps(d, neighborhood_size)
+    flops = 2 * num_points * (d + 1) * (channels_in + channels_out) \
+        + 2 * num_vertices * taps * channels_in * channels_out
+    nbytes = num_vertices * (channels_in + channels_out) * itemsize + num_vertices * taps * 4 \
+        + num_points * (d + 1) * (4 + itemsize)
+    return flops, nbytes
+
+
+class Lattice:
+    """
+    A permutohedral lattice built on a set of points.
+    :param elevated: N x (d+1) elevated positions (see elevate)
+    """
+    def __init__(self, elevated):
+        n, d1 = elevated.shape
+        self.d = d1 - 1
+        self.num_points = n
+        keys, self.bary = enclosing_simplices(elevated)
+        keys = keys.reshape(-1, self.d)
+
+        # integer codes of vertex keys: mixed radix when it fits in int64, otherwise raw bytes
+        self.lo = keys.min(axis=0)
+        extent = keys.max(axis=0) - self.lo + 1
+        if np.prod(extent.astype(np.float64)) < 2 ** 62:
+            self.extent = extent
+            self.strides = np.cumprod(np.concatenate(([1], extent[:-1]))).astype(np.int64)
+        else:
+            self.extent, self.strides = None, None
+        self.codes, first, inverse = np.unique(self._encode(keys)[0], return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.keys = keys[first]
+        self.ids = inverse.reshape(n, d1)
+
+        # splatting sums contributions of points sorted by vertex
+        self.splat_order = np.argsort(inverse, kind='stable')
+        self.splat_starts = np.searchsorted(inverse[self.splat_order], np.arange(len(self.codes)))
+        self._neighbors = dict()
+
+    @classmethod
+    def from_positions(cls, positions, scale=1.0):
+        return cls(elevate(np.asarray(positions, dtype=np.float64) * scale))
+
+    @property
+    def num_vertices(self):
+        return len(self.codes)
+
+    def _encode(self, keys):
+        """
+        :return: codes of ... x d keys, and whether each key can be a vertex of this lattice
+        """
+        if self.strides is None:
+            keys = np.ascontiguousarray(keys, dtype=np.int64)
+            return keys.view(np.dtype((np.void, 8 * self.d))).reshape(keys.shape[:-1]), \
+                np.ones(keys.shape[:-1], dtype=bool)
+        rel = keys - self.lo
+        valid = np.all((rel >= 0) & (rel < self.extent), axis=-1)
+        return rel.dot(self.strides), valid
+
+    def lookup(self, keys):
+        """
+        :return: vertex indices of ... x d keys (-1 where there is no such vertex)
+        """
+        codes, valid = self._encode(keys)
+        idx = np.minimum(np.searchsorted(self.codes, codes), self.num_vertices - 1)
+        return np.where(valid & (self.codes[idx] == codes), idx, -1)
+
+    def neighbors(self, neighborhood_size=1):
+        """
+        :return: M x T vertex indices of filter taps (see filter_offsets), -1 for taps off the lattice
+        """
+        if neighborhood_size not in self._neighbors:
+            offsets = filter_offsets(self.d, neighborhood_size)
+            self._neighbors[neighborhood_size] = self.lookup(self.keys[:, np.newaxis, :] + offsets)
+        return self._neighbors[neighborhood_size]
+
+    def splat(self, values):
+        """
+        :param values: N x C ndarray
+        :return: M x C lattice values
+        """
+        d1 = self.d + 1
+        contrib = self.bary.reshape(-1, 1) * np.repeat(values, d1, axis=0)
+        return np.add.reduceat(contrib[self.splat_order], self.splat_starts, axis=0)
+
+    def slice(self, lattice_values):
+        """
+        :param lattice_values: M x C ndarray
+        :return: N x C values interpolated at the points
+        """
+        return np.einsum('nr,nrc->nc', self.bary, lattice_values[self.ids])
+
+    def blur(self, lattice_values, weights, neighborhood_size=1, chunk_size=65536):
+        """
+        Filter lattice values with a learned filter
+        :param lattice_values: M x C_in ndarray
+        :param weights: C_out x C_in x T ndarray, T = num_filter_taps(d, neighborhood_size)
+        :return: M x C_out ndarray
+        """
+        assert weights.shape[2] == num_filter_taps(self.d, neighborhood_size)
+        nbrs = self.neighbors(neighborhood_size)
+        padded = np.concatenate((lattice_values, np.zeros((1, lattice_values.shape[1]))), axis=0)  # -1 -> 0
+        out = np.empty((self.num_vertices, weights.shape[0]))
+        for b in range(0, self.num_vertices, chunk_size):
+            out[b:b + chunk_size] = np.tensordot(padded[nbrs[b:b + chunk_size]], weights, axes=([1, 2], [2, 1]))
+        return out
+
+    def gaussian_blur(self, lattice_values):
+        """
+        Blur with a [1 2 1] / 4 kernel along each of the d+1 lattice directions
+        """
+        if not hasattr(self, '_directions'):
+            d1 = self.d + 1
+            steps = (d1 * np.eye(d1, dtype=np.int64) - 1)[:, :self.d]
+            self._directions = [(self.lookup(self.keys + v), self.lookup(self.keys - v)) for v in steps]
+        out = lattice_values
+        for fwd, bwd in self._directions:
+            padded = np.concatenate((out, np.zeros((1, out.shape[1]))), axis=0)
+            out = 0.5 * out + 0.25 * (padded[fwd] + padded[bwd])
+        return out
+
+    def filter(self, values, weights=None, bias=None, neighborhood_size=1, normalize=True):
+        """
+        Splat, blur, slice
+        :param values: N x C_in ndarray
+        :param weights: C_out x C_in x T learned filter, or None for a Gaussian blur
+        :param bias: optionally, C_out biases
+        :param normalize: if True, divide by the Gaussian-blurred point density
+        :return: N x C_out ndarray
+        """
+        splatted = self.splat(values)
+        if weights is None:
+            out = self.slice(self.gaussian_blur(splatted))
+        else:
+            out = self.slice(self.blur(splatted, weights, neighborhood_size))
+        if normalize:
+            norm = self.slice(self.gaussian_blur(self.splat(np.ones((self.num_points, 1)))))
+            out /= norm + 1e-10
+        if bias is not None:
+            out += bias
+        return out
+
+
+def build_lattices(positions, scales):
+    """
+    Lattices of the same positions at several scales. Since the embedding is linear, points are elevated once
+    and each scale only redoes the simplex search and hashing. Coarse lattices are not derived from the finest one:
+    scale ratios of lattice specs need not be integers, and barycentric weights of every point in its coarse simplex
+    have to be computed anyway, which is most of the simplex search.
+    :return: list of Lattice, one per scale
+    """
+    elevated = elevate(np.asarray(positions, dtype=np.float64))
+    return [Lattice(elevated * s) for s in scales]
+
+
+def lattices_from_dims(data, lattice_dims_strs):
+    """
+    Lattices of a point cloud for lattice specs like 'x*64_y*64_z*64' (channel indices in data, as in PickAndScale).
+    Specs over the same channels whose scales differ by a common factor share the elevation of positions.
+    :param data: N x C ndarray
+    :param lattice_dims_strs: list of specs
+    :return: list of Lattice, one per spec
+    """
+    groups = dict()
+    for i, spec in enumerate(lattice_dims_strs):
+        channels, scales = parse_channel_scale(spec)
+        scales = np.array(scales)
+        base = tuple(np.round(scales / scales[0], 6))
+        groups.setdefault((tuple(channels), base), []).append((i, scales[0]))
+
+    lattices = [None] * len(lattice_dims_strs)
+    for (channels, base), members in groups.items():
+        for (i, _), lattice in zip(members, build_lattices(data[:, list(channels)] * np.array(base),
+                                                           [s for _, s in members])):
+            lattices[i] = lattice
+    return lattices
+
+
+def brute_force_gaussian(positions, values, chunk_size=1024):
+    """
+    Normalized Gaussian filter with unit standard deviation, computed over all pairs of points, as a reference for
+    Lattice.filter
+    """
+    out = np.empty((len(positions), values.shape[1]))
+    for b in range(0, len(positions), chunk_size):
+        d2 = ((positions[b:b + chunk_size, np.newaxis] - positions[np.newaxis]) ** 2).sum(axis=2)
+        k = np.exp(-d2 / 2)
+        out[b:b + chunk_size] = k.dot(values) / k.sum(axis=1, keepdims=True)
+    return out
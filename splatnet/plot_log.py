@@ -2,32 +2,17 @@
 Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
-import os
 import argparse
-import subprocess
-import numpy as np
 import matplotlib.pyplot as plt
+from splatnet import caffe_log
 
 
-def parse_and_plot(path, subplot_size=5, n_col=3, skip_train=100, skip_test=10,
-                   caffe_root=None, show_wo_save=False):
+def parse_and_plot(path, subplot_size=5, n_col=3, skip_train=100, skip_test=10, show_wo_save=False):
 
-    if not caffe_root:
-        import caffe
-        caffe_root = os.path.join(os.path.dirname(caffe.__file__), '..', '..')
-
-    parser_path = os.path.join(caffe_root, 'tools/extra/parse_log.py')
-    subprocess.run('python2 {} {} {}'.format(parser_path, path, os.path.dirname(path)).split(' '))
-
-    with open(path + '.train') as f:
-        l = f.readline()
-    labels_train = l.strip().split(',')[2:]
-    with open(path + '.test') as f:
-        l = f.readline()
-    labels_test = l.strip().split(',')[2:]
-
-    stats_train = np.loadtxt(path + '.train', delimiter=',', skiprows=1)
-    stats_test = np.loadtxt(path + '.test', delimiter=',', skiprows=1)
+    log = caffe_log.load(path)
+    labels_train, stats_train = log.train_stats()
+    labels_test, stats_test = log.test_stats()
+    labels_train, labels_test = labels_train[2:], labels_test[2:]
 
     n_row = (len(labels_train) - 1) // n_col + 1, (len(labels_test) - 1) // n_col + 1
 
@@ -61,10 +46,9 @@ if __name__ == '__main__':
     parser.add_argument('--skip_train', default=100, type=int, help='skip first such training iterations')
     parser.add_argument('--skip_test', default=10, type=int, help='skip first such testing iterations')
     parser.add_argument('--show_wo_save', action='store_true', help='show figure instead of saving it')
-    parser.add_argument('--caffe_root', default=None, type=str, help='path to caffe installation directory')
 
     args = parser.parse_args()
 
     parse_and_plot(args.path, args.subplot_size, args.num_column, args.skip_train, args.skip_test,
-                   args.caffe_root, args.show_wo_save)
+                   args.show_wo_save)
 
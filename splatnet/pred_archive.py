@@ -0,0 +1,155 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import os
+import io
+import json
+import zipfile
+import argparse
+import numpy as np
+import splatnet.configs
+from splatnet.utils import save_label_ply
+
+INDEX_NAME = 'index.json'
+
+
+class PredictionWriter:
+    """
+    Writes predictions of a whole run into a single archive, keyed by shape id.
+    The archive is an uncompressed .npz file: labels are stored as 'label/<shape_id>' (uint8) and, optionally,
+    probabilities as 'prob/<shape_id>' (float16). An index mapping shape ids to categories is written on close.
+    """
+    def __init__(self, path, save_prob=False):
+        self.path = path
+        self.save_prob = save_prob
+        self.index = dict()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.zip = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_array(self, name, arr):
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, arr, allow_pickle=False)
+        self.zip.writestr(name + '.npy', buf.getvalue())
+
+    def add(self, shape_id, label, prob=None, category=None):
+        """
+        :param shape_id: unique id of the shape (e.g. its hash)
+        :param label: N integer labels
+        :param prob: optionally, N x C class probabilities (ignored unless save_prob is set)
+        :param category: optionally, shape category stored in the index
+        """
+        if shape_id in self.index:
+            raise ValueError('Duplicate shape id: {}'.format(shape_id))
+        label = np.asarray(label)
+        assert label.size == 0 or (label.min() >= 0 and label.max() < 256)
+        self._write_array('label/' + shape_id, label.astype(np.uint8))
+        if self.save_prob and prob is not None:
+            self._write_array('prob/' + shape_id, np.asarray(prob, dtype=np.float16))
+        self.index[shape_id] = category
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.writestr(INDEX_NAME, json.dumps(self.index))
+            self.zip.close()
+            self.zip = None
+
+
+class PredictionReader:
+    """
+    Random access to an archive written by PredictionWriter. Arrays are only read when requested.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.npz = np.load(path, allow_pickle=False)
+        self.index = json.loads(self.npz.zip.read(INDEX_NAME).decode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, shape_id):
+        return shape_id in self.index
+
+    def __getitem__(self, shape_id):
+        return self.label(shape_id)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def category(self, shape_id):
+        return self.index[shape_id]
+
+    def label(self, shape_id):
+        return self.npz['label/' + shape_id]
+
+    def prob(self, shape_id):
+        """
+        :return: float16 probabilities, or None if they were not saved
+        """
+        key = 'prob/' + shape_id
+        return self.npz[key] if key + '.npy' in self.npz.zip.namelist() else None
+
+    def close(self):
+        self.npz.close()
+
+
+def export_ply(archive_path, save_dir, dataset='shapenet', dataset_params=None):
+    """
+    Export predictions in an archive as one .ply file per shape, under save_dir/category
+    :param archive_path: path to an archive written by PredictionWriter
+    :param save_dir: output folder
+    :param dataset: choices: 'shapenet'
+    :param dataset_params: a dict with optional dataset parameters
+    :return: number of exported shapes
+    """
+    if dataset == 'shapenet':
+        import splatnet.dataset.dataset_shapenet as shapenet
+        dataset_params_new = {} if not dataset_params else dataset_params
+        dataset_params = dict(subset='test')  # default values
+        dataset_params.update(dataset_params_new)
+        cmap = splatnet.configs.SN_CMAP
+    else:
+        raise ValueError('Unsupported dataset: {}'.format(dataset))
+
+    cnt = 0
+    with PredictionReader(archive_path) as reader:
+        categories = sorted(set(reader.index.values()))
+        for category in categories:
+            xyz_norm_list, _, _, names = shapenet.points_single_category(dims='x_y_z_nx_ny_nz', category=category,
+                                                                         **dataset_params)
+            os.makedirs(os.path.join(save_dir, category), exist_ok=True)
+            for xyz_norm, name in zip(xyz_norm_list, names):
+                if name not in reader or reader.category(name) != category:
+                    continue
+                save_label_ply(os.path.join(save_dir, category, '{}.ply'.format(name)),
+                               xyz_norm[:, :3], reader.label(name), cmap, norms=xyz_norm[:, 3:])
+                cnt += 1
+
+    return cnt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export predictions in an archive as .ply files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('archive', help='a prediction archive (.npz)')
+    parser.add_argument('save_dir', help='output folder')
+    parser.add_argument('--dataset', default='shapenet', choices=('shapenet',), help='dataset')
+    parser.add_argument('--dataset_params', nargs='+', help='dataset-specific parameters (key value pairs)')
+    args = parser.parse_args()
+
+    dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2])) if args.dataset_params else {}
+    num_exported = export_ply(args.archive, args.save_dir, args.dataset, dataset_params)
+    print('{} shapes exported to {}'.format(num_exported, args.save_dir))
@@ -0,0 +1,133 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import os
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+# set by init_worker, one per process
+_worker = dict()
+
+
+def list_scenes(source):
+    """
+    :param source: a folder of .ply files, or a manifest file with one .ply path per line
+    :return: list of (scene name, path)
+    """
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, '*.ply')))
+    else:
+        root = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            paths = [os.path.join(root, l.strip()) for l in f if l.strip() and not l.startswith('#')]
+    return [(os.path.splitext(os.path.basename(p))[0], p) for p in paths]
+
+
+def output_path(save_dir, scene):
+    return os.path.join(save_dir, '{}.labels.npy'.format(scene))
+
+
+def init_worker(network, weights, use_cpu, devices):
+    import caffe
+    if use_cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(devices.get())
+    _worker['net'] = caffe.Net(network, weights, caffe.TEST)
+
+
+def process_scene(job):
+    from splatnet.dataset import dataset_facade
+    from splatnet.semseg3d.test import extract_feat_scene
+    from splatnet.utils import ProbReducer
+
+    scene, path, input_dims, sample_size, save_dir, save_prob, top_k = job
+    tic = time.time()
+    data = dataset_facade.load_scene(path).view(input_dims)[0]
+    toc_load = time.time()
+
+    reducer = ProbReducer(top_k=top_k if save_prob else 0, keep_prob=save_prob and top_k <= 0)
+    out = extract_feat_scene(None, None, feed=dict(data=data.transpose().reshape(1, -1, 1, len(data))),
+                             out_names='prob', sample_size=sample_size, net=_worker['net'], reducer=reducer)
+    toc_forward = time.time()
+
+    # write to temporary files first, so that interrupted runs never leave partial outputs behind
+    save_path = output_path(save_dir, scene)
+    results = [('prob', out.get('prob', out.get('topk_prob'))), ('topk', out.get('topk_label')),
+               ('labels', out['label'].astype(np.uint8))]
+    for suffix, arr in results:
+        if arr is not None:
+            tmp_path = os.path.join(save_dir, '.{}.{}.npy'.format(scene, suffix))
+            np.save(tmp_path, arr)
+            os.replace(tmp_path, os.path.join(save_dir, '{}.{}.npy'.format(scene, suffix)))
+    toc = time.time()
+
+    return dict(scene=scene, path=path, num_points=len(data), pred=save_path, pid=os.getpid(),
+                load_secs=toc_load - tic, forward_secs=toc_forward - toc_load, write_secs=toc - toc_forward)
+
+
+def batch_test(scenes, network, weights, save_dir, input_dims='nx_ny_nz_r_g_b_h', sample_size=-1,
+               num_workers=1, devices=(0,), use_cpu=False, save_prob=False, overwrite=False, top_k=0):
+    """
+    Segment many scenes with a pool of worker processes, each holding a loaded network
+    :param scenes: list of (scene name, path to .ply)
+    :param save_dir: predictions go to <save_dir>/<scene>.labels.npy, timings are appended to <save_dir>/timing.jsonl
+    :param num_workers: number of worker processes
+    :param devices: gpu devices, assigned to workers round-robin
+    :param overwrite: if False, skip scenes that already have predictions
+    :param top_k: if positive (with save_prob), keep only the k best classes per point: their float16 scores in
+                  <scene>.prob.npy and class ids in <scene>.topk.npy
+    :return: number of processed scenes, number of skipped scenes
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    todo = [(scene, path) for scene, path in scenes if overwrite or not os.path.exists(output_path(save_dir, scene))]
+    if not todo:
+        return 0, len(scenes)
+
+    num_workers = min(num_workers, len(todo))
+    ctx = multiprocessing.get_context('spawn')
+    device_queue = ctx.Queue()
+    for i in range(num_workers):
+        device_queue.put(devices[i % len(devices)])
+
+    jobs = [(scene, path, input_dims, sample_size, save_dir, save_prob, top_k) for scene, path in todo]
+    with ctx.Pool(num_workers, initializer=init_worker, initargs=(network, weights, use_cpu, device_queue)) as pool, \
+            open(os.path.join(save_dir, 'timing.jsonl'), 'a') as f:
+        for i, record in enumerate(pool.imap_unordered(process_scene, jobs)):
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            print('[{}/{}] {}: {} points in {:.2f} secs'.format(
+                i + 1, len(jobs), record['scene'], record['num_points'],
+                record['load_secs'] + record['forward_secs'] + record['write_secs']), flush=True)
+
+    return len(todo), len(scenes) - len(todo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segment a batch of scenes with a trained network',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('scenes', help='a folder of .ply scenes, or a manifest with one .ply path per line')
+    parser.add_argument('save_dir', help='output folder')
+    parser.add_argument('--network', required=True, type=str, help='a .prototxt file')
+    parser.add_argument('--weights', required=True, type=str, help='a .caffemodel file')
+    parser.add_argument('--input', default='nx_ny_nz_r_g_b_h', help='features to use as input')
+    parser.add_argument('--sample_size', default=-1, type=int, help='testing sample size')
+    parser.add_argument('--num_workers', default=1, type=int, help='number of worker processes')
+    parser.add_argument('--devices', default=[0], nargs='+', type=int, help='gpu devices, shared by workers')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    parser.add_argument('--save_prob', action='store_true', help='if True, also save float16 probabilities')
+    parser.add_argument('--top_k', default=0, type=int, help='if positive, save probs of the k best classes only')
+    parser.add_argument('--overwrite', action='store_true', help='if True, redo scenes that have predictions')
+    args = parser.parse_args()
+
+    tic = time.time()
+    num_done, num_skipped = batch_test(list_scenes(args.scenes), args.network, args.weights, args.save_dir,
+                                       args.input, args.sample_size, args.num_workers, args.devices, args.cpu,
+                                       args.save_prob, args.overwrite, args.top_k)
+    print('{} scenes processed, {} skipped, in {:.2f} secs'.format(num_done, num_skipped, time.time() - tic))
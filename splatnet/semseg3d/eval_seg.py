@@ -2,59 +2,191 @@
 Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import os
 import sys
+import zlib
 import argparse
+import functools
 import numpy as np
-from sklearn.metrics import confusion_matrix
 import splatnet.configs
-from splatnet.utils import TimedBlock
+from splatnet.utils import TimedBlock, present_label_confusion, confusion_matrix, confusion_scores, ply_header
 
 
-def get_label(ply_path, column=3, from_rgb=True, cmap=None):
-    with open(ply_path) as f:
-        header_size = np.where([l.strip() == 'end_header' for l in f.readlines(1000)])[0][0] + 1
-    ply_data = np.loadtxt(ply_path, skiprows=header_size)
+@functools.lru_cache(maxsize=4)
+def _rgb_lut(cmap):
+    """
+    :param cmap: a tuple of rgb triplets
+    :return: a 2^24 lookup table from packed rgb values to labels (-1 for colors not in cmap)
+    """
+    lut = np.full(1 << 24, -1, dtype=np.int16)
+    lut[pack_rgb(np.array(cmap))] = np.arange(len(cmap))
+    return lut
+
+
+def pack_rgb(rgb):
+    rgb = np.rint(rgb).astype(np.int64)
+    return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+
+def rgb_to_label(rgb, cmap):
+    """
+    :param rgb: N x 3 colors
+    :param cmap: a color map, one rgb triplet per label
+    :return: N labels
+    """
+    labels = _rgb_lut(tuple(tuple(int(c) for c in v) for v in cmap))[pack_rgb(rgb)]
+    if np.any(labels < 0):
+        raise ValueError('Colors not in color map: {}'.format(np.unique(rgb[labels < 0], axis=0).tolist()))
+    return labels
+
+
+def label_cache_path(ply_path, column, from_rgb, cmap):
+    key = 'c{}'.format(column)
     if from_rgb:
-        return [np.where(np.prod(v == cmap, axis=1))[0][0] for v in ply_data[:, column:column+3]]
+        key += 'rgb{:08x}'.format(zlib.crc32(np.asarray(cmap, dtype=np.int64).tobytes()))
+    return '{}.{}.labels.npy'.format(ply_path, key)
+
+
+def get_label(ply_path, column=3, from_rgb=True, cmap=None, cache=False):
+    """
+    :param ply_path: an ascii .ply file, or a .npy file with labels
+    :param column: (starting) column of labels (0-index)
+    :param from_rgb: if True, labels are encoded as rgb colors with cmap
+    :param cache: if True, decoded labels are cached next to ply_path and reused while it is unchanged
+    :return: N labels
+    """
+    if ply_path.endswith('.npy'):  # labels saved by streaming inference
+        return np.load(ply_path, mmap_mode='r')
+
+    if cache:
+        cache_path = label_cache_path(ply_path, column, from_rgb, cmap)
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(ply_path):
+            return np.load(cache_path, mmap_mode='r')
+
+    _, _, header_size = ply_header(ply_path)
+    if from_rgb:
+        labels = rgb_to_label(np.loadtxt(ply_path, skiprows=header_size, usecols=range(column, column + 3),
+                                         ndmin=2), cmap)
     else:
-        return ply_data[:, column] - 1
+        labels = np.loadtxt(ply_path, skiprows=header_size, usecols=column, ndmin=1) - 1
+
+    if cache:
+        try:
+            tmp_path = cache_path + '.tmp.npy'
+            np.save(tmp_path, labels)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # e.g. a read-only data folder
+    return labels
 
 
 def compute_scores(pred, gt):
-    pred, gt = np.array(pred), np.array(gt)
-    scores = dict()
-    labels = np.unique(gt)
-    assert np.all([(v in labels) for v in np.unique(pred)])
-
-    TPs, FPs, FNs, Total = [], [], [], []
-    for l in labels:
-        TPs.append(sum((gt == l) * (pred == l)))
-        FPs.append(sum((gt != l) * (pred == l)))
-        FNs.append(sum((gt == l) * (pred != l)))
-        Total.append(sum(gt == l))
-
-    scores['accuracy'] = sum(gt == pred) / len(gt)
-    scores['confusion'] = confusion_matrix(gt, pred)
-    scores['class_accuracy'] = [TPs[i] / (TPs[i] + FNs[i]) for i in range(len(labels))]
-    scores['avg_class_accuracy'] = sum(scores['class_accuracy']) / len(labels)
-    scores['class_iou'] = [TPs[i] / (TPs[i] + FNs[i] + FPs[i]) for i in range(len(labels))]
-    scores['avg_class_iou'] = sum(scores['class_iou']) / len(labels)
-    scores['num_points'] = Total
+    _, conf = present_label_confusion([pred], [gt])
+    conf = conf[0]
+    scores = confusion_scores(conf)
+    scores['confusion'] = conf
+    scores['avg_class_accuracy'] = scores['class_accuracy'].mean()
+    scores['avg_class_iou'] = scores['class_iou'].mean()
 
     return scores
 
 
+class ScoreAccumulator:
+    """
+    Accumulates a confusion matrix over chunks of (pred, gt), e.g. tiles, scenes or shards from worker processes.
+    Accumulators can be saved, loaded and merged; scores() gives the same results as compute_scores on the
+    concatenation of all chunks.
+    """
+    def __init__(self):
+        self.offset = 0  # label value of row/column 0
+        self.conf = np.zeros((0, 0), dtype=np.int64)
+
+    def _grow(self, lo, hi):
+        if self.conf.size:
+            lo, hi = min(lo, self.offset), max(hi, self.offset + len(self.conf) - 1)
+        if self.conf.size and lo == self.offset and hi - lo + 1 == len(self.conf):
+            return
+        conf = np.zeros((hi - lo + 1, hi - lo + 1), dtype=np.int64)
+        s = self.offset - lo
+        conf[s:s + len(self.conf), s:s + len(self.conf)] = self.conf
+        self.offset, self.conf = lo, conf
+
+    def update(self, pred, gt):
+        pred = np.asarray(pred).reshape(-1).astype(np.int64)
+        gt = np.asarray(gt).reshape(-1).astype(np.int64)
+        assert len(pred) == len(gt)
+        if len(gt) == 0:
+            return self
+        self._grow(min(pred.min(), gt.min()), max(pred.max(), gt.max()))
+        self.conf += confusion_matrix(pred - self.offset, gt - self.offset, len(self.conf))
+        return self
+
+    def merge(self, other):
+        if other.conf.size:
+            self._grow(other.offset, other.offset + len(other.conf) - 1)
+            s = other.offset - self.offset
+            self.conf[s:s + len(other.conf), s:s + len(other.conf)] += other.conf
+        return self
+
+    def save(self, path):
+        np.savez(path, offset=self.offset, conf=self.conf)
+
+    @classmethod
+    def load(cls, path):
+        acc = cls()
+        with np.load(path) as f:
+            acc.offset, acc.conf = int(f['offset']), f['conf']
+        return acc
+
+    def scores(self):
+        """
+        :return: same as compute_scores, plus 'labels' (label values present in ground-truth)
+        """
+        present = self.conf.sum(axis=1) > 0
+        assert not np.any(self.conf.sum(axis=0)[~present]), 'Predicted labels that are not in ground-truth'
+        conf = self.conf[present][:, present]
+        scores = confusion_scores(conf)
+        scores['confusion'] = conf
+        scores['avg_class_accuracy'] = scores['class_accuracy'].mean()
+        scores['avg_class_iou'] = scores['class_iou'].mean()
+        scores['labels'] = np.flatnonzero(present) + self.offset
+        return scores
+
+
+def print_scores(scores, classes, file=None):
+    print('-------------------- Summary --------------------', file=file)
+    print('   Overall accuracy: {:.4f}'.format(scores['accuracy']), file=file)
+    print('Avg. class accuracy: {:.4f}'.format(scores['avg_class_accuracy']), file=file)
+    print('                IoU: {:.4f}'.format(scores['avg_class_iou']), file=file)
+    print('-------------------- Breakdown --------------------', file=file)
+    print('  class      count(ratio) accuracy   IoU', file=file)
+    total_points = sum(scores['num_points'])
+    for i in range(len(classes)):
+        print('{:10} {:7d}({:4.1f}%) {:.4f}   {:.4f}'.format(classes[i], scores['num_points'][i],
+                                                             100 * scores['num_points'][i] / total_points,
+                                                             scores['class_accuracy'][i], scores['class_iou'][i]),
+              file=file)
+    print('-------------------- Confusion --------------------', file=file)
+    print('        {}'.format(' '.join(['{:>7}'.format(v) for v in classes])), file=file)
+    for i, c in enumerate(classes):
+        print('{:7} {}'.format(c, ' '.join(['{:7d}'.format(v) for v in scores['confusion'][i]])), file=file)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute evaluation metrics for segmentation results',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('pred', type=str, help='path to predictions')
-    parser.add_argument('gt', type=str, help='path to ground-truth')
+    parser.add_argument('pred', type=str, nargs='?', help='path to predictions')
+    parser.add_argument('gt', type=str, nargs='?', help='path to ground-truth')
     parser.add_argument('--dataset', default='facade', choices=('facade', 'stanford3d'),
                         help='specify a dataset for the evaluation')
     parser.add_argument('--pred_rgb', action='store_true', help='turn this on if pred is encoded with rgb values')
     parser.add_argument('--gt_rgb', action='store_true', help='turn this on if gt is encoded with rgb values')
     parser.add_argument('--pred_column', type=int, default=4, help='(starting) column of label in pred (1-index)')
     parser.add_argument('--gt_column', type=int, default=4, help='(starting) column of label in gt (1-index)')
+    parser.add_argument('--no_gt_cache', action='store_true', help='do not cache decoded ground-truth labels')
+    parser.add_argument('--chunk_size', type=int, default=1000000, help='number of points scored at a time')
+    parser.add_argument('--save_acc', type=str, default=None, help='save the accumulated confusion matrix (.npz)')
+    parser.add_argument('--merge', nargs='+', default=[], help='accumulators (.npz) saved by other runs to add')
     parser.add_argument('--log', type=str, default=None, help='redirect output to log if specified')
     parser.add_argument('-q', '--quiet', action='store_true', help='silent intermediate information')
     args = parser.parse_args()
@@ -62,20 +194,30 @@ if __name__ == '__main__':
     if args.dataset == 'facade':
         classes = splatnet.configs.FACADE_CATEGORIES
         cmap = splatnet.configs.FACADE_CMAP
+    elif args.dataset == 'stanford3d':
+        raise NotImplementedError()
+    else:
+        raise ValueError('Dataset {} is not supported'.format(args.dataset))
 
+    acc = ScoreAccumulator()
+    if args.pred is not None:
+        assert args.gt is not None
         with TimedBlock('Loading predictions from {}'.format(args.pred), not args.quiet):
             pred = get_label(args.pred, args.pred_column - 1, args.pred_rgb, cmap=cmap)
 
         with TimedBlock('Loading ground-truth from {}'.format(args.gt), not args.quiet):
-            gt = get_label(args.gt, args.gt_column - 1, args.gt_rgb, cmap=cmap)
+            gt = get_label(args.gt, args.gt_column - 1, args.gt_rgb, cmap=cmap, cache=not args.no_gt_cache)
 
-    elif args.dataset == 'stanford3d':
-        raise NotImplementedError()
-    else:
-        raise ValueError('Dataset {} is not supported'.format(args.dataset))
+        with TimedBlock('Computing scores', not args.quiet):
+            assert len(pred) == len(gt)
+            for i in range(0, len(gt), args.chunk_size):
+                acc.update(pred[i:i + args.chunk_size], gt[i:i + args.chunk_size])
 
-    with TimedBlock('Computing scores', not args.quiet):
-        scores = compute_scores(pred, gt)
+    for path in args.merge:
+        acc.merge(ScoreAccumulator.load(path))
+
+    if args.save_acc:
+        acc.save(args.save_acc)
 
     if not args.quiet:
         print('Evaluation done!')
@@ -83,19 +225,4 @@ if __name__ == '__main__':
     if args.log:
         sys.stdout = open(args.log, 'a')
 
-    print('-------------------- Summary --------------------')
-    print('   Overall accuracy: {:.4f}'.format(scores['accuracy']))
-    print('Avg. class accuracy: {:.4f}'.format(scores['avg_class_accuracy']))
-    print('                IoU: {:.4f}'.format(scores['avg_class_iou']))
-    print('-------------------- Breakdown --------------------')
-    print('  class      count(ratio) accuracy   IoU')
-    total_points = sum(scores['num_points'])
-    for i in range(len(classes)):
-        print('{:10} {:7d}({:4.1f}%) {:.4f}   {:.4f}'.format(classes[i], scores['num_points'][i],
-                                                             100 * scores['num_points'][i] / total_points,
-                                                             scores['class_accuracy'][i], scores['class_iou'][i]))
-    print('-------------------- Confusion --------------------')
-    print('        {}'.format(' '.join(['{:>7}'.format(v) for v in classes])))
-    for i, c in enumerate(classes):
-        print('{:7} {}'.format(c, ' '.join(['{:7d}'.format(v) for v in scores['confusion'][i]])))
-
+    print_scores(acc.scores(), classes)
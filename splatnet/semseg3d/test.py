@@ -4,21 +4,36 @@ Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses
 """
 import os
 import glob
+import shutil
+import tempfile
 import argparse
 import time
 import numpy as np
 import caffe
 import splatnet.configs
-from splatnet.utils import modify_blob_shape
+from splatnet.utils import modify_blob_shape, reshape_net_inputs, ply_header, ColumnStore, \
+    ProbReducer, TimedBlock, save_label_ply
 from splatnet import plot_log
+from splatnet.semseg3d import eval_seg
 import splatnet.configs
 
 
-EVAL_SCRIPT_PATH = os.path.join(splatnet.configs.ROOT_DIR, 'splatnet', 'semseg3d', 'eval_seg.py')
-
-
-def extract_feat_scene(network_path, weights_path, feed, out_names, batch_size=1, sample_size=-1):
-    net = caffe.Net(network_path, weights_path, caffe.TEST)
+def extract_feat_scene(network_path, weights_path, feed, out_names, batch_size=1, sample_size=-1, net=None,
+                       reducer=None):
+    """
+    Run a network over a whole scene
+    :param feed: a dict of input name -> 1 x C x 1 x N array
+    :param out_names: name(s) of output blobs
+    :param batch_size:
+    :param sample_size: -1 -- use all points in a single sample, 0 -- use the size in network
+    :param net: optionally, an already loaded network, whose inputs are reshaped in place instead of reloading it
+    :param reducer: optionally, a function (e.g. a ProbReducer) applied to each batch of N_b x C' outputs,
+                    returning a dict of per-point arrays; only its results are kept
+    :return: (a dict of) 1 x C' x 1 x N output array(s), or dict(s) of per-point arrays if reducer is given
+    """
+    resident = net is not None
+    if not resident:
+        net = caffe.Net(network_path, weights_path, caffe.TEST)
     net_bs, _, _, net_ss = net.blobs[list(feed.keys())[0]].data.shape
 
     npt = list(feed.values())[0].shape[-1]
@@ -30,8 +45,11 @@ def extract_feat_scene(network_path, weights_path, feed, out_names, batch_size=1
         assert sample_size * batch_size <= npt
 
     if net_bs != batch_size or net_ss != sample_size:
-        network_path = modify_blob_shape(network_path, feed.keys(), {0: batch_size, 3: sample_size})
-        net = caffe.Net(network_path, weights_path, caffe.TEST)
+        if resident:
+            reshape_net_inputs(net, feed.keys(), batch_size, sample_size)
+        else:
+            network_path = modify_blob_shape(network_path, feed.keys(), {0: batch_size, 3: sample_size})
+            net = caffe.Net(network_path, weights_path, caffe.TEST)
 
     if type(out_names) == str:
         out_names = (out_names,)
@@ -53,9 +71,12 @@ def extract_feat_scene(network_path, weights_path, feed, out_names, batch_size=1
         for out_key in out_names:
             out_sz = net.blobs[out_key].data.shape
             out = net.blobs[out_key].data.transpose(1, 2, 0, 3).reshape(1, out_sz[1], out_sz[2], -1)[:, :, :, -bs:]
-            outs[out_key].append(out.copy())
+            outs[out_key].append(out.copy() if reducer is None else reducer(out[0, :, 0, :].T))
 
-    result = {v: np.concatenate(outs[v], axis=3) for v in out_names}
+    if reducer is None:
+        result = {v: np.concatenate(outs[v], axis=3) for v in out_names}
+    else:
+        result = {v: {k: np.concatenate([o[k] for o in outs[v]], axis=0) for k in outs[v][0]} for v in out_names}
     if single_target:
         result = result[out_names[0]]
 
@@ -63,7 +84,7 @@ def extract_feat_scene(network_path, weights_path, feed, out_names, batch_size=1
 
 
 def semseg_test(dataset, network, weights, input_dims='nx_ny_nz_r_g_b_h', sample_size=-1,
-                dataset_params=None, save_dir='', save_prefix='', use_cpu=False):
+                dataset_params=None, save_dir='', save_prefix='', use_cpu=False, return_pred=False):
     """
     Testing trained semantic segmentation network
     :param dataset: choices: 'facade', 'stanford3d'
@@ -75,7 +96,8 @@ def semseg_test(dataset, network, weights, input_dims='nx_ny_nz_r_g_b_h', sample
     :param save_dir: default ''
     :param save_prefix: default ''
     :param use_cpu: default False
-    :return:
+    :param return_pred: if True, also return the predicted labels
+    :return: path to predictions, elapsed time, number of points (, predicted labels)
     """
 
     if use_cpu:
@@ -93,7 +115,8 @@ def semseg_test(dataset, network, weights, input_dims='nx_ny_nz_r_g_b_h', sample
         for v in {'val_ratio'}:
             if v in dataset_params:
                 dataset_params[v] = float(dataset_params[v])
-        data, xyz, norms = dataset_facade.points(dims=input_dims+',x_y_z,nx_ny_nz', **dataset_params)
+        store = dataset_facade.points_store(**dataset_params)
+        data, xyz, norms = [store.view(dims)[0] for dims in (input_dims, 'x_y_z', 'nx_ny_nz')]
         cmap = splatnet.configs.FACADE_CMAP
     elif dataset == 'stanford3d':
         norms = None
@@ -102,52 +125,127 @@ def semseg_test(dataset, network, weights, input_dims='nx_ny_nz_r_g_b_h', sample
         raise ValueError('Unsupported dataset: {}'.format(dataset))
 
     tic = time.time()
-    import pdb;pdb.set_trace()
-    prob = extract_feat_scene(network, weights,
+    pred = extract_feat_scene(network, weights,
                               feed=dict(data=data.transpose().reshape(1, -1, 1, len(data))),
                               out_names='prob',
-                              sample_size=sample_size)
+                              sample_size=sample_size, reducer=ProbReducer())['label']
     elapsed = time.time() - tic
-    import pdb; pdb.set_trace()
-
-    pred = prob.argmax(axis=1).squeeze()
-
-    if norms is None:
-        out = np.array([np.concatenate((x, cmap[int(c)]), axis=0) for (x, c) in zip(xyz, pred)])
-        header = '''ply
-format ascii 1.0
-element vertex {}
-property float x
-property float y
-property float z
-property uchar diffuse_red
-property uchar diffuse_green
-property uchar diffuse_blue
-end_header'''.format(len(data))
-        fmt = '%.6f %.6f %.6f %d %d %d'
-    else:
-        out = np.array([np.concatenate((x, n, cmap[int(c)]), axis=0) for (x, n, c) in zip(xyz, norms, pred)])
-        header = '''ply
-format ascii 1.0
-element vertex {}
-property float x
-property float y
-property float z
-property float nx
-property float ny
-property float nz
-property uchar diffuse_red
-property uchar diffuse_green
-property uchar diffuse_blue
-end_header'''.format(len(data))
-        fmt = '%.6f %.6f %.6f %.6f %.6f %.6f %d %d %d'
 
     save_path = os.path.join(save_dir, '{}pred_{}.ply'.format(save_prefix, dataset_params['subset']))
-    np.savetxt(save_path, out, fmt=fmt, header=header, comments='')
+    save_label_ply(save_path, xyz, pred, cmap, norms=norms)
 
+    if return_pred:
+        return save_path, elapsed, len(data), pred
     return save_path, elapsed, len(data)
 
 
+def slab_bounds(chunks, columns, num_points, slab_size, num_samples=100000):
+    """
+    Find the longest axis of a scene, and boundaries along it that cut the scene into slabs of about slab_size points,
+    from a subsample of its points
+    :param chunks: an iterable of N_i x C arrays
+    :param columns: column names, including 'x', 'y' and 'z'
+    :return: column index of the axis, ascending slab boundaries (a point goes to slab searchsorted(bounds, v, 'right'))
+    """
+    xyz_idx = [columns.index(c) for c in ('x', 'y', 'z')]
+    step = max(1, num_points // num_samples)
+    lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+    samples, offset = [], 0
+    for chunk in chunks:
+        xyz = chunk[:, xyz_idx]
+        lo, hi = np.minimum(lo, xyz.min(axis=0)), np.maximum(hi, xyz.max(axis=0))
+        samples.append(xyz[(-offset) % step::step])
+        offset += len(chunk)
+    axis = int(np.argmax(hi - lo))
+    samples = np.concatenate(samples)[:, axis]
+    num_slabs = int(np.ceil(num_points / slab_size))
+    return xyz_idx[axis], np.unique(np.percentile(samples, np.arange(1, num_slabs) * 100 / num_slabs))
+
+
+def bucket_slabs(chunks, num_columns, axis, bounds, tmp_dir):
+    """
+    Write points to one file per slab, as records of a row and its index in the scene
+    :return: paths to slab files (missing for empty slabs), record dtype
+    """
+    dtype = np.dtype([('row', np.float32, (num_columns,)), ('index', np.int64)])
+    paths = [os.path.join(tmp_dir, 'slab_{}.bin'.format(i)) for i in range(len(bounds) + 1)]
+    offset = 0
+    for chunk in chunks:
+        records = np.empty(len(chunk), dtype=dtype)
+        records['row'], records['index'] = chunk, np.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+        slab = np.searchsorted(bounds, chunk[:, axis], side='right')
+        order = np.argsort(slab, kind='stable')
+        starts = np.searchsorted(slab[order], np.arange(len(paths) + 1))
+        for i in np.flatnonzero(np.diff(starts)):
+            with open(paths[i], 'ab') as f:
+                records[order[starts[i]:starts[i + 1]]].tofile(f)
+    return paths, dtype
+
+
+def semseg_test_stream(network, weights, scene_path, save_path, input_dims='nx_ny_nz_r_g_b_h',
+                       window=100000, overlap=10000, use_cpu=False):
+    """
+    Testing trained semantic segmentation network on a scene in memory bounded by a few slabs: the scene is cut
+    along its longest axis into slabs of about window points, written to temporary files next to save_path, and
+    segmented slab by slab in windows of window points, each with the overlap nearest points along that axis on
+    both sides as context (taken from adjacent slabs at most). Labels are written to a memory-mapped .npy
+    :param network: path to a .prototxt file
+    :param weights: path to a .caffemodel file
+    :param scene_path: path to an ascii .ply scene
+    :param save_path: path to a .npy file for predicted labels
+    :param input_dims: feat dims and scales
+    :param window: number of points predicted per forward
+    :param overlap: number of context points on each side of a window, should cover the largest lattice cell
+    :param use_cpu: default False
+    :return: save_path, elapsed time, number of points
+    """
+    from splatnet.dataset import dataset_facade
+
+    if use_cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    net = caffe.Net(network, weights, caffe.TEST)
+    num_points, props, _ = ply_header(scene_path)
+    columns = dataset_facade.scene_columns(props)
+
+    tic = time.time()
+    axis, bounds = slab_bounds(dataset_facade.iter_scene_chunks(scene_path, window), columns, num_points, window)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(save_path)))
+    try:
+        paths, dtype = bucket_slabs(dataset_facade.iter_scene_chunks(scene_path, window), len(columns), axis, bounds,
+                                    tmp_dir)
+
+        def load_slab(i):
+            if i >= len(paths) or not os.path.exists(paths[i]):
+                return np.empty(0, dtype=dtype)
+            records = np.fromfile(paths[i], dtype=dtype)
+            return records[np.argsort(records['row'][:, axis], kind='stable')]
+
+        labels = np.lib.format.open_memmap(save_path, mode='w+', dtype=np.uint8, shape=(num_points,))
+        prev, cur, nxt = np.empty(0, dtype=dtype), load_slab(0), load_slab(1)
+        for i in range(len(paths)):
+            before = prev[max(0, len(prev) - overlap):]
+            records = np.concatenate((before, cur, nxt[:overlap]))
+            for start in range(len(before), len(before) + len(cur), window):
+                end = min(start + window, len(before) + len(cur))
+                lo, hi = max(0, start - overlap), min(len(records), end + overlap)
+                data = ColumnStore([records['row'][lo:hi]], columns).view(input_dims)[0]
+                pred = extract_feat_scene(None, None, feed=dict(data=data.transpose().reshape(1, -1, 1, len(data))),
+                                          out_names='prob', net=net, reducer=ProbReducer())['label']
+                labels[records['index'][start:end]] = pred[start - lo:end - lo]
+            prev, cur, nxt = cur, nxt, load_slab(i + 2)
+        labels.flush()
+        del labels
+    finally:
+        shutil.rmtree(tmp_dir)
+    elapsed = time.time() - tic
+
+    return save_path, elapsed, num_points
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(add_help=False)
 
@@ -165,6 +263,12 @@ if __name__ == '__main__':
     group.add_argument('--log_eval', default=None, type=str, help='path to write evaluation logs')
     group.add_argument('--save_dir', default=None, type=str, help='together with save_prefix, a place for predictions')
     group.add_argument('--save_prefix', default=None, type=str, help='together with save_dir, a place for predictions')
+    group.add_argument('--stream_window', default=0, type=int,
+                       help='if positive, segment the test scene in slabs of this many points along its longest axis, '
+                            'holding only a few slabs in memory (facade test only)')
+    group.add_argument('--stream_overlap', default=10000, type=int,
+                       help='context points on each side of a window, from adjacent slabs at most; should cover the '
+                            'coarsest lattice cell')
 
     group = parser.add_argument_group('evaluation options')
     group.add_argument('--gt', default=None, type=str, help='path to ground-truth')
@@ -209,8 +313,17 @@ if __name__ == '__main__':
     else:
         args.dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2]))
 
-    pred_path, elapsed, num_pts = semseg_test(args.dataset, network, weights, args.input, args.sample_size,
-                                              args.dataset_params, save_dir, save_prefix, args.cpu)
+    pred = None
+    if args.stream_window > 0:
+        assert args.dataset == 'facade' and args.dataset_params.get('subset', 'test') == 'test'
+        scene_path = os.path.join(args.dataset_params.get('root', splatnet.configs.FACADE_DATA_DIR), 'pcl_test.ply')
+        pred_path, elapsed, num_pts = semseg_test_stream(network, weights, scene_path,
+                                                         os.path.join(save_dir, '{}pred_test.npy'.format(save_prefix)),
+                                                         args.input, args.stream_window, args.stream_overlap, args.cpu)
+    else:
+        pred_path, elapsed, num_pts, pred = semseg_test(args.dataset, network, weights, args.input, args.sample_size,
+                                                        args.dataset_params, save_dir, save_prefix, args.cpu,
+                                                        return_pred=args.gt is not None)
 
     if log_eval:
         with open(log_eval, 'a') as f:
@@ -218,18 +331,25 @@ if __name__ == '__main__':
             f.write('{} points evaluated in {:.2f} secs.\n'.format(num_pts, elapsed))
 
     if args.gt is not None:
-        import subprocess
-        subprocess.run('python {} --dataset {} {}'
-                       '{} --pred_rgb --pred_column 7 '
-                       '{} {}--gt_column {}'.format(EVAL_SCRIPT_PATH,
-                                                    args.dataset,
-                                                    '--log {} '.format(log_eval) if log_eval else '',
-                                                    os.path.abspath(pred_path),
-                                                    os.path.abspath(args.gt),
-                                                    '--gt_rgb ' if args.gt_rgb else '',
-                                                    args.gt_column).split(' '))
-
-    if log_train is not '':
-        import pdb; pdb.set_trace()
+        if args.dataset != 'facade':
+            raise NotImplementedError()
+        if pred is None:
+            pred = eval_seg.get_label(pred_path)
+        with TimedBlock('Loading ground-truth from {}'.format(args.gt), True):
+            gt = eval_seg.get_label(args.gt, args.gt_column - 1, args.gt_rgb, cmap=splatnet.configs.FACADE_CMAP,
+                                    cache=True)
+        if len(pred) != len(gt):
+            raise ValueError('{} predictions for {} ground-truth points'.format(len(pred), len(gt)))
+        with TimedBlock('Computing scores', True):
+            acc = eval_seg.ScoreAccumulator()
+            for i in range(0, len(gt), 1000000):
+                acc.update(pred[i:i + 1000000], gt[i:i + 1000000])
+        if log_eval:
+            with open(log_eval, 'a') as f:
+                eval_seg.print_scores(acc.scores(), splatnet.configs.FACADE_CATEGORIES, file=f)
+        else:
+            eval_seg.print_scores(acc.scores(), splatnet.configs.FACADE_CATEGORIES)
+
+    if log_train:
         plot_log.parse_and_plot(log_train)
 
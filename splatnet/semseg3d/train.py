@@ -56,34 +56,36 @@ def semseg_train(network, exp_dir, exp_prefix, args):
 
     random_seed = 0
     debug_info = False
-    solver = create_solver.standard_solver(network,
-                                           network,
-                                           snapshot_prefix,
-                                           base_lr=args.base_lr,
-                                           gamma=args.lr_decay,
-                                           stepsize=args.stepsize,
-                                           test_iter=args.test_iter,
-                                           test_interval=args.test_interval,
-                                           max_iter=args.num_iter,
-                                           snapshot=args.snapshot_interval,
-                                           solver_type=args.solver_type,
-                                           weight_decay=args.weight_decay,
-                                           iter_size=args.iter_size,
-                                           debug_info=debug_info,
-                                           random_seed=random_seed,
-                                           save_path=os.path.join(exp_dir, exp_prefix + 'solver.prototxt'))
-    solver = caffe.get_solver(solver)
-
+    solver_path = create_solver.standard_solver(network,
+                                                network,
+                                                snapshot_prefix,
+                                                base_lr=args.base_lr,
+                                                gamma=args.lr_decay,
+                                                stepsize=args.stepsize,
+                                                test_iter=args.test_iter,
+                                                test_interval=args.test_interval,
+                                                max_iter=args.num_iter,
+                                                snapshot=args.snapshot_interval,
+                                                solver_type=args.solver_type,
+                                                weight_decay=args.weight_decay,
+                                                iter_size=args.iter_size,
+                                                debug_info=debug_info,
+                                                random_seed=random_seed,
+                                                solver_mode='CPU' if args.cpu else 'GPU',
+                                                save_path=os.path.join(exp_dir, exp_prefix + 'solver.prototxt'))
+
+    weights, state = None, None
     if args.init_model:
         if args.init_model.endswith('.solverstate'):
-            solver.restore(args.init_model)
+            state = args.init_model
         elif args.init_model.endswith('.caffemodel'):
-            solver.net.copy_from(args.init_model)
+            weights = args.init_model
         else:
             raise ValueError('Invalid file: {}'.format(args.init_model))
 
-    import pdb; pdb.set_trace()
-    solver.solve()
+    create_solver.train(solver_path, weights, state,
+                        os.path.join(exp_dir, exp_prefix + 'metrics.jsonl') if args.metrics else None,
+                        args.batch_size * args.sample_size, args.workers)
 
 
 if __name__ == '__main__':
@@ -119,9 +121,15 @@ if __name__ == '__main__':
     parser.add_argument('--exp_prefix', default='', help='optional prefix for the experiment')
     parser.add_argument('--cpu', action='store_true', help='use cpu')
     parser.add_argument('--init_model', default=None, help='a .caffemodel/.solverstate file to start/resume training')
+    parser.add_argument('--metrics', action='store_true', help='if True, log per-iteration metrics to a .jsonl file')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='number of data-parallel worker processes (with --cpu), each training on batch_size samples')
 
     args = parser.parse_args()
 
+    if args.workers > 1 and not args.cpu:
+        parser.error('--workers requires --cpu')
+
     if not args.dataset_params:
         args.dataset_params = {}
     else:
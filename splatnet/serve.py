@@ -0,0 +1,311 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import numpy as np
+
+import splatnet.configs
+from splatnet.utils import pad_indices, scatter_mean, reshape_net_inputs
+
+
+class ResidentNet:
+    """
+    A deploy network loaded once. Input blobs are reshaped in place to fit each batch.
+    """
+    def __init__(self, network, weights, input_name='data', output_name='prob'):
+        import caffe
+        self.net = caffe.Net(network, weights, caffe.TEST)
+        self.input_name = input_name
+        self.output_name = output_name
+        self.input_channels = self.net.blobs[input_name].data.shape[1]
+
+    def forward(self, clouds):
+        """
+        :param clouds: a list of N_i x C arrays
+        :return: a list of N_i x K arrays
+        """
+        sample_sizes = [len(cloud) for cloud in clouds]
+        ss = max(sample_sizes)
+        pad_idxs = [pad_indices(k, ss) for k in sample_sizes]
+        data = np.stack([cloud[idx] for cloud, idx in zip(clouds, pad_idxs)])    # B x S x C
+
+        blob = self.net.blobs[self.input_name]
+        if blob.data.shape[0] != len(clouds) or blob.data.shape[3] != ss:
+            reshape_net_inputs(self.net, (self.input_name,), len(clouds), ss)
+        blob.data[...] = data.transpose(0, 2, 1)[:, :, np.newaxis, :]
+        self.net.forward()
+
+        out = self.net.blobs[self.output_name].data.transpose(0, 3, 1, 2).reshape(len(clouds), ss, -1)
+        return [scatter_mean(out[i], idx, k) for i, (idx, k) in enumerate(zip(pad_idxs, sample_sizes))]
+
+
+class Request:
+    def __init__(self, model, points, return_prob):
+        self.model = model
+        self.points = points
+        self.return_prob = return_prob
+        self.future = Future()
+        self.tic = time.time()
+
+
+class Stats:
+    """
+    Latency and throughput counters.
+    """
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests, self.points, self.batches, self.errors = 0, 0, 0, 0
+        self.forward_time = 0.0
+        self.latencies = collections.deque(maxlen=window)
+
+    def add_batch(self, requests, forward_time):
+        toc = time.time()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.points += sum(len(r.points) for r in requests)
+            self.forward_time += forward_time
+            self.latencies.extend([toc - r.tic for r in requests])
+
+    def add_error(self, num_requests):
+        with self.lock:
+            self.errors += num_requests
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            return dict(uptime=elapsed,
+                        requests=self.requests,
+                        points=self.points,
+                        batches=self.batches,
+                        errors=self.errors,
+                        avg_batch_size=self.requests / max(self.batches, 1),
+                        requests_per_sec=self.requests / elapsed,
+                        points_per_sec=self.points / elapsed,
+                        forward_points_per_sec=self.points / max(self.forward_time, 1e-9),
+                        latency_p50=float(np.percentile(latencies, 50)),
+                        latency_p95=float(np.percentile(latencies, 95)),
+                        latency_max=float(latencies.max()))
+
+
+class InferenceService:
+    """
+    Owns all networks in a single inference thread (Caffe device settings are per thread), and micro-batches
+    requests: after the first request arrives, it waits up to max_wait seconds for more, then runs one forward
+    per network with up to batch_size clouds.
+    :param models: a dict of model name -> (network key, class slice or None)
+    :param nets: a dict of network key -> (prototxt, caffemodel)
+    """
+    def __init__(self, models, nets, batch_size=16, max_wait=0.005, use_cpu=False, device=0):
+        self.models = models
+        self.nets = nets
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.use_cpu = use_cpu
+        self.device = device
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.ready = threading.Event()
+        self.load_error = None
+        self.input_channels = dict()  # network key -> number of input channels, set once networks are loaded
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.load_error is not None:
+            raise self.load_error
+
+    def submit(self, model, points, return_prob=False):
+        if model not in self.models:
+            raise KeyError('Unknown model: {}'.format(model))
+        points = np.asarray(points, dtype=np.float32)
+        if points.ndim != 2 or len(points) == 0:
+            raise ValueError('Expected a non-empty N x C array of points, got shape {}'.format(points.shape))
+        input_channels = self.input_channels[self.models[model][0]]
+        if points.shape[1] != input_channels:
+            raise ValueError('Model {} expects {} channels, got {}'.format(model, input_channels, points.shape[1]))
+        request = Request(model, points, return_prob)
+        self.queue.put(request)
+        return request.future
+
+    def _run(self):
+        import caffe
+        try:
+            if self.use_cpu:
+                caffe.set_mode_cpu()
+            else:
+                caffe.set_mode_gpu()
+                caffe.set_device(self.device)
+            resident = {k: ResidentNet(network, weights) for k, (network, weights) in self.nets.items()}
+            self.input_channels = {k: net.input_channels for k, net in resident.items()}
+        except Exception as e:
+            self.load_error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(requests) < self.batch_size * len(resident):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            groups = collections.OrderedDict()
+            for r in requests:
+                groups.setdefault(self.models[r.model][0], []).append(r)
+            for net_key, group in groups.items():
+                for b in range(0, len(group), self.batch_size):
+                    self._process(resident[net_key], group[b:b + self.batch_size])
+
+    def _process(self, net, requests):
+        try:
+            tic = time.time()
+            probs = net.forward([r.points for r in requests])
+            forward_time = time.time() - tic
+        except Exception as e:
+            self.stats.add_error(len(requests))
+            for r in requests:
+                r.future.set_exception(e)
+            return
+
+        for r, prob in zip(requests, probs):
+            class_slice = self.models[r.model][1]
+            if class_slice is not None:
+                prob = prob[:, class_slice]
+            result = dict(labels=prob.argmax(axis=1))
+            if r.return_prob:
+                result['prob'] = prob
+            r.future.set_result(result)
+        self.stats.add_batch(requests, forward_time)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict/<model>   body: {"points": [[f1, f2, ...], ...], "return_prob": false} or an .npy array
+                            response: {"labels": [...], "prob": [[...], ...]}
+    GET  /models            available model names
+    GET  /stats             latency and throughput counters
+    """
+    service = None
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.service.stats.summary())
+        elif self.path == '/models':
+            self._reply(200, sorted(self.service.models.keys()))
+        else:
+            self._reply(404, dict(error='Unknown path: {}'.format(self.path)))
+
+    def do_POST(self):
+        if not self.path.startswith('/predict/'):
+            self._reply(404, dict(error='Unknown path: {}'.format(self.path)))
+            return
+        model = self.path[len('/predict/'):]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if model not in self.service.models:
+            self._reply(404, dict(error='Unknown model: {}'.format(model)))
+            return
+        try:
+            if self.headers.get('Content-Type') == 'application/x-npy':
+                points, return_prob = np.load(io.BytesIO(body), allow_pickle=False), False
+            else:
+                request = json.loads(body.decode())
+                if not isinstance(request, dict) or 'points' not in request:
+                    raise ValueError('Missing "points" in request body')
+                points, return_prob = request['points'], request.get('return_prob', False)
+            future = self.service.submit(model, points, return_prob)
+        except ValueError as e:  # also malformed json and .npy
+            self._reply(400, dict(error=str(e)))
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self._reply(500, dict(error=str(e)))
+            return
+        self._reply(200, {k: v.tolist() for k, v in result.items()})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def partseg_models(exp_dir, categories, single_model=False):
+    """
+    Locate deploy networks and weights of a part segmentation experiment (same layout as partseg3d/test.py)
+    :return: models, nets (see InferenceService)
+    """
+    models, nets = dict(), dict()
+    for category in categories:
+        category_id = splatnet.configs.SN_CATEGORY_NAMES.index(category)
+        if single_model:
+            offset = sum(splatnet.configs.SN_NUM_PART_CATEGORIES[:category_id])
+            num_parts = splatnet.configs.SN_NUM_PART_CATEGORIES[category_id]
+            nets['single'] = (os.path.join(exp_dir, 'net_deploy.prototxt'), os.path.join(exp_dir, 'snapshot.caffemodel'))
+            models[category] = ('single', slice(offset, offset + num_parts))
+        else:
+            nets[category] = (os.path.join(exp_dir, '{}_net_deploy.prototxt'.format(category)),
+                              os.path.join(exp_dir, '{}.caffemodel'.format(category)))
+            models[category] = (category, None)
+    return models, nets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve trained segmentation networks over local HTTP',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--exp_dir', default=None, type=str, help='a part segmentation experiment folder')
+    parser.add_argument('--categories', nargs='+', help='pick some categories, otherwise serve all')
+    parser.add_argument('--single_model', action='store_true', help='if True, use a single model across all categories')
+    parser.add_argument('--network', default=None, type=str, help='a .prototxt file; overwrites \'--exp_dir\'')
+    parser.add_argument('--weights', default=None, type=str, help='a .caffemodel file, together with \'--network\'')
+    parser.add_argument('--name', default='default', type=str, help='model name, together with \'--network\'')
+    parser.add_argument('--host', default='127.0.0.1', type=str, help='address to bind')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on')
+    parser.add_argument('--batch_size', default=16, type=int, help='max number of point clouds per forward')
+    parser.add_argument('--max_wait', default=5.0, type=float, help='max time (ms) to wait for filling a batch')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    parser.add_argument('--device', default=0, type=int, help='gpu device id')
+    args = parser.parse_args()
+
+    if args.network:
+        models, nets = {args.name: (args.name, None)}, {args.name: (args.network, args.weights)}
+    else:
+        categories = args.categories if args.categories else splatnet.configs.SN_CATEGORY_NAMES
+        models, nets = partseg_models(args.exp_dir, categories, args.single_model)
+
+    RequestHandler.service = InferenceService(models, nets, args.batch_size, args.max_wait / 1000.0,
+                                              args.cpu, args.device)
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print('Serving {} model(s) at http://{}:{}'.format(len(models), args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -2,6 +2,7 @@
 Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
 Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 """
+import os
 import time
 import tempfile
 import numpy as np
@@ -39,6 +40,69 @@ def map_channel_scale(channel_scale_str, refs):
     return '_'.join([str(f) + s for f, s in zip([np.where([i == v for v in refs])[0][0] for i in channels], scales)])
 
 
+class ColumnStore:
+    """
+    A list of per-sample feature arrays (N_i x C) with named columns, loaded once.
+    Projections to different columns and scales are obtained through view() and share the same data.
+    """
+    def __init__(self, arrays, columns):
+        self.arrays = arrays
+        self.columns = columns.split('_') if type(columns) == str else list(columns)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __getitem__(self, i):
+        return self.arrays[i]
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def view(self, dims):
+        return ColumnView(self, dims)
+
+
+class ColumnView:
+    """
+    A lightweight projection of a ColumnStore, e.g. 'x*64_y*64_z*64' (same syntax as parse_channel_scale).
+    'one' is a constant column. Samples are materialized on access: plain slices of the stored arrays if
+    the columns are contiguous and unscaled, otherwise a new array filled column by column.
+    """
+    def __init__(self, store, dims):
+        names, scales = parse_channel_scale(dims, channel_str=True)
+        self.store = store
+        self.dims = dims
+        self.idxs = [-1 if f == 'one' else store.columns.index(f) for f in names]
+        self.scales = scales
+        if min(self.idxs) >= 0 and all(s == 1.0 for s in scales) \
+                and self.idxs == list(range(self.idxs[0], self.idxs[0] + len(self.idxs))):
+            self.cols = slice(self.idxs[0], self.idxs[0] + len(self.idxs))
+        else:
+            self.cols = None
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        if type(i) == slice:
+            return [self[j] for j in range(*i.indices(len(self)))]
+        data = self.store.arrays[i]
+        if self.cols is not None:
+            return data[:, self.cols]
+        out = np.empty((len(data), len(self.idxs)), dtype=data.dtype)
+        for j, (k, s) in enumerate(zip(self.idxs, self.scales)):
+            if k < 0:
+                out[:, j] = 1
+            elif s == 1.0:
+                out[:, j] = data[:, k]
+            else:
+                np.multiply(data[:, k], s, out=out[:, j])
+        return out
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 def rotate_3d(xyz, rotations, center=(0, 0, 0)):
     """
     Apply rotations to 3d points.
@@ -108,6 +172,157 @@ def modify_blob_shape(net_path, tops, blob_size):
     return f.name
 
 
+def reshape_net_inputs(net, tops, batch_size, sample_size):
+    """
+    Reshape input blobs of a loaded network in place (the counterpart of modify_blob_shape for resident networks)
+    """
+    for top in tops:
+        blob = net.blobs[top]
+        blob.reshape(batch_size, blob.data.shape[1], blob.data.shape[2], sample_size)
+    net.reshape()
+
+
+def ply_header(path):
+    """
+    Parse the header of an ascii .ply file with a single vertex element
+    :return: number of vertices, names of vertex properties, number of header lines
+    """
+    num_vertices, props = 0, []
+    with open(path) as f:
+        for i, l in enumerate(f):
+            v = l.split()
+            if v and v[0] == 'element' and v[1] == 'vertex':
+                num_vertices = int(v[2])
+            elif v and v[0] == 'property':
+                props.append(v[-1])
+            elif v and v[0] == 'format' and v[1] != 'ascii':
+                raise ValueError('Only ascii .ply files are supported: {}'.format(path))
+            elif l.strip() == 'end_header':
+                return num_vertices, props, i + 1
+    raise ValueError('Invalid .ply file: {}'.format(path))
+
+
+def pad_indices(k, sample_size):
+    """
+    Indices that pad (or subsample) k points to sample_size: all points are repeated, the remainder is random.
+    """
+    return np.concatenate((np.tile(np.arange(k), (sample_size // k, )),
+                           np.random.permutation(k)[:(sample_size % k)]), axis=0)
+
+
+def unique_rows(data):
+    """
+    :param data: N x C ndarray
+    :return: distinct rows, index of first occurrence of each, and index of the distinct row for each input row
+    """
+    uniq, first_idx, inverse = np.unique(data, axis=0, return_index=True, return_inverse=True)
+    return uniq, first_idx, inverse.reshape(-1)
+
+
+def scatter_mean(values, idx, n):
+    """
+    Average rows of values that map to the same index
+    :param values: N x C ndarray
+    :param idx: N indices in [0, n)
+    :return: n x C ndarray (zeros where nothing maps to)
+    """
+    out = np.zeros((n,) + values.shape[1:], dtype=values.dtype)
+    np.add.at(out, idx, values)
+    cnt = np.bincount(idx, minlength=n).reshape((n,) + (1,) * (values.ndim - 1))
+    np.divide(out, np.maximum(cnt, 1), out=out)
+    return out
+
+
+class ProbReducer:
+    """
+    Reduces per-point class scores right after each forward, so that only O(points) values are retained.
+    :param class_range: optionally, (offset, n) -- when the network predicts more than n classes (e.g. a model shared
+                        across categories), only classes [offset, offset + n) are considered and labels are relative
+    :param top_k: if positive, also keep the k best classes ('topk_label') and their scores ('topk_prob', float16)
+    :param keep_prob: if True, also keep all (restricted) scores as float16 ('prob')
+    """
+    def __init__(self, class_range=None, top_k=0, keep_prob=False):
+        self.class_range = class_range
+        self.top_k = top_k
+        self.keep_prob = keep_prob
+
+    def __call__(self, prob):
+        """
+        :param prob: N x C ndarray
+        :return: a dict with 'label' (N) and, optionally, 'prob', 'topk_label', 'topk_prob'
+        """
+        if self.class_range is not None and prob.shape[1] > self.class_range[1]:
+            prob = prob[:, self.class_range[0]:self.class_range[0] + self.class_range[1]]
+        label_type = np.min_scalar_type(prob.shape[1] - 1)
+        out = dict(label=prob.argmax(axis=1).astype(label_type))
+        if self.keep_prob:
+            out['prob'] = prob.astype(np.float16)
+        if self.top_k > 0:
+            k = min(self.top_k, prob.shape[1])
+            idx = np.argpartition(-prob, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(prob, idx, axis=1)
+            order = np.argsort(-top, axis=1)
+            out['topk_label'] = np.take_along_axis(idx, order, axis=1).astype(label_type)
+            out['topk_prob'] = np.take_along_axis(top, order, axis=1).astype(np.float16)
+        return out
+
+
+def save_label_ply(save_path, xyz, labels, cmap, norms=None):
+    """
+    Write a labeled point cloud as an ascii .ply file, with labels encoded as rgb colors
+    :param save_path: path to the output .ply file
+    :param xyz: N x 3 ndarray
+    :param labels: N integer labels
+    :param cmap: a color map, one rgb triplet per label
+    :param norms: optionally, N x 3 ndarray of normals
+    :return: save_path
+    """
+    colors = np.asarray(cmap)[np.asarray(labels, dtype=int)]
+    if norms is None:
+        out = np.concatenate((xyz, colors), axis=1)
+        props = ('x', 'y', 'z')
+        fmt = '%.6f %.6f %.6f %d %d %d'
+    else:
+        out = np.concatenate((xyz, norms, colors), axis=1)
+        props = ('x', 'y', 'z', 'nx', 'ny', 'nz')
+        fmt = '%.6f %.6f %.6f %.6f %.6f %.6f %d %d %d'
+    header = '\n'.join(['ply', 'format ascii 1.0', 'element vertex {}'.format(len(out))]
+                       + ['property float {}'.format(p) for p in props]
+                       + ['property uchar diffuse_{}'.format(c) for c in ('red', 'green', 'blue')]
+                       + ['end_header'])
+    np.savetxt(save_path, out, fmt=fmt, header=header, comments='')
+    return save_path
+
+
+# part of the training data read by data layers of this process, as (rank, number of shards)
+_data_shard = (0, 1)
+
+
+def set_data_shard(rank, num_shards):
+    """
+    Make training data layers set up afterwards in this process read only one of num_shards disjoint parts of the data
+    (for data-parallel training, see create_solver.run_parallel)
+    """
+    global _data_shard
+    _data_shard = (rank, num_shards)
+
+
+def data_shard():
+    return _data_shard
+
+
+def current_rss():
+    """
+    :return: resident set size of this process (bytes), or its peak where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 class TimedBlock:
     """
     Context manager that times the execution of a block of code.
@@ -127,31 +342,72 @@ class TimedBlock:
             print(' done! ({:.2f} secs)'.format(toc - self.tic))
 
 
+def confusion_matrix(pred, gt, num_classes):
+    """
+    :param pred: N integer labels in [0, num_classes)
+    :param gt: N integer labels in [0, num_classes)
+    :return: num_classes x num_classes ndarray, rows are ground-truth and columns are predictions
+    """
+    idx = np.asarray(gt, dtype=np.int64) * num_classes + np.asarray(pred, dtype=np.int64)
+    return np.bincount(idx, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def segmented_confusion_matrix(pred_list, gt_list, num_classes):
+    """
+    Confusion matrices of a ragged batch of samples, with a single bincount
+    :return: K x num_classes x num_classes ndarray, one matrix per sample
+    """
+    sizes = [len(gt) for gt in gt_list]
+    seg = np.repeat(np.arange(len(sizes), dtype=np.int64), sizes)
+    idx = (seg * num_classes + np.concatenate(gt_list).astype(np.int64)) * num_classes \
+        + np.concatenate(pred_list).astype(np.int64)
+    cc = num_classes * num_classes
+    return np.bincount(idx, minlength=len(sizes) * cc).reshape(len(sizes), num_classes, num_classes)
+
+
+def present_label_confusion(pred_list, gt_list):
+    """
+    Per-sample confusion matrices over the labels present in ground-truth, for arbitrary integer label values
+    (no sorting involved -- labels are offset to start at 0, and unused rows/columns are dropped)
+    :return: labels present in ground-truth, K x L x L ndarray
+    """
+    gts = [np.asarray(gt).reshape(-1).astype(np.int64) for gt in gt_list]
+    preds = [np.asarray(pred).reshape(-1).astype(np.int64) for pred in pred_list]
+    lo = min(min(v.min() for v in gts), min(v.min() for v in preds))
+    hi = max(max(v.max() for v in gts), max(v.max() for v in preds))
+    conf = segmented_confusion_matrix([v - lo for v in preds], [v - lo for v in gts], hi - lo + 1)
+    present = conf.sum(axis=(0, 2)) > 0
+    assert not np.any(conf.sum(axis=(0, 1))[~present]), 'Predicted labels that are not in ground-truth'
+    return np.flatnonzero(present) + lo, conf[:, present][:, :, present]
+
+
+def confusion_scores(conf, eps=0.0):
+    """
+    Metrics derived from (a stack of) confusion matrices
+    :param conf: ... x C x C ndarray, rows are ground-truth and columns are predictions
+    :param eps: smoothing added to numerators and denominators of per-class scores
+    :return: a dict with accuracy, class_accuracy, class_iou (per class) and num_points (ground-truth count per class)
+    """
+    tp = np.diagonal(conf, axis1=-2, axis2=-1).astype(np.float64)
+    num_gt = conf.sum(axis=-1)
+    num_pred = conf.sum(axis=-2)
+    return dict(accuracy=tp.sum(axis=-1) / num_gt.sum(axis=-1),
+                class_accuracy=(tp + eps) / (num_gt + eps),
+                class_iou=(tp + eps) / (num_gt + num_pred - tp + eps),
+                num_points=num_gt)
+
+
 def seg_scores(pred_list, gt_list, nclasses=-1):
 
     eps = 0.0001
 
-    labels = np.unique(np.concatenate([np.unique(gt) for gt in gt_list]))
+    labels, conf = present_label_confusion(pred_list, gt_list)
     if nclasses != -1:
         assert len(labels) == nclasses
 
-    acc, avg_class_acc, avg_class_iou = [], [], []
-    for pred, gt in zip(pred_list, gt_list):
-        pred, gt = np.array(pred), np.array(gt)
-        assert np.all([(v in labels) for v in np.unique(pred)])
-
-        tp, fp, fn = [], [], []
-        for l in labels:
-            tp.append(sum((gt == l) * (pred == l)))
-            fp.append(sum((gt != l) * (pred == l)))
-            fn.append(sum((gt == l) * (pred != l)))
-
-        class_acc = [(tp[i] + eps) / (tp[i] + fn[i] + eps) for i in range(len(labels))]
-        class_iou = [(tp[i] + eps) / (tp[i] + fn[i] + fp[i] + eps) for i in range(len(labels))]
-
-        acc.append(sum(gt == pred) / len(gt))
-        avg_class_acc.append(sum(class_acc) / len(labels))
-        avg_class_iou.append(sum(class_iou) / len(labels))
+    scores = confusion_scores(conf, eps=eps)
+    acc = scores['accuracy'].tolist()
+    avg_class_acc = scores['class_accuracy'].mean(axis=1).tolist()
+    avg_class_iou = scores['class_iou'].mean(axis=1).tolist()
 
     return acc, avg_class_acc, avg_class_iou
-
@@ -0,0 +1,71 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('caffe.proto')
+from splatnet.create_solver import sync_replicas
+
+
+class Blob(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class Net(object):
+    def __init__(self, rng):
+        self.params = {'fc': [Blob(rng.rand(3, 2).astype(np.float32)), Blob(rng.rand(3).astype(np.float32))]}
+
+
+class Solver(object):
+    """
+    Stands in for caffe's Solver: step() moves parameters towards a per-replica target, snapshot() saves them
+    """
+    def __init__(self, rank):
+        self.net = Net(np.random.RandomState(rank))
+        self.iter = 0
+        self.target = float(rank)
+        self.snapshots = dict()
+
+    def step(self):
+        for b in self.net.params['fc']:
+            b.data -= 0.5 * (b.data - self.target)
+        self.iter += 1
+
+    def snapshot(self):
+        self.snapshots[self.iter] = [b.data.copy() for b in self.net.params['fc']]
+
+
+def test_snapshots_hold_averaged_params():
+    num_workers, num_iters, snapshot = 3, 4, 2
+    solvers = [Solver(rank) for rank in range(num_workers)]
+    num_params = sum(b.data.size for b in solvers[0].net.params['fc'])
+    shared = np.zeros((num_workers, num_params), dtype=np.float32)
+    barrier = threading.Barrier(num_workers)
+    replicas = [dict() for _ in range(num_workers)]  # iteration -> parameters before averaging
+
+    def worker(rank):
+        solver = solvers[rank]
+        for _ in range(num_iters):
+            solver.step()
+            replicas[rank][solver.iter] = [b.data.copy() for b in solver.net.params['fc']]
+            sync_replicas(solver, shared, rank, barrier, snapshot)
+
+    threads = [threading.Thread(target=worker, args=(rank,)) for rank in range(num_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(solvers[0].snapshots) == [2, 4]
+    assert not any(s.snapshots for s in solvers[1:])
+    for it, saved in solvers[0].snapshots.items():
+        for i, data in enumerate(saved):
+            assert np.allclose(data, np.mean([r[it][i] for r in replicas], axis=0))
+            assert not np.allclose(data, replicas[0][it][i])
+    for s in solvers[1:]:  # replicas agree after averaging
+        for a, b in zip(s.net.params['fc'], solvers[0].net.params['fc']):
+            assert np.array_equal(a.data, b.data)
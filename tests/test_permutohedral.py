@@ -0,0 +1,116 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import numpy as np
+import pytest
+
+from splatnet.permutohedral import Lattice, elevate, enclosing_simplices, filter_offsets, num_filter_taps, \
+    build_lattices, brute_force_gaussian
+
+# The lattice Gaussian filter approximates a Gaussian with unit standard deviation. With points dense relative to the
+# kernel (2000 points in [0, 4]^d), it should correlate with the exact filter at least this much, and differ from it
+# by at most this fraction of the mean absolute deviation of the exact output.
+GAUSSIAN_MIN_CORR = 0.95
+GAUSSIAN_MAX_REL_ERR = 0.3
+
+
+def random_cloud(num_points=2000, dims=3, extent=4.0, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.rand(num_points, dims) * extent, rng.rand(num_points, 2)
+
+
+def test_enclosing_simplices_exact():
+    # barycentric weights (0.5, 0.3, 0.2) in the canonical simplex of the 2d lattice, whose vertices are (0, 0, 0),
+    # (1, 1, -2) and (2, -1, -1), then in the simplex translated by (3, -3, 0) and in the one with permuted axes
+    elevated = np.array([[0.7, 0.1, -0.8], [3.7, -2.9, -0.8], [0.1, 0.7, -0.8]])
+    keys, bary = enclosing_simplices(elevated)
+    assert np.array_equal(keys, [[[0, 0], [1, 1], [2, -1]], [[3, -3], [4, -2], [5, -4]], [[0, 0], [1, 1], [-1, 2]]])
+    assert np.allclose(bary, [[0.5, 0.3, 0.2]] * 3, rtol=0, atol=1e-12)
+
+    lattice = Lattice(elevated)
+    splatted = lattice.splat(np.array([[1.0], [10.0], [100.0]]))
+    expected = {(0, 0): 50.5, (1, 1): 30.3, (2, -1): 0.2, (-1, 2): 20.0, (3, -3): 5.0, (4, -2): 3.0, (5, -4): 2.0}
+    assert lattice.num_vertices == len(expected)
+    for key, v in expected.items():
+        assert np.isclose(splatted[lattice.lookup(np.array(key)), 0], v, rtol=0, atol=1e-12)
+
+
+def test_filter_exact():
+    # 1d lattice: elevated points (t, -t) lie between lattice points k and k + 1 at weights (k + 1 - t, t - k)
+    lattice = Lattice(np.array([[0.25, -0.25], [1.5, -1.5]]))
+    values = np.array([[4.0], [2.0]])
+    assert np.array_equal(lattice.keys.ravel(), [0, 1, 2])
+    assert np.allclose(lattice.splat(values).ravel(), [3, 2, 1], rtol=0, atol=1e-12)
+
+    # [1 2 1] / 4 along both lattice directions (which are +1 and -1 in 1d): [3 2 1] -> [2 2 1] -> [1.5 1.75 1]
+    assert np.allclose(lattice.gaussian_blur(lattice.splat(values)).ravel(), [1.5, 1.75, 1], rtol=0, atol=1e-12)
+    # sliced: [0.75 * 1.5 + 0.25 * 1.75, 0.5 * 1.75 + 0.5 * 1], normalized by the same for unit values (plus 1e-10)
+    assert np.allclose(lattice.filter(values).ravel(), [1.5625 / 0.48828125, 1.375 / 0.4921875], rtol=1e-9, atol=0)
+
+    # taps are the vertex, k - 1 and k + 1: [3 2 1] -> [3 + 3 * 2, 2 + 2 * 3 + 3 * 1, 1 + 2 * 2] = [9 11 5]
+    assert np.array_equal(filter_offsets(1).ravel(), [0, -1, 1])
+    out = lattice.filter(values, np.array([[[1.0, 2.0, 3.0]]]), bias=np.array([1.0]), normalize=False)
+    assert np.allclose(out.ravel(), [0.75 * 9 + 0.25 * 11 + 1, 0.5 * 11 + 0.5 * 5 + 1], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('dims', [1, 2, 3, 5])
+def test_enclosing_simplices(dims):
+    positions, _ = random_cloud(500, dims, extent=10.0)
+    elevated = elevate(positions)
+    keys, bary = enclosing_simplices(elevated)
+
+    assert np.allclose(elevated.sum(axis=1), 0)
+    assert np.all(bary >= -1e-9)
+    assert np.allclose(bary.sum(axis=1), 1)
+    full_keys = np.concatenate((keys, -keys.sum(axis=2, keepdims=True)), axis=2)
+    assert np.all((full_keys - full_keys[:, :, :1]) % (dims + 1) == 0)  # coordinates of a lattice point agree mod d+1
+    assert np.allclose(np.einsum('nr,nrk->nk', bary, full_keys), elevated)
+
+
+@pytest.mark.parametrize('dims,neighborhood_size', [(2, 1), (3, 1), (3, 2), (5, 1)])
+def test_neighbors(dims, neighborhood_size):
+    positions, _ = random_cloud(1000, dims)
+    lattice = Lattice.from_positions(positions, 2.0)
+    offsets = filter_offsets(dims, neighborhood_size)
+    assert len(offsets) == num_filter_taps(dims, neighborhood_size)
+    assert not np.any(offsets[0])
+
+    vertex = {tuple(k): i for i, k in enumerate(lattice.keys)}
+    expected = [[vertex.get(tuple(k + o), -1) for o in offsets] for k in lattice.keys]
+    assert np.array_equal(lattice.neighbors(neighborhood_size), np.array(expected))
+
+
+@pytest.mark.parametrize('dims', [2, 3])
+def test_center_tap(dims):
+    positions, values = random_cloud(1000, dims)
+    lattice = Lattice.from_positions(positions)
+    weights = np.zeros((2, 2, num_filter_taps(dims)))
+    weights[:, :, 0] = np.eye(2)
+    out = lattice.filter(values, weights, normalize=False)
+    assert np.allclose(out, lattice.slice(lattice.splat(values)))
+
+
+def test_splat_slice_constant():
+    positions, _ = random_cloud(1000, 3)
+    lattice = Lattice.from_positions(positions)
+    assert np.isclose(lattice.splat(np.ones((1000, 1))).sum(), 1000)
+    assert np.allclose(lattice.filter(np.full((1000, 1), 3.0)), 3.0)
+
+
+@pytest.mark.parametrize('dims', [2, 3, 5])
+def test_gaussian_parity(dims):
+    positions, values = random_cloud(2000, dims)
+    out = Lattice.from_positions(positions).filter(values)
+    ref = brute_force_gaussian(positions, values)
+    assert np.corrcoef(out.ravel(), ref.ravel())[0, 1] > GAUSSIAN_MIN_CORR
+    assert np.abs(out - ref).mean() / np.abs(ref - ref.mean()).mean() < GAUSSIAN_MAX_REL_ERR
+
+
+def test_build_lattices_matches_single_scale():
+    positions, _ = random_cloud(1000, 3)
+    for scale, lattice in zip((1.0, 2.0, 4.0), build_lattices(positions, (1.0, 2.0, 4.0))):
+        single = Lattice.from_positions(positions, scale)
+        assert np.array_equal(lattice.codes, single.codes)
+        assert np.array_equal(lattice.ids, single.ids)
+        assert np.allclose(lattice.bary, single.bary)
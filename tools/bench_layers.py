@@ -0,0 +1,86 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import time
+import argparse
+import numpy as np
+import caffe
+from caffe import layers as L
+
+import splatnet.configs  # makes custom_layers importable by caffe
+from splatnet.utils import get_prototxt
+
+
+def layer_net(layer, bottom_shapes, param_str='', loss=False):
+    """
+    A tiny network with one Python layer from custom_layers, fed by Input layers
+    :return: path to a temporary .prototxt
+    """
+    n = caffe.NetSpec()
+    bottoms = []
+    for i, shape in enumerate(bottom_shapes):
+        n['in{}'.format(i)] = L.Input(shape=dict(dim=list(shape)))
+        bottoms.append(n['in{}'.format(i)])
+    n.out = L.Python(*bottoms, python_param=dict(module='custom_layers', layer=layer, param_str=param_str),
+                     loss_weight=1 if loss else 0)
+    net = n.to_proto()
+    net.force_backward = True  # inputs do not need gradients otherwise
+    return get_prototxt(net)
+
+
+def bench(net, repeat=100, warmup=5):
+    """
+    :return: average forward and backward time (ms)
+    """
+    for _ in range(warmup):
+        net.forward()
+        net.backward()
+    tic = time.time()
+    for _ in range(repeat):
+        net.forward()
+    toc = time.time()
+    for _ in range(repeat):
+        net.backward()
+    return (toc - tic) / repeat * 1000, (time.time() - toc) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time forward/backward of the custom Python layers',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch_size', default=32, type=int, help='batch size')
+    parser.add_argument('--sample_size', default=3000, type=int, help='number of points per sample')
+    parser.add_argument('--channels', default=64, type=int, help='number of feature channels')
+    parser.add_argument('--classes', default=50, type=int, help='number of classes')
+    parser.add_argument('--repeat', default=100, type=int, help='number of timed iterations')
+    parser.add_argument('--layers', nargs='+', help='pick some layers, otherwise time all')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    args = parser.parse_args()
+
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    bs, ss, nc, nk = args.batch_size, args.sample_size, args.channels, args.classes
+    configs = dict(GlobalPooling=([(bs, nc, 1, ss)], '', False),
+                   ProbRenorm=([(bs, nk, 1, ss), (bs, nk, 1, ss)], '', False),
+                   Permute=([(bs, nc, 1, ss)], '0_3_2_1', False),
+                   LossHelper=([(bs, nk, 1, ss)], '', False),
+                   LogLoss=([(bs, nk, 1, ss), (bs, 1, 1, ss)], '', True),
+                   PickAndScale=([(bs, 7, 1, ss)], '0*64_1*64_2*64_3_4_5_6', False))
+
+    print('{:14} {:>12} {:>12}'.format('layer', 'forward(ms)', 'backward(ms)'))
+    for layer in (args.layers if args.layers else configs.keys()):
+        shapes, param_str, loss = configs[layer]
+        net = caffe.Net(layer_net(layer, shapes, param_str, loss), caffe.TEST)
+        for i, shape in enumerate(shapes):
+            net.blobs['in{}'.format(i)].data[...] = np.random.rand(*shape)
+        if layer == 'ProbRenorm':
+            net.blobs['in1'].data[...] = np.random.rand(*shapes[1]) > 0.5
+        elif layer == 'LogLoss':
+            net.blobs['in0'].data[...] /= net.blobs['in0'].data.sum(axis=1, keepdims=True)
+            net.blobs['in1'].data[...] = np.random.randint(nk, size=shapes[1])
+        t_forward, t_backward = bench(net, args.repeat)
+        print('{:14} {:12.3f} {:12.3f}'.format(layer, t_forward, t_backward))
@@ -0,0 +1,138 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import sys
+import time
+import argparse
+import numpy as np
+
+from splatnet.permutohedral import Lattice, elevate, enclosing_simplices, filter_offsets, num_filter_taps, \
+    brute_force_gaussian
+
+
+# bounds on check_parity results: simplices, lookups and the learned filter agree with exact references up to
+# rounding, and the Gaussian approximation is as good as tests require (see tests/test_permutohedral.py), which holds
+# only for points dense relative to the kernel (the defaults)
+PARITY_TOLERANCE = dict(gaussian_corr=(0.95, None), gaussian_rel_err=(None, 0.3), neighbors_ok=(1, None),
+                        simplex_err=(None, 1e-9), center_tap_err=(None, 1e-9), filter_err=(None, 1e-9))
+
+
+def parity_failures(checks):
+    """
+    :return: names of checks outside PARITY_TOLERANCE
+    """
+    return [k for k, (lo, hi) in PARITY_TOLERANCE.items()
+            if (lo is not None and checks[k] < lo) or (hi is not None and checks[k] > hi)]
+
+
+def reference_filter(keys, bary, values, weights, offsets):
+    """
+    Learned filter without normalization, with a dict of vertex keys and explicit loops over points and taps
+    :param keys, bary: simplices of the points, see enclosing_simplices
+    :param offsets: filter taps, see filter_offsets
+    """
+    vertex = dict()
+    for k in keys.reshape(-1, keys.shape[2]):
+        vertex.setdefault(tuple(k), len(vertex))
+    splatted = np.zeros((len(vertex), values.shape[1]))
+    for i in range(len(keys)):
+        for k, b in zip(keys[i], bary[i]):
+            splatted[vertex[tuple(k)]] += b * values[i]
+    blurred = np.zeros((len(vertex), weights.shape[0]))
+    for k, j in vertex.items():
+        for t, o in enumerate(offsets):
+            if tuple(k + o) in vertex:
+                blurred[j] += weights[:, :, t].dot(splatted[vertex[tuple(k + o)]])
+    return np.array([sum(b * blurred[vertex[tuple(k)]] for k, b in zip(keys[i], bary[i])) for i in range(len(keys))])
+
+
+def check_parity(num_points=2000, dims=3, extent=4.0, neighborhood_size=1, seed=0):
+    """
+    :param extent: points are uniform in [0, extent]^dims, positions in units of the Gaussian's standard deviation
+    :return: a dict of checks:
+             gaussian_corr -- correlation of the lattice Gaussian filter with the brute-force one,
+             gaussian_rel_err -- their mean absolute difference relative to the mean absolute deviation of the latter,
+             neighbors_ok -- whether filter taps found by searchsorted match a dict lookup of vertex keys,
+             simplex_err -- difference between points and their barycentric combination of simplex vertices,
+             center_tap_err -- difference between a center-tap-only learned filter and splat + slice,
+             filter_err -- relative difference between a random learned filter and reference_filter
+    """
+    rng = np.random.RandomState(seed)
+    positions = rng.rand(num_points, dims) * extent
+    values = rng.rand(num_points, 1)
+    lattice = Lattice.from_positions(positions)
+
+    elevated = elevate(positions)
+    keys, bary = enclosing_simplices(elevated)
+    full_keys = np.concatenate((keys, -keys.sum(axis=2, keepdims=True)), axis=2)
+    offsets = filter_offsets(dims, neighborhood_size)
+    learned = rng.randn(2, 1, len(offsets))
+    filtered = lattice.filter(values, learned, neighborhood_size=neighborhood_size, normalize=False)
+    filtered_ref = reference_filter(keys, bary, values, learned, offsets)
+
+    out, ref = lattice.filter(values), brute_force_gaussian(positions, values)
+
+    vertex = {tuple(k): i for i, k in enumerate(lattice.keys)}
+    nbrs = [[vertex.get(tuple(k + o), -1) for o in offsets] for k in lattice.keys]
+
+    weights = np.zeros((1, 1, num_filter_taps(dims, neighborhood_size)))
+    weights[0, 0, 0] = 1
+    center = lattice.filter(values, weights, neighborhood_size=neighborhood_size, normalize=False)
+
+    return dict(gaussian_corr=np.corrcoef(out.ravel(), ref.ravel())[0, 1],
+                gaussian_rel_err=np.abs(out - ref).mean() / np.abs(ref - ref.mean()).mean(),
+                neighbors_ok=bool(np.all(lattice.neighbors(neighborhood_size) == np.array(nbrs))),
+                simplex_err=np.abs(np.einsum('nr,nrk->nk', bary, full_keys) - elevated).max(),
+                center_tap_err=np.abs(center - lattice.slice(lattice.splat(values))).max(),
+                filter_err=np.abs(filtered - filtered_ref).max() / np.abs(filtered_ref).max())
+
+
+def bench(num_points, scale, dims=3, channels=(64, 64), neighborhood_size=1, repeat=5):
+    """
+    Time a learned filter on random points in the unit cube, positions scaled as in lattice specs (e.g. x*64)
+    :return: number of lattice vertices, lattice build time and filter time (ms)
+    """
+    positions = np.random.rand(num_points, dims)
+    values = np.random.rand(num_points, channels[0])
+    weights = np.random.rand(channels[1], channels[0], num_filter_taps(dims, neighborhood_size))
+    t_build, t_filter = 0, 0
+    for _ in range(repeat):
+        tic = time.time()
+        lattice = Lattice.from_positions(positions, scale)
+        lattice.neighbors(neighborhood_size)
+        toc = time.time()
+        lattice.filter(values, weights, neighborhood_size=neighborhood_size)
+        t_build, t_filter = t_build + toc - tic, t_filter + time.time() - toc
+    return lattice.num_vertices, t_build / repeat * 1000, t_filter / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and time the NumPy permutohedral lattice',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num_points', nargs='+', type=int, default=[1000, 3000, 10000, 30000],
+                        help='point counts to time')
+    parser.add_argument('--scales', nargs='+', type=float, default=[8, 16, 32, 64], help='lattice scales to time')
+    parser.add_argument('--dims', default=3, type=int, help='lattice dimensions')
+    parser.add_argument('--channels', nargs=2, type=int, default=[64, 64], help='input and output channels')
+    parser.add_argument('--neighborhood_size', default=1, type=int, help='filter neighborhood size')
+    parser.add_argument('--repeat', default=5, type=int, help='number of timed iterations')
+    parser.add_argument('--skip_check', action='store_true', help='if True, skip the parity check')
+    args = parser.parse_args()
+
+    if not args.skip_check:
+        checks = check_parity(dims=args.dims, neighborhood_size=args.neighborhood_size)
+        print('Parity: ' + ', '.join('{}={:.4g}'.format(k, v) for k, v in checks.items()))
+        failures = parity_failures(checks)
+        if failures:
+            sys.exit('Parity check failed: {}'.format(', '.join(failures)))
+
+    print('{:>8} {:>7} {:>9} {:>10} {:>11} {:>11}'.format('points', 'scale', 'vertices', 'build(ms)', 'filter(ms)',
+                                                          'Mpoints/s'))
+    for num_points in args.num_points:
+        for scale in args.scales:
+            m, t_build, t_filter = bench(num_points, scale, args.dims, args.channels, args.neighborhood_size,
+                                         args.repeat)
+            print('{:8d} {:7g} {:9d} {:10.2f} {:11.2f} {:11.3f}'.format(
+                num_points, scale, m, t_build, t_filter, num_points / (t_build + t_filter) / 1000), flush=True)
+
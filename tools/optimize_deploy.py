@@ -0,0 +1,202 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import argparse
+import numpy as np
+import caffe
+from caffe.proto import caffe_pb2
+import google.protobuf.text_format as txtf
+
+import splatnet.configs  # makes custom_layers importable by caffe
+from splatnet.utils import parse_channel_scale
+
+LINEAR_TYPES = ('Convolution', 'Permutohedral')
+
+
+def load_net_param(path):
+    net = caffe_pb2.NetParameter()
+    with open(path) as f:
+        txtf.Merge(f.read(), net)
+    return net
+
+
+def consumers(net_param):
+    """
+    :return: a dict of blob name -> list of (layer, bottom index)
+    """
+    out = dict()
+    for layer in net_param.layer:
+        for i, b in enumerate(layer.bottom):
+            out.setdefault(b, []).append((layer, i))
+    return out
+
+
+def producer(net_param, blob):
+    """
+    :return: the last layer writing to blob (there can be several with in-place layers)
+    """
+    return [l for l in net_param.layer if blob in l.top][-1]
+
+
+def pick_and_scale(layer):
+    """
+    :return: list of (input channel, scale) of a PickAndScale layer, or None for other layers
+    """
+    if layer.type != 'Python' or layer.python_param.layer != 'PickAndScale':
+        return None
+    return list(zip(*parse_channel_scale(layer.python_param.param_str)))
+
+
+def remove_layer(net_param, layer):
+    for i, l in enumerate(net_param.layer):
+        if l.name == layer.name:
+            del net_param.layer[i]
+            return
+
+
+def fold_batchnorm(net_param, params):
+    """
+    Fold (inference-time) BatchNorm layers into the preceding Convolution/Permutohedral layer:
+    y = (W x + b - mean) / std  ==>  W' = W / std, b' = (b - mean) / std
+    (weights of both layer types are laid out as output channels x input channels x ...)
+    :return: number of folded layers
+    """
+    cnt = 0
+    for bn in [l for l in net_param.layer if l.type == 'BatchNorm']:
+        prev = producer(net_param, bn.bottom[0])
+        if prev.type not in LINEAR_TYPES or len(consumers(net_param)[bn.bottom[0]]) != 1 \
+                or not params.get(prev.name) or len(params[prev.name]) < 2:
+            continue
+        mean, var, scale_factor = params[bn.name]
+        sf = 0 if scale_factor.flat[0] == 0 else 1.0 / scale_factor.flat[0]
+        inv_std = 1.0 / np.sqrt(var.reshape(-1) * sf + bn.batch_norm_param.eps)
+        w, b = params[prev.name][:2]
+        w *= inv_std.reshape((-1,) + (1,) * (w.ndim - 1))
+        b.reshape(-1)[...] = (b.reshape(-1) - mean.reshape(-1) * sf) * inv_std
+
+        # the linear layer now writes to the output blob of BatchNorm
+        prev.top[list(prev.top).index(bn.bottom[0])] = bn.top[0]
+        remove_layer(net_param, bn)
+        del params[bn.name]
+        cnt += 1
+    return cnt
+
+
+def fold_input_scaling(net_param, params):
+    """
+    Fold a PickAndScale layer on the network input into the weights of the linear layers that take it as features
+    (these layers are linear in their input channels, along axis 1 of the weights)
+    :return: number of folded layers
+    """
+    cnt = 0
+    for pick in [l for l in net_param.layer if pick_and_scale(l) is not None]:
+        users = consumers(net_param).get(pick.top[0], [])
+        if not users or not all(l.type in LINEAR_TYPES and i == 0 for l, i in users):
+            continue
+        num_in = num_input_channels(net_param, pick.bottom[0])
+        for l, _ in users:
+            w = params[l.name][0]
+            w_new = np.zeros((w.shape[0], num_in) + w.shape[2:], dtype=w.dtype)
+            for i, (j, s) in enumerate(pick_and_scale(pick)):
+                w_new[:, j] += w[:, i] * s
+            params[l.name][0] = w_new
+            l.bottom[0] = pick.bottom[0]
+        remove_layer(net_param, pick)
+        cnt += 1
+    return cnt
+
+
+def replace_lattice_scaling(net_param, params):
+    """
+    Replace the remaining PickAndScale layers (lattice positions) with native 1x1 convolutions
+    :return: number of replaced layers
+    """
+    cnt = 0
+    for pick in [l for l in net_param.layer if pick_and_scale(l) is not None]:
+        dims = pick_and_scale(pick)
+        w = np.zeros((len(dims), num_input_channels(net_param, pick.bottom[0]), 1, 1), dtype=np.float32)
+        for i, (j, s) in enumerate(dims):
+            w[i, j] = s
+        pick.type = 'Convolution'
+        pick.ClearField('python_param')
+        pick.convolution_param.num_output = len(dims)
+        pick.convolution_param.kernel_size.append(1)
+        pick.convolution_param.bias_term = False
+        params[pick.name] = [w]
+        cnt += 1
+    return cnt
+
+
+def num_input_channels(net_param, blob):
+    layer = producer(net_param, blob)
+    assert layer.type == 'Input', 'Only network inputs are supported: {}'.format(blob)
+    return layer.input_param.shape[list(layer.top).index(blob)].dim[1]
+
+
+def optimize(network, weights, out_network, out_weights):
+    """
+    :return: a dict of optimization -> number of affected layers
+    """
+    net_param = load_net_param(network)
+    net = caffe.Net(network, weights, caffe.TEST)
+    params = {k: [b.data.copy() for b in v] for k, v in net.params.items()}
+
+    stats = dict(batchnorm=fold_batchnorm(net_param, params),
+                 input_scaling=fold_input_scaling(net_param, params),
+                 lattice_scaling=replace_lattice_scaling(net_param, params))
+
+    with open(out_network, 'w') as f:
+        f.write(str(net_param))
+    net_new = caffe.Net(out_network, caffe.TEST)
+    for name, blobs in params.items():
+        for blob, v in zip(net_new.params[name], blobs):
+            blob.data[...] = v.reshape(blob.data.shape)
+    net_new.save(out_weights)
+
+    return stats
+
+
+def check(network, weights, out_network, out_weights, data=None, out_name='prob'):
+    """
+    Run both networks on the same input
+    :param data: input array, or None for random points in [-1, 1]
+    :return: max absolute difference of outputs
+    """
+    outs = []
+    for net_path, weights_path in ((network, weights), (out_network, out_weights)):
+        net = caffe.Net(net_path, weights_path, caffe.TEST)
+        if data is None:
+            data = np.random.uniform(-1, 1, net.blobs['data'].data.shape)
+        net.blobs['data'].data[...] = data
+        net.forward()
+        outs.append(net.blobs[out_name].data.copy())
+    return np.abs(outs[0] - outs[1]).max()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold BatchNorm and input scaling of a deploy network',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('network', help='a deploy .prototxt file')
+    parser.add_argument('weights', help='a .caffemodel file')
+    parser.add_argument('out_network', help='optimized .prototxt file')
+    parser.add_argument('out_weights', help='optimized .caffemodel file')
+    parser.add_argument('--check', action='store_true', help='if True, compare outputs of both networks')
+    parser.add_argument('--check_data', default=None, type=str, help='an .npy input for the check (default: random)')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    args = parser.parse_args()
+
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    stats = optimize(args.network, args.weights, args.out_network, args.out_weights)
+    print('Folded {batchnorm} BatchNorm layer(s), {input_scaling} input scaling layer(s); '
+          'replaced {lattice_scaling} lattice scaling layer(s)'.format(**stats))
+
+    if args.check:
+        data = np.load(args.check_data) if args.check_data else None
+        print('Max abs difference of outputs: {:g}'.format(check(args.network, args.weights,
+                                                                 args.out_network, args.out_weights, data)))
@@ -6,23 +6,8 @@ import os
 import sys
 import glob
 import shutil
-import subprocess
 import numpy as np
-
-
-def parse_and_plot(path, skip_train=100, skip_test=10, caffe_root=None):
-
-    if not caffe_root:
-        import caffe
-        caffe_root = os.path.join(os.path.dirname(caffe.__file__), '..', '..')
-
-    parser_path = os.path.join(caffe_root, 'tools/extra/parse_log.py')
-    subprocess.run('python2 {} {} {}'.format(parser_path, path, os.path.dirname(path)).split(' '))
-
-    stats_train = np.loadtxt(path + '.train', delimiter=',', skiprows=1)
-    stats_test = np.loadtxt(path + '.test', delimiter=',', skiprows=1)
-
-    return stats_train, stats_test
+from splatnet import caffe_log
 
 
 def copy_best_model(exp_dir, categories, pick_rule='best_loss'):
@@ -37,11 +22,11 @@ def copy_best_model(exp_dir, categories, pick_rule='best_loss'):
         if pick_rule == 'last':
             snap_iter = max(iters_avail)
         elif pick_rule == 'best_acc':
-            _, stats_val = parse_and_plot(log, skip_train=0, skip_test=0)
+            _, stats_val = caffe_log.load(log).test_stats()
             iter_acc = dict(zip(stats_val[:, 0], stats_val[:, -2]))
             snap_iter = iters_avail[np.argmax([iter_acc[v] for v in iters_avail])]
         elif pick_rule == 'best_loss':
-            _, stats_val = parse_and_plot(log, skip_train=0, skip_test=0)
+            _, stats_val = caffe_log.load(log).test_stats()
             iter_loss = dict(zip(stats_val[:, 0], stats_val[:, -1]))
             snap_iter = iters_avail[np.argmin([iter_loss[v] for v in iters_avail])]
         elif pick_rule.isdigit():
@@ -0,0 +1,116 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import json
+import argparse
+import numpy as np
+
+import splatnet.configs
+from splatnet.permutohedral import lattices_from_dims, filter_cost
+from splatnet.utils import map_channel_scale, pad_indices
+
+
+def load_samples(dataset, input_dims, num_samples=100, sample_size=3000, categories=None, subset='train',
+                 dataset_params=None):
+    """
+    :return: list of sample_size x C arrays, sampled as the training data layers do (shapes for shapenet,
+             consecutive points ordered by height for facade)
+    """
+    params = {k: v for k, v in (dataset_params or {}).items() if k == 'root'}
+    if dataset == 'shapenet':
+        import splatnet.dataset.dataset_shapenet as shapenet
+        if categories:
+            shapes = [v for c in categories
+                      for v in shapenet.points_single_category(subset, category=c, dims=input_dims, **params)[0]]
+        else:
+            shapes = shapenet.points_all_categories(subset, dims=input_dims, **params)[0]
+        picked = np.linspace(0, len(shapes) - 1, min(num_samples, len(shapes))).astype(int)
+        return [shapes[i][pad_indices(len(shapes[i]), sample_size)] for i in picked]
+    elif dataset == 'facade':
+        import splatnet.dataset.dataset_facade as facade
+        data = facade.ordered_points(subset, dims=input_dims, **params)[0]
+        starts = np.linspace(0, len(data) - sample_size, min(num_samples, len(data) // sample_size)).astype(int)
+        return [data[s:s + sample_size] for s in starts]
+    else:
+        raise ValueError('Unsupported dataset: {}'.format(dataset))
+
+
+def profile_lattice(samples, lattice_dims_strs, input_dims, channels=(64, 64), neighborhood_size=1):
+    """
+    :param lattice_dims_strs: list of lattice specs over input_dims, e.g. 'x*64_y*64_z*64'
+    :return: list of dicts, one per (spec, sample): number of points and occupied vertices, points per vertex,
+             fraction of filter taps that land on occupied vertices, and estimated filter FLOPs and bytes
+             for one layer with the given input/output channels
+    """
+    specs = [map_channel_scale(s, input_dims.split('_')) for s in lattice_dims_strs]
+    rows = []
+    for i, data in enumerate(samples):
+        for spec, lattice in zip(lattice_dims_strs, lattices_from_dims(data, specs)):
+            flops, nbytes = filter_cost(len(data), lattice.num_vertices, lattice.d, channels[0], channels[1],
+                                        neighborhood_size)
+            rows.append(dict(spec=spec, sample=i, points=len(data), vertices=lattice.num_vertices,
+                             points_per_vertex=len(data) / lattice.num_vertices,
+                             fill=float(np.mean(lattice.neighbors(neighborhood_size) >= 0)),
+                             flops=flops, bytes=nbytes))
+    return rows
+
+
+def summarize(rows):
+    """
+    :return: a dict of spec -> averages (and maxima of vertices and bytes) over samples
+    """
+    summary = dict()
+    for spec in dict.fromkeys(r['spec'] for r in rows):
+        r = [v for v in rows if v['spec'] == spec]
+        summary[spec] = dict(samples=len(r),
+                             vertices_per_point=float(np.mean([v['vertices'] / v['points'] for v in r])),
+                             **{k: float(np.mean([v[k] for v in r]))
+                                for k in ('vertices', 'points_per_vertex', 'fill', 'flops', 'bytes')},
+                             max_vertices=int(max(v['vertices'] for v in r)),
+                             max_bytes=int(max(v['bytes'] for v in r)))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile lattice occupancy and filter cost of lattice specs',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dataset', choices=['shapenet', 'facade'], help='dataset')
+    parser.add_argument('lattice', nargs='+', help='lattice features and scales, e.g. x*64_y*64_z*64')
+    parser.add_argument('--input', default='x_y_z', help='input features the lattice specs refer to')
+    parser.add_argument('--categories', nargs='+', help='shapenet categories, otherwise all')
+    parser.add_argument('--subset', default='train', help='dataset subset')
+    parser.add_argument('--num_samples', default=100, type=int, help='number of samples to profile')
+    parser.add_argument('--sample_size', default=3000, type=int, help='number of points per sample')
+    parser.add_argument('--channels', nargs=2, type=int, default=[64, 64],
+                        help='input and output channels of the filter whose cost is estimated')
+    parser.add_argument('--neighborhood_size', default=1, type=int, help='filter neighborhood size')
+    parser.add_argument('--dataset_params', nargs='+', help='dataset-specific parameters (key value pairs)')
+    parser.add_argument('--per_sample', action='store_true', help='if True, also print one row per sample')
+    parser.add_argument('--save_json', default=None, type=str, help='save per-spec summary to a .json file')
+    args = parser.parse_args()
+
+    dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2])) if args.dataset_params else {}
+    samples = load_samples(args.dataset, args.input, args.num_samples, args.sample_size, args.categories,
+                           args.subset, dataset_params)
+    rows = profile_lattice(samples, args.lattice, args.input, args.channels, args.neighborhood_size)
+
+    header = '{:24} {:>7} {:>9} {:>10} {:>6} {:>10} {:>9}'
+    line = '{:24} {:>7} {:9.0f} {:10.2f} {:6.3f} {:10.1f} {:9.2f}'
+    if args.per_sample:
+        print(header.format('lattice', 'sample', 'vertices', 'pts/vertex', 'fill', 'MFLOPs', 'MB'))
+        for r in rows:
+            print(line.format(r['spec'], r['sample'], r['vertices'], r['points_per_vertex'], r['fill'],
+                              r['flops'] / 1e6, r['bytes'] / 2 ** 20))
+        print()
+
+    summary = summarize(rows)
+    print(header.format('lattice', 'samples', 'vertices', 'pts/vertex', 'fill', 'MFLOPs', 'MB(max)'))
+    for spec, s in summary.items():
+        print(line.format(spec, s['samples'], s['vertices'], s['points_per_vertex'], s['fill'], s['flops'] / 1e6,
+                          s['max_bytes'] / 2 ** 20))
+
+    if args.save_json:
+        with open(args.save_json, 'w') as f:
+            json.dump(dict(dataset=args.dataset, input=args.input, sample_size=args.sample_size,
+                           neighborhood_size=args.neighborhood_size, lattices=summary), f, indent=2)
@@ -0,0 +1,117 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import caffe
+
+import splatnet.configs  # makes custom_layers and dataset layers importable by caffe
+
+
+def layer_type(net, i):
+    layer = net.layers[i]
+    return layer.type if layer.type != 'Python' else 'Python:' + type(layer).__name__
+
+
+def profile(net, num_iter=10, warmup=2, backward=True):
+    """
+    Time every layer by stepping through the network one layer at a time. Layers are run by index (Net::ForwardFromTo
+    and BackwardFromTo), unlike net.forward(start=..., end=...), which would copy output blobs to the host after each
+    layer. On gpu, timings only cover kernels if launches are synchronous (CUDA_LAUNCH_BLOCKING=1, see __main__).
+    :return: a dict of layer name -> (type, list of forward times, list of backward times), and a list of
+             trace events (name, phase, start, duration; seconds relative to the first iteration)
+    """
+    names = list(net._layer_names)
+    times = {name: (layer_type(net, i), [], []) for i, name in enumerate(names)}
+    events = []
+    t0 = None
+    for it in range(warmup + num_iter):
+        record = it >= warmup
+        if record and t0 is None:
+            t0 = time.time()
+        passes = [('forward', range(len(names)), net._forward, 1)]
+        if backward:
+            passes.append(('backward', range(len(names) - 1, -1, -1), net._backward, 2))
+        for phase, order, step, k in passes:
+            for i in order:
+                tic = time.time()
+                step(i, i)
+                toc = time.time()
+                if record:
+                    times[names[i]][k].append(toc - tic)
+                    events.append((names[i], phase, tic - t0, toc - tic))
+    return times, events
+
+
+def summarize(times):
+    """
+    :return: list of dicts (name, type, forward/backward/total ms, share of total), slowest first
+    """
+    rows = [dict(name=name, type=t, forward_ms=np.mean(fw) * 1000 if fw else 0.0,
+                 backward_ms=np.mean(bw) * 1000 if bw else 0.0) for name, (t, fw, bw) in times.items()]
+    total = sum(r['forward_ms'] + r['backward_ms'] for r in rows)
+    for r in rows:
+        r['total_ms'] = r['forward_ms'] + r['backward_ms']
+        r['share'] = r['total_ms'] / total if total > 0 else 0.0
+    return sorted(rows, key=lambda r: -r['total_ms'])
+
+
+def chrome_trace(events):
+    """
+    :return: a dict in the Chrome trace event format (load in chrome://tracing)
+    """
+    return dict(traceEvents=[dict(name=name, cat=phase, ph='X', ts=start * 1e6, dur=dur * 1e6, pid=0,
+                                  tid=0 if phase == 'forward' else 1) for name, phase, start, dur in events],
+                displayTimeUnit='ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time forward/backward of every layer of a network',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('network', help='a .prototxt file (training or deploy)')
+    parser.add_argument('--weights', default=None, type=str, help='a .caffemodel file')
+    parser.add_argument('--phase', default='train', choices=('train', 'test'), help='network phase')
+    parser.add_argument('--num_iter', default=10, type=int, help='number of timed iterations')
+    parser.add_argument('--warmup', default=2, type=int, help='number of untimed iterations')
+    parser.add_argument('--no_backward', action='store_true', help='if True, only time forward passes')
+    parser.add_argument('--save_json', default=None, type=str, help='save the per-layer table to a .json file')
+    parser.add_argument('--save_trace', default=None, type=str, help='save a Chrome trace (.json) of all passes')
+    parser.add_argument('--cpu', action='store_true',
+                        help='use cpu (on gpu, kernel launches are made synchronous to time each layer, which adds '
+                             'launch latency to every layer)')
+    args = parser.parse_args()
+
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        os.environ['CUDA_LAUNCH_BLOCKING'] = '1'  # read when the CUDA context is created, in set_mode_gpu
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    phase = caffe.TRAIN if args.phase == 'train' else caffe.TEST
+    net = caffe.Net(args.network, args.weights, phase) if args.weights else caffe.Net(args.network, phase)
+    for name in net.inputs:  # deploy networks: random points
+        net.blobs[name].data[...] = np.random.uniform(-1, 1, net.blobs[name].data.shape)
+
+    times, events = profile(net, args.num_iter, args.warmup, backward=not args.no_backward)
+    rows = summarize(times)
+
+    print('{:16} {:28} {:>12} {:>12} {:>12} {:>7}'.format('layer', 'type', 'forward(ms)', 'backward(ms)',
+                                                          'total(ms)', 'share'))
+    for r in rows:
+        print('{:16} {:28} {:12.3f} {:12.3f} {:12.3f} {:6.1f}%'.format(
+            r['name'], r['type'], r['forward_ms'], r['backward_ms'], r['total_ms'], r['share'] * 100))
+    print('{:16} {:28} {:12.3f} {:12.3f} {:12.3f}'.format(
+        'total', '', sum(r['forward_ms'] for r in rows), sum(r['backward_ms'] for r in rows),
+        sum(r['total_ms'] for r in rows)))
+
+    if args.save_json:
+        with open(args.save_json, 'w') as f:
+            json.dump(dict(network=args.network, phase=args.phase, num_iter=args.num_iter, layers=rows), f, indent=2)
+    if args.save_trace:
+        with open(args.save_trace, 'w') as f:
+            json.dump(chrome_trace(events), f)
@@ -0,0 +1,221 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import os
+import argparse
+import numpy as np
+import caffe
+
+import splatnet.configs
+from splatnet.partseg3d import models
+from splatnet.partseg3d.test import partseg_test
+from splatnet.utils import pad_indices, reshape_net_inputs
+
+
+def parse_arch(arch_str):
+    return [(v[0], int(v[1:])) if v[0] in {'b', 'c'} else ('c', int(v)) for v in arch_str.split('_')]
+
+
+def format_arch(arch):
+    return '_'.join('{}{}'.format(t, c) for t, c in arch)
+
+
+def parse_skips(skip_str):
+    """
+    :return: a dict of block index -> (list of source block indices, options), as wired in models.partseg_seq
+    """
+    skips = dict()
+    for v in (skip_str if skip_str else ()):
+        params = v.split('_')
+        to, opts = int(params[0]), params[2] if len(params) > 2 else ''
+        skips.setdefault(to, ([], opts))[0].append(int(params[1]))
+    return skips
+
+
+def block_layouts(arch, skips):
+    """
+    Trace where the channels of each block output come from through global pooling, Concat and Eltwise
+    :return: a dict of block index -> list of (source block index, channel), and a dict of block index ->
+             representative block index (blocks that are summed together must keep the same channels)
+    """
+    group = {idx: idx for idx in range(1, len(arch) + 1)}
+
+    def find(i):
+        while group[i] != i:
+            i = group[i]
+        return i
+
+    layouts = dict()
+    for idx, (_, n_out) in enumerate(arch, start=1):
+        layout = [(idx, c) for c in range(n_out)]
+        if idx in skips:
+            sources, opts = skips[idx]
+            if 'a' in opts:
+                for src in sources:
+                    assert layouts[src] == [(src, c) for c in range(n_out)], 'Only block outputs can be summed'
+                    group[find(src)] = find(idx)
+            else:
+                for src in sources:
+                    layout = layout + layouts[src]
+        layouts[idx] = layout
+    return layouts, {idx: find(idx) for idx in group}
+
+
+def activation_blob(idx, batchnorm=True):
+    return 'bn{}'.format(idx) if batchnorm else 'conv{}'.format(idx)
+
+
+def channel_scores(net, arch, data_list, sample_size, batchnorm=True):
+    """
+    Mean absolute activation of every channel of every block over a calibration set
+    :param data_list: list of N_i x C input arrays
+    :return: a dict of block index -> per-channel scores
+    """
+    reshape_net_inputs(net, ('data',), 1, sample_size)
+    scores = {idx: np.zeros(n_out) for idx, (_, n_out) in enumerate(arch, start=1)}
+    for data in data_list:
+        net.blobs['data'].data[...] = data[pad_indices(len(data), sample_size)].T.reshape(1, -1, 1, sample_size)
+        net.forward()
+        for idx in scores:
+            scores[idx] += np.abs(net.blobs[activation_blob(idx, batchnorm)].data).mean(axis=(0, 2, 3))
+    return {idx: v / len(data_list) for idx, v in scores.items()}
+
+
+def weight_scores(net, arch):
+    """
+    L1 norm of filters, when no calibration data is given
+    """
+    return {idx: np.abs(net.params['conv{}'.format(idx)][0].data).reshape(n_out, -1).sum(axis=1)
+            for idx, (_, n_out) in enumerate(arch, start=1)}
+
+
+def select_channels(arch, scores, groups, ratio):
+    """
+    :return: a dict of block index -> sorted indices of kept channels
+    """
+    keep = dict()
+    for rep in sorted(set(groups.values())):
+        members = [idx for idx in groups if groups[idx] == rep]
+        score = sum(scores[idx] for idx in members)
+        n_keep = max(1, int(round(len(score) * (1 - ratio))))
+        kept = np.sort(np.argsort(-score)[:n_keep])
+        for idx in members:
+            keep[idx] = kept
+    return keep
+
+
+def prune_params(net, arch, layouts, keep, batchnorm=True):
+    """
+    :return: a dict of layer name -> list of pruned parameter arrays
+    """
+    params = dict()
+    keep_sets = {idx: set(v) for idx, v in keep.items()}
+    for idx in range(1, len(arch) + 2):
+        name = 'conv{}'.format(idx)
+        w, b = [v.data for v in net.params[name]]
+        out_idx = keep[idx] if idx in keep else np.arange(w.shape[0])
+        if idx > 1:
+            in_idx = [i for i, (src, c) in enumerate(layouts[idx - 1]) if c in keep_sets[src]]
+        else:
+            in_idx = np.arange(w.shape[1])
+        params[name] = [w[out_idx][:, in_idx], b.reshape(-1)[out_idx]]
+        if batchnorm and idx in keep:
+            mean, var, scale_factor = [v.data for v in net.params['bn{}'.format(idx)]]
+            params['bn{}'.format(idx)] = [mean.reshape(-1)[out_idx], var.reshape(-1)[out_idx], scale_factor]
+    return params
+
+
+def save_params(network, params, save_path):
+    net = caffe.Net(network, caffe.TEST)
+    for name, blobs in params.items():
+        for blob, v in zip(net.params[name], blobs):
+            blob.data[...] = v.reshape(blob.data.shape)
+    net.save(save_path)
+
+
+def prune(exp_dir, category, arch_str, skips, feat, lattice, input_dims, ratios, dataset_params=None,
+          num_calib=64, sample_size=3000, batch_size=32, use_cpu=False):
+    """
+    Prune a trained per-category part segmentation model (as trained by partseg3d/train.py) at several ratios
+    :param ratios: fractions of channels to remove from every block
+    :param num_calib: number of validation shapes used to rank channels, 0 -- rank by filter weights instead
+    :return: list of dicts, one per ratio (including 0 -- the original model)
+    """
+    if use_cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    arch, skip_map = parse_arch(arch_str), parse_skips(skips)
+    layouts, groups = block_layouts(arch, skip_map)
+
+    network = os.path.join(exp_dir, '{}_net_deploy.prototxt'.format(category))
+    weights = os.path.join(exp_dir, '{}.caffemodel'.format(category))
+    net = caffe.Net(network, weights, caffe.TEST)
+
+    if num_calib > 0:
+        import splatnet.dataset.dataset_shapenet as shapenet
+        params_calib = dict(subset='val')
+        params_calib.update({k: v for k, v in (dataset_params or {}).items() if k == 'root'})
+        data_list = shapenet.points_single_category(dims=input_dims, category=category, **params_calib)[0]
+        scores = channel_scores(net, arch, data_list[:num_calib], sample_size)
+    else:
+        scores = weight_scores(net, arch)
+
+    test_params = {k: v for k, v in (dataset_params or {}).items() if k == 'root'}
+    results = []
+    for ratio in [0.0] + list(ratios):
+        if ratio == 0:
+            arch_new, network_new, weights_new = arch_str, network, weights
+        else:
+            keep = select_channels(arch, scores, groups, ratio)
+            arch_new = format_arch([(t, len(keep[idx])) for idx, (t, _) in enumerate(arch, start=1)])
+            prefix = os.path.join(exp_dir, '{}_p{:g}'.format(category, ratio))
+            network_new = models.partseg_seq(deploy=True, arch_str=arch_new, skip_str=skips, category=category,
+                                             feat_dims_str=feat, lattice_dims_str=lattice,
+                                             sample_size=sample_size, save_path=prefix + '_net_deploy.prototxt')
+            weights_new = prefix + '.caffemodel'
+            save_params(network_new, prune_params(net, arch, layouts, keep), weights_new)
+
+        num_params = sum(v.data.size for vs in caffe.Net(network_new, weights_new, caffe.TEST).params.values()
+                         for v in vs)
+        acc, _, avgiou, elapsed = partseg_test('shapenet', network_new, weights_new, input_dims, sample_size,
+                                               batch_size, category, test_params, skip_ply=True, use_cpu=use_cpu)
+        results.append(dict(ratio=ratio, arch=arch_new, network=network_new, weights=weights_new,
+                            num_params=num_params, acc=np.mean(acc), iou=np.mean(avgiou), secs=elapsed,
+                            num_shapes=len(acc)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune channels of trained part segmentation models',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('exp_dir', help='folder with <category>.caffemodel and <category>_net_deploy.prototxt')
+    parser.add_argument('--categories', nargs='+', help='pick some categories, otherwise prune all')
+    parser.add_argument('--arch', default='64_128_256_256', help='network architecture of the trained models')
+    parser.add_argument('--skips', nargs='+', help='skip connections of the trained models')
+    parser.add_argument('--feat', default='x_y_z', help='features used as input by the trained models')
+    parser.add_argument('--lattice', nargs='+', help='bnn lattice features and scales of the trained models')
+    parser.add_argument('--input', default='x_y_z', help='input features of the deploy networks')
+    parser.add_argument('--ratios', nargs='+', type=float, default=[0.25, 0.5, 0.75],
+                        help='fractions of channels to remove')
+    parser.add_argument('--num_calib', default=64, type=int,
+                        help='number of validation shapes to rank channels; 0 -- rank by filter weights')
+    parser.add_argument('--dataset_params', nargs='+', help='dataset-specific parameters (key value pairs)')
+    parser.add_argument('--sample_size', default=3000, type=int, help='testing sample size')
+    parser.add_argument('--batch_size', default=32, type=int, help='testing batch size')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    args = parser.parse_args()
+
+    categories = args.categories if args.categories else splatnet.configs.SN_CATEGORY_NAMES
+    dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2])) if args.dataset_params else {}
+
+    print('category   ratio #params   secs/shape   acc      iou      arch')
+    for category in categories:
+        for r in prune(args.exp_dir, category, args.arch, args.skips, args.feat, args.lattice, args.input,
+                       args.ratios, dataset_params, args.num_calib, args.sample_size, args.batch_size, args.cpu):
+            print('{:10} {:5.2f} {:8d} {:10.4f}   {:.4f}   {:.4f}   {}'.format(
+                category, r['ratio'], r['num_params'], r['secs'] / r['num_shapes'], r['acc'], r['iou'], r['arch']),
+                flush=True)
@@ -0,0 +1,156 @@
+"""
+Copyright (C) 2018 NVIDIA Corporation.  All rights reserved.
+Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
+"""
+import os
+import ast
+import time
+import argparse
+import numpy as np
+import caffe
+
+import splatnet.configs  # makes custom_layers importable by caffe
+from splatnet import cost_model
+from splatnet.utils import get_prototxt
+from profile_lattice import load_samples
+
+
+def training_net(model, arch, skips, feat, lattice, sample_size, batch_size, dataset_params=None,
+                 category='airplane', renorm_class=False):
+    """
+    :return: a training network fed by its inputs (dataset layers replaced by Input layers), as a NetParameter,
+             and the feature dims of its 'data' input
+    """
+    net_param, _ = cost_model.network_variants(model, arch, skips, feat, lattice, sample_size, batch_size,
+                                               dataset_params, category, renorm_class)
+    feat_dims = [ast.literal_eval(l.python_param.param_str)['feat_dims'] for l in net_param.layer
+                 if l.type == 'Python' and l.python_param.module.startswith('dataset_')][0]
+    return cost_model.with_input_layers(net_param, 'TRAIN'), feat_dims
+
+
+def fill_inputs(net, samples, offset=0):
+    """
+    Feed a batch of real samples (lattice cost depends on how points occupy the lattice), starting at offset
+    :param samples: list of sample_size x C arrays, see profile_lattice.load_samples
+    """
+    for name in net.inputs:
+        blob = net.blobs[name]
+        if name == 'data':
+            batch = [samples[(offset + i) % len(samples)] for i in range(blob.data.shape[0])]
+            blob.data[...] = np.stack(batch).transpose(0, 2, 1)[:, :, np.newaxis, :]
+        elif name == 'label_mask':
+            blob.data[...] = 1
+        else:
+            blob.data[...] = 0  # labels
+
+
+def time_iteration(net, samples, repeat=5, warmup=2):
+    """
+    :return: average time (s) of a forward/backward pass, on different batches of samples
+    """
+    batch_size = net.blobs['data'].data.shape[0]
+    elapsed = 0.0
+    for i in range(warmup + repeat):
+        fill_inputs(net, samples, i * batch_size)
+        tic = time.time()
+        net.forward()
+        net.backward()
+        if i >= warmup:
+            elapsed += time.time() - tic
+    return elapsed / repeat
+
+
+def tune(model, arch, skips, feat, lattice, batch_sizes, sample_sizes, mem_budget, target_batch, dataset_params=None,
+         category='airplane', renorm_class=False, lattice_stats=None, vertices_per_point=1.0, repeat=5,
+         num_samples=64):
+    """
+    Time training iterations over a grid of batch/sample sizes, on samples of the training data
+    :param mem_budget: memory budget (bytes); configurations with a larger estimated footprint are skipped
+    :param target_batch: samples per solver iteration, reached with iter_size
+    :param num_samples: number of training samples loaded (per sample size) and cycled through
+    :return: list of dicts, one per configuration, with estimated memory and measured points/sec
+             (0 if skipped or failed)
+    """
+    dataset = 'facade' if model == 'semseg' else 'shapenet'
+    categories = [category] if model == 'partseg' else None
+    samples = dict()  # sample size -> list of samples
+    results = []
+    for bs in batch_sizes:
+        for ss in sample_sizes:
+            net_param, feat_dims = training_net(model, arch, skips, feat, lattice, ss, bs, dataset_params, category,
+                                                renorm_class)
+            est = cost_model.totals(cost_model.analyze(net_param, 'TRAIN', lattice_stats, vertices_per_point),
+                                    train=True)['total_bytes']
+            r = dict(batch_size=bs, sample_size=ss, iter_size=int(np.ceil(target_batch / bs)), est_bytes=est,
+                     secs=0.0, points_per_sec=0.0, status='ok')
+            if est > mem_budget:
+                r['status'] = 'over budget'
+            else:
+                try:
+                    if ss not in samples:
+                        samples[ss] = load_samples(dataset, feat_dims, num_samples, ss, categories, 'train',
+                                                   dataset_params)
+                    net_path = get_prototxt(net_param)
+                    try:
+                        net = caffe.Net(net_path, caffe.TRAIN)
+                    finally:
+                        os.remove(net_path)
+                    r['secs'] = time_iteration(net, samples[ss], repeat)
+                    r['points_per_sec'] = bs * ss / r['secs']
+                    del net
+                except Exception as e:  # e.g. out of memory
+                    r['status'] = 'failed: {}'.format(e)
+            results.append(r)
+            print('{:6d} {:8d} {:5d} {:10.1f} {:10.4f} {:12.0f}   {}'.format(
+                bs, ss, r['iter_size'], est / 2 ** 20, r['secs'], r['points_per_sec'], r['status']), flush=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pick batch/sample sizes with the highest training throughput',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', default='partseg', choices=('partseg', 'partseg_combined', 'semseg'),
+                        help='network generator')
+    parser.add_argument('--arch', default='64_128_256_256', help='network architecture')
+    parser.add_argument('--skips', nargs='+', help='skip connections')
+    parser.add_argument('--feat', default='x_y_z', help='features to use as input')
+    parser.add_argument('--lattice', nargs='+', help='bnn lattice features and scales')
+    parser.add_argument('--category', default='airplane', help='shapenet category (partseg)')
+    parser.add_argument('--renorm_class', action='store_true', help='renormalize prediction in true class')
+    parser.add_argument('--dataset_params', nargs='+', help='dataset-specific parameters (key value pairs)')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32], help='batch sizes to try')
+    parser.add_argument('--sample_sizes', nargs='+', type=int, default=[3000], help='sample sizes to try')
+    parser.add_argument('--target_batch', type=int, default=32,
+                        help='samples per solver iteration (batch_size x iter_size)')
+    parser.add_argument('--mem_budget', type=float, default=8000, help='memory budget (MB)')
+    parser.add_argument('--lattice_profile', default=None, type=str,
+                        help='a .json summary from tools/profile_lattice.py for memory estimates')
+    parser.add_argument('--vertices_per_point', type=float, default=1.0,
+                        help='occupied lattice vertices per point, for lattices without profile')
+    parser.add_argument('--repeat', default=5, type=int, help='number of timed iterations per configuration')
+    parser.add_argument('--num_samples', default=64, type=int, help='number of training samples to time on')
+    parser.add_argument('--cpu', action='store_true', help='use cpu')
+    args = parser.parse_args()
+
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(0)
+
+    dataset_params = dict(zip(args.dataset_params[::2], args.dataset_params[1::2])) if args.dataset_params else None
+    stats = cost_model.lattice_stats_from_json(args.lattice_profile, args.feat, args.lattice) \
+        if args.lattice_profile and args.lattice else None
+
+    print('{:>6} {:>8} {:>5} {:>10} {:>10} {:>12}'.format('batch', 'sample', 'iter', 'est(MB)', 'secs/iter',
+                                                           'points/sec'))
+    results = tune(args.model, args.arch, args.skips, args.feat, args.lattice, args.batch_sizes, args.sample_sizes,
+                   args.mem_budget * 2 ** 20, args.target_batch, dataset_params, args.category, args.renorm_class,
+                   stats, args.vertices_per_point, args.repeat, args.num_samples)
+
+    best = max(results, key=lambda r: r['points_per_sec'])
+    if best['points_per_sec'] > 0:
+        print('Best: {:.0f} points/sec'.format(best['points_per_sec']))
+        print('--batch_size {batch_size} --sample_size {sample_size} --iter_size {iter_size}'.format(**best))
+    else:
+        print('No configuration fits the memory budget')